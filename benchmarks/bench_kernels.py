@@ -0,0 +1,279 @@
+"""Time the array kernels of the builders against stored baselines
+
+Each kernel runs on synthetic 1024x1024 frames (files are written afresh
+before every timing, as most kernels update them in place) and the best
+of ``--repeat`` timings is kept.  The times are compared with those in
+``kernel_baselines.json``, and with ``--check`` any kernel slower than
+its baseline by more than the threshold ratio is reported as a
+regression and the exit status is 1.
+
+    python benchmarks/bench_kernels.py [--repeat N]       # print times
+    python benchmarks/bench_kernels.py --save             # record baselines
+    python benchmarks/bench_kernels.py --check [--threshold 1.5]
+
+The threshold defaults to ``REFSTIS_BENCHMARK_THRESHOLD``, and setting that
+variable also makes ``kernels_test.py`` run the check with the test suite.
+Baselines only mean something on the machine they were recorded on, so
+record them again after changing machines.
+
+"""
+
+import argparse
+from collections import OrderedDict
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from astropy.io import fits
+import numpy as np
+
+from refstis import basedark, basejoint, functions, refbias, refcache
+from refstis import synthetic, weekdark
+from refstis.msarith import msarith
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kernel_baselines.json')
+DEFAULT_THRESHOLD = 1.5
+
+#-------------------------------------------------------------------------------
+
+def make_sci(seed=1, level=0.0, noise=1.0):
+    """Frame with noise, hot pixels and a few hot columns"""
+
+    rng = np.random.default_rng(seed)
+    sci = rng.normal(level, noise, (1024, 1024)).astype(np.float32)
+    n_hot = sci.size // 200
+    sci[rng.integers(0, 1024, n_hot), rng.integers(0, 1024, n_hot)] += \
+        rng.exponential(50 * noise, n_hot).astype(np.float32)
+    sci[:, rng.integers(0, 1024, 8)] += 10 * noise
+
+    return sci
+
+#-------------------------------------------------------------------------------
+
+def write_imsets(filename, n_imsets=1, seed=1, level=0.0, noise=1.0, targname='DARK'):
+    """Calibrated-looking file with SCI/ERR/DQ imsets"""
+
+    primary = fits.PrimaryHDU()
+    primary.header['NEXTEND'] = 3 * n_imsets
+    primary.header['TARGNAME'] = targname
+    primary.header['TEXPTIME'] = 1100.0 * n_imsets
+    primary.header['ATODGAIN'] = 1.0
+    primary.header['CCDGAIN'] = 1
+    primary.header['BINAXIS1'] = 1
+    primary.header['BINAXIS2'] = 1
+
+    hdu = fits.HDUList(primary)
+    for i in range(n_imsets):
+        sci = make_sci(seed + i, level, noise)
+        for extname, data in (('SCI', sci),
+                              ('ERR', np.full_like(sci, noise)),
+                              ('DQ', np.zeros(sci.shape, dtype=np.int16))):
+            ext = fits.ImageHDU(data)
+            ext.header['EXTNAME'] = extname
+            ext.header['EXTVER'] = i + 1
+            if extname == 'SCI':
+                ext.header['OCCDHTAV'] = 18.0 + i
+            hdu.append(ext)
+
+    hdu.writeto(filename, overwrite=True)
+    return filename
+
+#-------------------------------------------------------------------------------
+#-- each kernel prepares its inputs in a folder, and returns the call to time
+
+def kernel_make_residual(tmpdir):
+    sci = make_sci()
+    return lambda: functions.make_residual(sci, (3, 15))
+
+def kernel_make_resicols_image(tmpdir):
+    residual = make_sci()
+    return lambda: functions.make_resicols_image(residual, yfrac=.25)
+
+def kernel_hot_columns(tmpdir):
+    residual = make_sci()
+    return lambda: functions.hot_columns(functions.column_means(residual, (1, .2))[1])
+
+def kernel_normalize_crj(tmpdir):
+    filename = write_imsets(os.path.join(tmpdir, 'crj.fits'), level=100)
+    return lambda: functions.normalize_crj(filename)
+
+def kernel_apply_dark_correction(tmpdir):
+    filename = write_imsets(os.path.join(tmpdir, 'joined.fits'), n_imsets=4, level=10)
+    return lambda: functions.apply_dark_correction(filename, 57000.)
+
+def kernel_msjoin(tmpdir):
+    detector = synthetic.Detector()
+    rng = np.random.default_rng(2)
+    raw_files = []
+    for i in range(3):
+        filename = os.path.join(tmpdir, 'o00000{:03d}_raw.fits'.format(i))
+        synthetic.write_raw(filename, detector, rng, nimsets=2, expstart=57000. + i)
+        raw_files.append(filename)
+    joined = os.path.join(tmpdir, 'joined.fits')
+    return lambda: functions.msjoin(raw_files, joined)
+
+def kernel_replace_hot_cols(tmpdir):
+    mean_bias = make_sci()
+    residual, median = functions.make_residual(mean_bias)
+    return lambda: basejoint.replace_hot_cols(mean_bias, median, residual, yfrac=(1, .2))
+
+def kernel_replace_hot_pix(tmpdir):
+    mean_bias = make_sci()
+    residual, median = functions.make_residual(mean_bias)
+    return lambda: basejoint.replace_hot_pix(mean_bias, median)
+
+def kernel_flag_hotpix(tmpdir):
+    sci = make_sci(level=0.01, noise=0.002)
+    dq = np.zeros(sci.shape, dtype=np.int16)
+    return lambda: basedark.flag_hotpix(sci, dq)
+
+def kernel_flag_hot_pixels(tmpdir):
+    filename = write_imsets(os.path.join(tmpdir, 'refbias.fits'), targname='BIAS')
+    return lambda: refbias.flag_hot_pixels(filename)
+
+def kernel_create_superdark(tmpdir):
+    crj = write_imsets(os.path.join(tmpdir, 'crj.fits'), seed=1, level=0.01, noise=0.002)
+    base = write_imsets(os.path.join(tmpdir, 'basedark.fits'), seed=7, level=0.01, noise=0.002)
+    refcache.cache().clear()
+    return lambda: weekdark.create_superdark(crj, base)
+
+def kernel_update_sci(tmpdir):
+    filename = write_imsets(os.path.join(tmpdir, 'basedark.fits'), level=0.01, noise=0.002)
+    return lambda: basedark.update_sci(filename)
+
+def kernel_find_hotpix(tmpdir):
+    filename = write_imsets(os.path.join(tmpdir, 'basedark.fits'), level=0.01, noise=0.002)
+    return lambda: basedark.find_hotpix(filename)
+
+def kernel_msarith(tmpdir):
+    first = write_imsets(os.path.join(tmpdir, 'first.fits'), n_imsets=2, seed=1, level=10)
+    second = write_imsets(os.path.join(tmpdir, 'second.fits'), n_imsets=2, seed=5, level=10)
+    result = os.path.join(tmpdir, 'result.fits')
+    return lambda: msarith(first, '-', second, result, verbose=False)
+
+KERNELS = OrderedDict((name[len('kernel_'):], func)
+                      for name, func in sorted(globals().items())
+                      if name.startswith('kernel_'))
+
+#-------------------------------------------------------------------------------
+
+def time_kernel(name, repeat=5):
+    """Best time of a kernel, with fresh inputs for every call"""
+
+    times = []
+    for i in range(repeat):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with contextlib.redirect_stdout(io.StringIO()):
+                run = KERNELS[name](tmpdir)
+                start = time.perf_counter()
+                run()
+                times.append(time.perf_counter() - start)
+
+    return min(times)
+
+#-------------------------------------------------------------------------------
+
+def machine():
+    return '{} {} cpus, numpy {}'.format(platform.machine(), os.cpu_count(), np.__version__)
+
+#-------------------------------------------------------------------------------
+
+def load_baselines(filename=BASELINES):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except IOError:
+        return {'machine': None, 'kernels': {}}
+
+#-------------------------------------------------------------------------------
+
+def save_baselines(times, filename=BASELINES):
+    with open(filename, 'w') as f:
+        json.dump({'machine': machine(), 'kernels': times}, f, indent=1, sort_keys=True)
+        f.write('\n')
+
+#-------------------------------------------------------------------------------
+
+def check(threshold=DEFAULT_THRESHOLD, repeat=5, names=None, verbose=True):
+    """Time the kernels and compare them with the baselines
+
+    Parameters
+    ----------
+    threshold : float, optional
+        largest allowed ratio of a time to its baseline
+    repeat : int, optional
+        number of timings to take the best of
+    names : list, optional
+        kernels to time, defaults to all
+    verbose : bool, optional
+        print a table of the times
+
+    Returns
+    -------
+    regressions : dict
+        (time, baseline) of every kernel over the threshold
+    times : dict
+        time of every kernel
+
+    """
+
+    baselines = load_baselines()
+    if verbose and baselines['machine'] not in (None, machine()):
+        print('Baselines were recorded on {}, this is {}'.format(baselines['machine'], machine()))
+
+    times = {}
+    regressions = {}
+    if verbose:
+        print('{:<24} {:>10} {:>10} {:>7}'.format('kernel', 'time (s)', 'baseline', 'ratio'))
+    for name in names or KERNELS:
+        times[name] = time_kernel(name, repeat)
+        baseline = baselines['kernels'].get(name)
+        ratio = times[name] / baseline if baseline else float('nan')
+        if baseline and ratio > threshold:
+            regressions[name] = (times[name], baseline)
+        if verbose:
+            print('{:<24} {:>10.4f} {:>10.4f} {:>6.2f}x{}'.format(
+                name, times[name], baseline or float('nan'), ratio,
+                '  REGRESSION' if name in regressions else ''))
+
+    return regressions, times
+
+#-------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('kernels', nargs='*',
+                        help='kernels to time, all by default: {}'.format(', '.join(KERNELS)))
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of timings to take the best of')
+    parser.add_argument('--save', action='store_true',
+                        help='record the times as the new baselines')
+    parser.add_argument('--check', action='store_true',
+                        help='exit with status 1 if any kernel is over the threshold')
+    parser.add_argument('--threshold', type=float,
+                        default=float(os.environ.get('REFSTIS_BENCHMARK_THRESHOLD',
+                                                     DEFAULT_THRESHOLD)),
+                        help='largest allowed ratio to the baseline')
+    args = parser.parse_args()
+
+    unknown = set(args.kernels) - set(KERNELS)
+    if unknown:
+        parser.error('unknown kernels {}'.format(', '.join(sorted(unknown))))
+
+    regressions, times = check(args.threshold, args.repeat, args.kernels)
+
+    if args.save:
+        baselines = load_baselines()['kernels']
+        baselines.update(times)
+        save_baselines(baselines)
+        print('Baselines written to {}'.format(BASELINES))
+
+    if args.check and regressions:
+        print('{} kernel(s) slower than {:.2f}x their baseline: {}'.format(
+            len(regressions), args.threshold, ', '.join(sorted(regressions))))
+        sys.exit(1)
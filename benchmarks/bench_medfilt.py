@@ -0,0 +1,59 @@
+"""Compare refstis.medfilt with the scipy median filters it replaces
+
+Times each kernel used by the builders on a synthetic 1024x1024 float32
+frame and checks that the outputs are identical.
+
+    python benchmarks/bench_medfilt.py [--repeat N] [--workers N]
+
+"""
+
+import argparse
+import time
+
+import numpy as np
+from scipy.ndimage import median_filter
+from scipy.signal import medfilt
+
+from refstis import medfilt as refstis_medfilt
+
+#-- (scipy function, refstis function, kernel) as called from the builders
+CASES = [('ndimage.median_filter', median_filter, refstis_medfilt.median_filter, (3, 15)),
+         ('signal.medfilt', medfilt, refstis_medfilt.medfilt, (3, 15)),
+         ('signal.medfilt', medfilt, refstis_medfilt.medfilt, (5, 5))]
+
+#-------------------------------------------------------------------------------
+
+def best_time(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+#-------------------------------------------------------------------------------
+
+def main(repeat=3, workers=None):
+    frame = np.random.RandomState(1).normal(1000, 5, (1024, 1024)).astype(np.float32)
+    print('{:>22} {:>8} {:>10} {:>12} {:>8} {:>10}'.format(
+        'scipy', 'kernel', 'scipy (s)', 'refstis (s)', 'speedup', 'identical'))
+
+    for name, scipy_func, refstis_func, kernel in CASES:
+        t_scipy, expected = best_time(lambda: scipy_func(frame, kernel), repeat)
+        t_refstis, result = best_time(lambda: refstis_func(frame, kernel, workers=workers),
+                                      repeat)
+        print('{:>22} {:>8} {:>10.3f} {:>12.3f} {:>7.1f}x {:>10}'.format(
+            name, '{}x{}'.format(*kernel), t_scipy, t_refstis, t_scipy / t_refstis,
+            str(np.array_equal(expected, result))))
+
+#-------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timings to take the best of')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='threads used by refstis.medfilt, one per CPU by default')
+    args = parser.parse_args()
+
+    main(args.repeat, args.workers)
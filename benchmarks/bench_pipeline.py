@@ -0,0 +1,143 @@
+"""Time the refstis builders and pipeline on synthetic anneal months
+
+For each scale a month of synthetic raw biases and darks is written with
+`refstis.synthetic` (``--scales 1`` is 2 gain 1 biases of 4 imsets and 1
+dark of 2 imsets per week), and the following are timed on it:
+
+* separate_period
+* make_refbias and make_weekbias of the first gain 1 week, with numpy
+  cosmic-ray rejection (the weekbias uses the refbias as its basebias)
+
+If hstcal is installed (``cs1.e`` on the PATH) and ``oref`` points to a
+folder of STIS reference files, these are timed as well:
+
+* make_basebias, bias subtraction of the darks, make_basedark and
+  make_weekdark
+* make_pipeline_reffiles on a fresh copy of the month
+
+    python benchmarks/bench_pipeline.py [--scales 1 2 4] [--workers N]
+                                        [--method numpy] [--keep DIR]
+
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+from refstis import basedark, basejoint, functions, pipeline, refbias
+from refstis import synthetic, weekbias, weekdark
+
+#-------------------------------------------------------------------------------
+
+def have_calstis():
+    oref = os.environ.get('oref', '')
+    return bool(shutil.which('cs1.e')) and os.path.isdir(oref)
+
+#-------------------------------------------------------------------------------
+
+def timed(timings, scale, stage, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings.append((scale, stage, time.perf_counter() - start))
+    return result
+
+#-------------------------------------------------------------------------------
+
+def make_month(folder, scale, seed=1):
+    return synthetic.make_anneal_month(folder,
+                                       bias_per_week=2 * scale,
+                                       bias_imsets=4,
+                                       dark_per_week=scale,
+                                       dark_imsets=2,
+                                       gain4_bias_per_biweek=scale,
+                                       gain4_bias_imsets=4,
+                                       seed=seed)
+
+#-------------------------------------------------------------------------------
+
+def bench_scale(work_dir, scale, workers=1, method='numpy'):
+    timings = []
+
+    pristine = os.path.join(work_dir, 'raw')
+    raw_files = timed(timings, scale, 'generate', make_month, pristine, scale)
+    n_imsets = int(functions.count_imsets(raw_files))
+    print('Scale {}: {} files, {} imsets'.format(scale, len(raw_files), n_imsets))
+
+    month = os.path.join(work_dir, '14425_01')
+    shutil.copytree(pristine, month)
+    timed(timings, scale, 'separate_period', pipeline.separate_period, month)
+
+    week = os.path.join(month, 'biases', '1-1x1', 'wk01')
+    bias_files = sorted(glob.glob(os.path.join(week, '*_raw.fits')))
+    refbias_name = os.path.join(week, 'refbias_wk01.fits')
+    timed(timings, scale, 'make_refbias', refbias.make_refbias,
+          bias_files, refbias_name, crreject_method='numpy')
+    timed(timings, scale, 'make_weekbias', weekbias.make_weekbias,
+          bias_files, os.path.join(week, 'weekbias_wk01.fits'), refbias_name,
+          crreject_method='numpy')
+
+    if not have_calstis():
+        print('hstcal or oref not available, skipping the calstis stages')
+        return timings, n_imsets
+
+    gain1_biases = sorted(glob.glob(os.path.join(month, 'biases', '1-1x1', '*', '*_raw.fits')))
+    basebias_name = os.path.join(month, 'basebias.fits')
+    timed(timings, scale, 'make_basebias', basejoint.make_basebias,
+          gain1_biases, basebias_name)
+
+    dark_week = os.path.join(month, 'darks', 'wk01')
+    dark_files = sorted(glob.glob(os.path.join(month, 'darks', '*', '*_raw.fits')))
+    flt_files = timed(timings, scale, 'bias_subtract_data', functions.bias_subtract_data_many,
+                      dark_files, basebias_name)
+    basedark_name = os.path.join(month, 'basedark.fits')
+    timed(timings, scale, 'make_basedark', basedark.make_basedark,
+          flt_files, basedark_name)
+    week_flts = [item for item in flt_files if item.startswith(dark_week)]
+    timed(timings, scale, 'make_weekdark', weekdark.make_weekdark,
+          week_flts, os.path.join(dark_week, 'weekdark_wk01.fits'), basedark_name,
+          basebias_name)
+
+    fresh = os.path.join(work_dir, 'pipeline', '14425_01')
+    shutil.copytree(pristine, fresh)
+    timed(timings, scale, 'make_pipeline_reffiles', pipeline.make_pipeline_reffiles,
+          fresh, crreject_method=method, workers=workers)
+
+    return timings, n_imsets
+
+#-------------------------------------------------------------------------------
+
+def main(scales=(1, 2, 4), workers=1, method='numpy', keep=None):
+    results = []
+    for scale in scales:
+        if keep:
+            work_dir = os.path.join(keep, 'scale{}'.format(scale))
+            os.makedirs(work_dir)
+            results.append(bench_scale(work_dir, scale, workers, method))
+        else:
+            with tempfile.TemporaryDirectory() as work_dir:
+                results.append(bench_scale(work_dir, scale, workers, method))
+
+    print()
+    print('{:>5} {:>7} {:<24} {:>10}'.format('scale', 'imsets', 'stage', 'time (s)'))
+    for timings, n_imsets in results:
+        for scale, stage, seconds in timings:
+            print('{:>5} {:>7} {:<24} {:>10.2f}'.format(scale, n_imsets, stage, seconds))
+
+#-------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 2, 4],
+                        help='data volumes to time, in multiples of the smallest month')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes used by make_pipeline_reffiles')
+    parser.add_argument('--method', default='numpy', choices=['numpy', 'calstis'],
+                        help='cosmic-ray rejection of the weekly biases in the pipeline')
+    parser.add_argument('--keep', default=None,
+                        help='write the months here and keep them, instead of a temporary folder')
+    args = parser.parse_args()
+
+    main(args.scales, args.workers, args.method, args.keep)
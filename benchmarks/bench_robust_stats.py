@@ -0,0 +1,68 @@
+"""Compare refstis.robust_stats with astropy.stats.sigma_clipped_stats
+
+Times both on a synthetic 1024x1024 frame (a bias-like gaussian with a
+sprinkling of hot pixels) for each sigma/maxiters pair used by the
+builders, and prints the largest difference in the returned statistics.
+
+    python benchmarks/bench_robust_stats.py [--repeat N]
+
+"""
+
+import argparse
+import time
+
+from astropy.stats import sigma_clipped_stats
+import numpy as np
+
+from refstis import robust_stats
+
+#-- (sigma, maxiters) as called from the builders
+SETTINGS = [(3, 20), (3, 30), (3, 40), (5, 40), (5, 50)]
+
+#-------------------------------------------------------------------------------
+
+def make_frame(shape=(1024, 1024), seed=1):
+    rng = np.random.RandomState(seed)
+    frame = rng.normal(1000, 5, shape).astype(np.float32)
+    n_hot = frame.size // 200
+    frame[rng.randint(0, shape[0], n_hot),
+          rng.randint(0, shape[1], n_hot)] += rng.exponential(500, n_hot)
+    return frame
+
+#-------------------------------------------------------------------------------
+
+def best_time(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+#-------------------------------------------------------------------------------
+
+def main(repeat=5):
+    frame = make_frame()
+    print('{:>5} {:>8} {:>12} {:>12} {:>8} {:>12}'.format(
+        'sigma', 'maxiters', 'astropy (s)', 'refstis (s)', 'speedup', 'max diff'))
+
+    for sigma, maxiters in SETTINGS:
+        t_astropy, expected = best_time(
+            lambda: sigma_clipped_stats(frame, sigma=sigma, maxiters=maxiters), repeat)
+        t_refstis, result = best_time(
+            lambda: robust_stats.sigma_clipped_stats(frame, sigma=sigma, maxiters=maxiters), repeat)
+
+        diff = np.max(np.abs(np.array(result, dtype=np.float64) -
+                             np.array(expected, dtype=np.float64)))
+        print('{:>5} {:>8} {:>12.4f} {:>12.4f} {:>7.1f}x {:>12.3g}'.format(
+            sigma, maxiters, t_astropy, t_refstis, t_astropy / t_refstis, diff))
+
+#-------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of timings to take the best of')
+    args = parser.parse_args()
+
+    main(args.repeat)
@@ -0,0 +1,23 @@
+import os
+from unittest import SkipTest
+
+import bench_kernels
+
+#-------------------------------------------------------------------------------
+
+def test_no_regressions():
+    """ No kernel should be slower than its baseline by more than the
+    REFSTIS_BENCHMARK_THRESHOLD ratio
+
+    """
+
+    threshold = os.environ.get('REFSTIS_BENCHMARK_THRESHOLD')
+    if not threshold:
+        raise SkipTest('Set REFSTIS_BENCHMARK_THRESHOLD to compare with the baselines')
+
+    regressions, times = bench_kernels.check(float(threshold))
+    assert not regressions, 'Slower than {}x the baseline: {}'.format(
+        threshold, ', '.join('{} {:.4f}s (baseline {:.4f}s)'.format(name, *regressions[name])
+                             for name in sorted(regressions)))
+
+#-------------------------------------------------------------------------------
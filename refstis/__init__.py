@@ -1,2 +1,19 @@
-from . import delivery
-from . import pipeline
+"""Pipeline to create STIS CCD superdarks and superbiases
+
+Submodules are imported when they are first used, so that scripts which
+only need one of the builders don't pay for loading matplotlib, crds and
+stistools.
+
+"""
+
+import importlib
+
+__all__ = ['delivery', 'pipeline']
+
+#-------------------------------------------------------------------------------
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
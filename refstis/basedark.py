@@ -1,8 +1,8 @@
 """Functions to create a BaseDark for the STIS instrument
 
 #. If not already done, perform bias subtraction
-#. If after switch to side-2 electronics, perform temperature scaling
-#. Join all imsets from input list into single file
+#. Join all imsets from input list into single file, performing temperature
+   scaling if after switch to side-2 electronics
 #. combine and cr-reject
 #. normalize to e/s by dividing by (exptime/gain)
 #. update DQ array with hot pixel information
@@ -17,12 +17,18 @@
 
 
 from astropy.io import fits
-from astropy.stats import sigma_clipped_stats
-import numpy as np
-from scipy.ndimage.filters import median_filter
+import glob
+import hashlib
+import os
 import shutil
 
+from . import calcache
 from . import functions
+from . import trace
+from .robust_stats import SortedSample
+
+#-- basedarks kept in a cache_dir by make_basedark, the most recently used
+MEMO_LIMIT = 2
 
 #-------------------------------------------------------------------------------
 
@@ -39,25 +45,30 @@ def update_sci(filename):
     """
 
     with fits.open(filename, mode='update') as hdu:
-        im_mean, im_median, im_std = sigma_clipped_stats(hdu[('sci', 1)].data,
-                                                         sigma=5,
-                                                         maxiters=50)
-        fivesig = im_mean + 5.0 * im_std
-        only_hotpix = np.where(hdu[('sci', 1)].data >= fivesig,
-                               hdu[('sci', 1)].data - im_mean,
-                               0)
+        hdu[('dq', 1)].data = update_sci_dq(hdu[('sci', 1)].data, hdu[('dq', 1)].data)
+
+#-------------------------------------------------------------------------------
+
+def update_sci_dq(sci, dq):
+    """DQ array of the baseline dark, see `update_sci`
+
+    Parameters
+    ----------
+    sci: np.ndarray
+        normalized science array
+    dq: np.ndarray
+        DQ array, updated in-place
 
+    Returns
+    -------
+    dq: np.ndarray
+        the updated DQ array
 
-        #-- I don't see this being used
-        med_im = median_filter(hdu[('sci', 1)].data, (3, 3))
-        only_baseline = np.where(hdu[('sci', 1)].data >= fivesig,
-                                 med_im,
-                                 hdu[('sci', 1)].data)
+    """
 
+    dq[_baseline_hotpix(sci, SortedSample(sci))] = 16
 
-        hdu[('dq', 1)].data = np.where(only_hotpix >= .1,
-                                       16,
-                                       hdu[('dq', 1)].data)
+    return dq
 
 #-------------------------------------------------------------------------------
 
@@ -78,21 +89,159 @@ def find_hotpix(filename):
     """
 
     with fits.open(filename, mode='update') as hdu:
-        im_mean, im_median, im_std = sigma_clipped_stats(hdu[('sci', 1)].data,
-                                                         sigma=3,
-                                                         maxiters=40)
+        hdu[('DQ', 1)].data = find_hotpix_dq(hdu[('SCI', 1)].data, hdu[('DQ', 1)].data)
+
+#-------------------------------------------------------------------------------
+
+def find_hotpix_dq(sci, dq):
+    """DQ array with the hot pixels flagged, see `find_hotpix`
+
+    Parameters
+    ----------
+    sci: np.ndarray
+        normalized science array
+    dq: np.ndarray
+        DQ array, updated in-place
+
+    Returns
+    -------
+    dq: np.ndarray
+        the updated DQ array
+
+    """
+
+    dq[_hotpix(sci, SortedSample(sci))] = 16
+
+    return dq
+
+#-------------------------------------------------------------------------------
+
+def flag_hotpix(sci, dq):
+    """Flag the hot pixels of the baseline dark in its DQ array
+
+    Does the work of `update_sci` followed by `find_hotpix` on arrays in
+    memory: the science array is sorted once and both sets of clipped
+    statistics are taken from it, and the hot pixels of both are combined
+    in a single boolean mask before the DQ array is updated.
+
+    Parameters
+    ----------
+    sci: np.ndarray
+        normalized science array
+    dq: np.ndarray
+        DQ array, updated in-place
+
+    Returns
+    -------
+    dq: np.ndarray
+        the updated DQ array
+
+    """
+
+    sample = SortedSample(sci)
+    hot = _baseline_hotpix(sci, sample)
+    hot |= _hotpix(sci, sample)
+    dq[hot] = 16
+
+    return dq
+
+#-------------------------------------------------------------------------------
+
+def _baseline_hotpix(sci, sample):
+    """Pixels above mean + 5*sigma, and at least 0.1 above the mean"""
+
+    im_mean, im_median, im_std = sample.sigma_clipped_stats(sigma=5, maxiters=50)
+
+    hot = sci >= im_mean + 5.0 * im_std
+    hot &= sci >= im_mean + .1
+
+    return hot
 
-        five_sigma = im_median + 5 * im_std
-        index = np.where((hdu[('SCI', 1)].data > five_sigma) &
-                         (hdu[('SCI', 1)].data > im_mean + 0.1))
+#-------------------------------------------------------------------------------
+
+def _hotpix(sci, sample):
+    """Pixels above median + 5*sigma, and more than 0.1 above the mean"""
+
+    im_mean, im_median, im_std = sample.sigma_clipped_stats(sigma=3, maxiters=40)
 
-        hdu[('DQ', 1)].data[index] = 16
+    hot = sci > im_median + 5 * im_std
+    hot &= sci > im_mean + 0.1
+
+    return hot
 
 #-------------------------------------------------------------------------------
 
-def make_basedark(input_list, refdark_name='basedark.fits', bias_file=None):
+def basedark_key(flt_list, bias_file=None, refdark_name='basedark.fits'):
+    """Key identifying a basedark built from the given prepared inputs
+
+    The key is made from the names and contents of the bias subtracted and
+    temperature corrected input files, sorted by name, with the contents
+    of the bias file and the name of the output, so any change to the
+    inputs or parameters gives a different key.
+
+    Parameters
+    ----------
+    flt_list: list
+        list of prepared input dark files
+
+    bias_file: str or None
+        bias file used in calibration
+
+    refdark_name: str
+        name of the output reference file
+
+    Returns
+    -------
+    key: str
+        hexadecimal key
+
+    """
+
+    digest = hashlib.sha256()
+    for filename in sorted(os.path.abspath(item) for item in flt_list):
+        digest.update('{} {}\n'.format(os.path.basename(filename),
+                                        calcache.file_digest(filename)).encode())
+
+    if bias_file and os.path.exists(bias_file):
+        bias_file = calcache.file_digest(bias_file)
+    digest.update('bias {}\n'.format(bias_file).encode())
+    digest.update('output {}\n'.format(os.path.basename(refdark_name)).encode())
+
+    return digest.hexdigest()[:16]
+
+#-------------------------------------------------------------------------------
+
+def prune_memos(cache_dir, keep=MEMO_LIMIT):
+    """Remove all but the most recently used basedarks kept in cache_dir
+
+    Parameters
+    ----------
+    cache_dir: str
+        directory holding previously built basedarks
+
+    keep: int
+        number of basedarks to keep
+
+    """
+
+    memos = sorted(glob.glob(os.path.join(cache_dir, 'basedark_memo_*.fits')),
+                   key=os.path.getmtime, reverse=True)
+    for item in memos[keep:]:
+        print('Removing old {}'.format(item))
+        functions.RemoveIfThere(item)
+
+#-------------------------------------------------------------------------------
+
+@trace.traced
+def make_basedark(input_list, refdark_name='basedark.fits', bias_file=None, cache_dir=None,
+                  workers=None):
     """Make a monthly baseline dark from the input list.
 
+    When a cache_dir is given, each basedark made is also kept there under
+    its `basedark_key`, and a later request with identical inputs and
+    parameters is filled from that copy instead of being rebuilt.  Only
+    the ``MEMO_LIMIT`` most recently used copies are kept.
+
     Parameters
     ----------
     input_list: list
@@ -104,6 +253,13 @@ def make_basedark(input_list, refdark_name='basedark.fits', bias_file=None):
     bias_file: str or None
         bias file to be used in calibration (optional)
 
+    cache_dir: str or None
+        directory holding previously built basedarks (optional)
+
+    workers: int or None
+        number of files bias subtracted at a time, see
+        `refstis.functions.bias_subtract_data_many` (optional)
+
     """
 
     print('#-------------------------------#')
@@ -114,14 +270,20 @@ def make_basedark(input_list, refdark_name='basedark.fits', bias_file=None):
 
     #-- bias subtract data if not already done
     if bias_file:
-        flt_list = [functions.bias_subtract_data(item, bias_file) for item in input_list]
+        flt_list = functions.bias_subtract_data_many(input_list, bias_file, workers=workers)
     else:
         flt_list = input_list
 
-    for filename in flt_list:
-        texpstrt = fits.getval(filename, 'texpstrt', 0)
-        if texpstrt > 52091.0:
-            functions.apply_dark_correction(filename, texpstrt)
+    if cache_dir:
+        key = basedark_key(flt_list, bias_file, refdark_name)
+        memo_name = os.path.join(cache_dir, 'basedark_memo_{}.fits'.format(key))
+        if os.path.exists(memo_name):
+            print('Reusing {}, made from the same inputs'.format(memo_name))
+            shutil.copy(memo_name, refdark_name)
+            with functions.header_edits(refdark_name) as header:
+                header['FILENAME'] = os.path.basename(refdark_name)
+            os.utime(memo_name)
+            return
 
     joined_filename = refdark_name.replace('.fits', '_joined.fits')
     crj_filename = joined_filename.replace('.fits', '_crj.fits')
@@ -129,28 +291,30 @@ def make_basedark(input_list, refdark_name='basedark.fits', bias_file=None):
     #if not bias_file:
     #    raise IOError('No biasfile specified, this task needs one to run')
 
-    print('Joining images')
-    functions.msjoin(flt_list, joined_filename)
+    print('Joining and temperature correcting images')
+    functions.msjoin(flt_list, joined_filename, scale_temperature=True)
 
     print('Performing CRREJECT')
     crdone = functions.bd_crreject(joined_filename)
     if not crdone:
         functions.bd_calstis(joined_filename, bias_file)
 
-    functions.normalize_crj(crj_filename)
-    shutil.copy(crj_filename, refdark_name)
+    sci, err, dq = functions.normalized_imset(crj_filename)
+    flag_hotpix(sci, dq)
 
-    update_sci(refdark_name)
-    find_hotpix(refdark_name)
-
-    functions.update_header_from_input(refdark_name, input_list)
-    fits.setval(refdark_name, 'TASKNAME', ext=0, value='BASEDARK')
+    functions.write_reference_file(refdark_name, input_list, sci, err, dq,
+                                   taskname='BASEDARK')
 
     print('Cleaning...')
     functions.RemoveIfThere(crj_filename)
     functions.RemoveIfThere(joined_filename)
     #map(functions.RemoveIfThere, flt_list)
 
+    if cache_dir:
+        shutil.copy(refdark_name, memo_name + '.tmp')
+        os.replace(memo_name + '.tmp', memo_name)
+        prune_memos(cache_dir)
+
     print('basedark done for {}'.format(refdark_name))
 
 #-------------------------------------------------------------------------------
@@ -23,14 +23,16 @@ scales appropriate to the gain and binning settings of the superbias.
 """
 
 from astropy.io import fits
-from astropy.stats import sigma_clipped_stats
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 import os
 import shutil
-import sys
-import stistools
 
+from . import calcache
 from . import functions
+from . import header_index
+from . import trace
+from .robust_stats import sigma_clipped_stats
 
 #-------------------------------------------------------------------------------
 
@@ -53,65 +55,230 @@ def average_biases(bias_list):
 
     """
 
-    assert len(bias_list), 'Bias list is empty'
+    hdulist, totalweight = average_bias_arrays(bias_list)
 
     file_path, file_name = os.path.split(bias_list[0])
     mean_file = os.path.join(file_path, 'mean.fits')
-
-    for iteration, item in enumerate(bias_list):
-        with fits.open(item) as hdu:
-            hdr0 = hdu[0].header
-            hdr1 = hdu[1].header
-            nimset = hdr0['nextend'] // 3
-            ncombine = hdr1['ncombine']
-
-            #-- If input files have more than one imset or
-            #-- have not been cr-rejected, exit
-            if (nimset > 1) | (ncombine <= 1):
-                print('Input files have to be single imset files and have been CR-rejected')
-                print('NIMSET: %d  NCOMBINE: %d' % (nimset, ncombine))
-                sys.exit(3)
-
-            #Otherwise, add image to running sum
-            if (iteration == 0):
-                sum_arr = hdu[1].data
-                err_arr = (hdu[2].data) ** 2
-                dq_arr = hdu[3].data
-                totalweight = ncombine
-                totaltime = hdr0['texptime']
-            else:
-                sum_arr += hdu[1].data
-                err_arr += (hdu[2].data) ** 2
-                dq_arr |= hdu[3].data
-                totalweight += ncombine
-                totaltime += hdr0['texptime']
-
-    # Then divide by the sum of the weighting factors.
-    mean_arr = sum_arr / float(totalweight)
-    mean_err_arr = np.sqrt(err_arr / (totalweight ** 2))
-    #Update exptime and number of orbits
-
-    hdr0['texptime'] = totaltime
-    hdr1['ncombine'] = totalweight
-    hdr1['exptime'] = totaltime
-
-    out_hdu0 = fits.PrimaryHDU(header=hdr0)
-    out_hdu1 = fits.ImageHDU(mean_arr, header=hdr1)
-    out_hdu2 = fits.ImageHDU(mean_err_arr, header=hdu[2].header)
-    out_hdu3 = fits.ImageHDU(dq_arr, header=hdu[3].header)
-
-    hdulist = fits.HDUList([out_hdu0, out_hdu1, out_hdu2, out_hdu3])
     hdulist.writeto(mean_file, output_verify='exception')
 
     return mean_file, totalweight
 
 #-------------------------------------------------------------------------------
 
+def check_crj_inputs(bias_list):
+    """Make sure every input is a single, cosmic-ray rejected imset
+
+    Only the headers are read, through the header index, so every input
+    is checked before any of the data is.
+
+    Parameters
+    ----------
+    bias_list : list
+        list of the input biases
+
+    """
+
+    if not len(bias_list):
+        raise ValueError('Bias list is empty')
+
+    header_index.populate(bias_list)
+
+    bad = []
+    for item in bias_list:
+        nimset = header_index.getval(item, 'NEXTEND', 0) // 3
+        ncombine = header_index.getval(item, 'NCOMBINE', 1)
+        if (nimset > 1) or (ncombine <= 1):
+            bad.append('{}  NIMSET: {}  NCOMBINE: {}'.format(item, nimset, ncombine))
+
+    if bad:
+        raise ValueError('Input files have to be single imset files and have been '
+                         'CR-rejected:\n    {}'.format('\n    '.join(bad)))
+
+#-------------------------------------------------------------------------------
+
+def check_raw_inputs(input_list):
+    """Make sure the raw biases can be combined, before calibrating any
+
+    Inputs with a single imset which isn't CR-rejected can't be
+    calibrated, and are left out with a notice as `calibrate` does.  All
+    others must share the same CCDGAIN, binning and image shape.  Only the
+    headers are read, through the header index, and every mismatch is
+    reported at once.
+
+    Parameters
+    ----------
+    input_list : list
+        list of the input raw biases
+
+    Returns
+    -------
+    input_list : list
+        the inputs which can be calibrated, in the same order
+
+    """
+
+    if not len(input_list):
+        raise ValueError('Bias list is empty')
+
+    header_index.populate(input_list)
+
+    def mode(item):
+        return (header_index.getval(item, 'CCDGAIN', 0),
+                header_index.getval(item, 'BINAXIS1', 0),
+                header_index.getval(item, 'BINAXIS2', 0),
+                header_index.getval(item, 'NAXIS1', 1),
+                header_index.getval(item, 'NAXIS2', 1))
+
+    kept = []
+    for item in input_list:
+        nimset = header_index.getval(item, 'NEXTEND', 0) // 3
+        if nimset <= 1 and header_index.getval(item, 'CRCORR', 0) != 'COMPLETE':
+            print("Sorry, {} seems to have only 1 imset, but it isn't cr-rejected.".format(item))
+            print("This task can only handle 'raw' or 'flt images with the NEXTEND keyword equal to 3*N (N > 1).")
+            print("Skipping it.")
+            continue
+        kept.append(item)
+
+    if not kept:
+        raise ValueError('No bias in the list can be calibrated')
+
+    expected = mode(kept[0])
+    bad = []
+    for item in kept:
+        if mode(item) != expected:
+            bad.append('{}  CCDGAIN, BINAXIS1, BINAXIS2, shape: {}, not {}'.format(
+                item, mode(item), expected))
+
+    if bad:
+        raise ValueError('Input biases can not be combined:\n    {}'.format('\n    '.join(bad)))
+
+    return kept
+
+#-------------------------------------------------------------------------------
+
+class BiasAccumulator(object):
+    """Running sum of cosmic-ray rejected biases
+
+    Each file is read once and added into float64 buffers for SCI and
+    ERR**2, with the DQ arrays OR'd together, so files can be added one at
+    a time as they become available.  `result` gives the average weighted
+    by the NCOMBINE of each file.
+
+    """
+
+    def __init__(self):
+        self.sci = None
+        self.err2 = None
+        self.dq = None
+        self.totalweight = 0
+        self.totaltime = 0
+        self.headers = None
+        self._scratch = None
+        self._sci_dtype = None
+
+    def add(self, filename):
+        """Add a single-imset, cosmic-ray rejected file to the sum"""
+
+        with fits.open(filename) as hdu:
+            nimset = hdu[0].header['nextend'] // 3
+            ncombine = hdu[1].header['ncombine']
+            if (nimset > 1) or (ncombine <= 1):
+                raise ValueError('{} has to be a single imset file and have been '
+                                 'CR-rejected. NIMSET: {}  NCOMBINE: {}'.format(filename,
+                                                                                nimset,
+                                                                                ncombine))
+
+            sci = hdu[1].data
+            if self.sci is None:
+                self.sci = np.zeros(sci.shape, dtype=np.float64)
+                self.err2 = np.zeros(sci.shape, dtype=np.float64)
+                self._scratch = np.empty(sci.shape, dtype=np.float64)
+                self.dq = np.zeros(sci.shape, dtype=hdu[3].data.dtype.newbyteorder('='))
+                self._sci_dtype = sci.dtype.newbyteorder('=')
+            elif sci.shape != self.sci.shape:
+                raise ValueError('{} has shape {}, not {}'.format(filename, sci.shape,
+                                                                   self.sci.shape))
+
+            np.add(self.sci, sci, out=self.sci)
+
+            np.copyto(self._scratch, hdu[2].data)
+            np.square(self._scratch, out=self._scratch)
+            np.add(self.err2, self._scratch, out=self.err2)
+
+            np.bitwise_or(self.dq, hdu[3].data, out=self.dq, casting='unsafe')
+
+            self.totalweight += ncombine
+            self.totaltime += hdu[0].header['texptime']
+            self.headers = [ext.header.copy() for ext in hdu[:4]]
+
+    def result(self):
+        """Return the averaged file
+
+        Returns
+        -------
+        hdulist : astropy.io.fits.HDUList
+            averaged SCI, ERR and DQ with the headers of the last input
+        totalweight : float
+            sum of the NCOMBINE header keywords from the data
+
+        """
+
+        if self.sci is None:
+            raise ValueError('No biases have been added')
+
+        # Then divide by the sum of the weighting factors.
+        mean_arr = (self.sci / float(self.totalweight)).astype(self._sci_dtype)
+        mean_err_arr = np.sqrt(self.err2 / (self.totalweight ** 2)).astype(self._sci_dtype)
+
+        hdr0, hdr1, hdr2, hdr3 = self.headers
+        #Update exptime and number of orbits
+        hdr0['texptime'] = self.totaltime
+        hdr1['ncombine'] = self.totalweight
+        hdr1['exptime'] = self.totaltime
+
+        hdulist = fits.HDUList([fits.PrimaryHDU(header=hdr0),
+                                fits.ImageHDU(mean_arr, header=hdr1),
+                                fits.ImageHDU(mean_err_arr, header=hdr2),
+                                fits.ImageHDU(self.dq.copy(), header=hdr3)])
+
+        return hdulist, self.totalweight
+
+#-------------------------------------------------------------------------------
+
+def average_bias_arrays(bias_list):
+    """Create a weighted sum of the individual input files in memory.
+
+    Parameters
+    ----------
+    bias_list : list
+        list of the input biases
+
+    Returns
+    -------
+    hdulist : astropy.io.fits.HDUList
+        averaged SCI, ERR and DQ with the headers of the inputs
+    totalweight : float
+        sum of the NCOMBINE header keywords from the data
+
+    """
+
+    check_crj_inputs(bias_list)
+
+    accumulator = BiasAccumulator()
+    for item in bias_list:
+        accumulator.add(item)
+
+    return accumulator.result()
+
+#-------------------------------------------------------------------------------
+
 def calibrate(input_file):
     """ calibrate input file
 
     """
 
+    import stistools
+
     if not 'oref' in os.environ:
         os.environ['oref'] = '/grp/hst/cdbs/oref/'
 
@@ -144,70 +311,172 @@ def calibrate(input_file):
             hdu[0].header['APER_FOV'] = '50x50'
 
             if (blevcorr != 'COMPLETE'):
-                #print('Performing BLEVCORR')
                 hdu[0].header['BLEVCORR'] = 'PERFORM'
-                stistools.basic2d.basic2d(input=input_file,
-                                          output=output_blev,
-                                          outblev='',
-                                          dqicorr='perform',
-                                          atodcorr='omit',
-                                          blevcorr='perform',
-                                          doppcorr='omit',
-                                          lorscorr='omit',
-                                          glincorr='omit',
-                                          lflgcorr='omit',
-                                          biascorr='omit',
-                                          darkcorr='omit',
-                                          flatcorr='omit',
-                                          shadcorr='omit',
-                                          photcorr='omit',
-                                          statflag=False,
-                                          verbose=False,
-                                          trailer="/dev/null")
-            else:
-                #print('Blevcorr alread Performed')
-                shutil.copy(input_file, output_blev)
-
-            #print('Performing OCRREJECT')
-            stistools.ocrreject.ocrreject(input=output_blev,
-                                          output=output_crj,
-                                          verbose=False,
-                                          trailer="/dev/null")
+
+            #-- write the edits out now, so the calibration (and the cache
+            #-- key) sees the same header every time
+            hdu.flush()
+            header_index.invalidate(input_file)
+
+            switches = dict(dqicorr='perform',
+                            atodcorr='omit',
+                            blevcorr='perform',
+                            doppcorr='omit',
+                            lorscorr='omit',
+                            glincorr='omit',
+                            lflgcorr='omit',
+                            biascorr='omit',
+                            darkcorr='omit',
+                            flatcorr='omit',
+                            shadcorr='omit',
+                            photcorr='omit')
+            key = calcache.make_key('calibrate', [input_file],
+                                    calcache.reference_tables(input_file, 'calibrate'), switches)
+            if not calcache.fetch(key, 'calibrate', {'crj': output_crj}):
+                if (blevcorr != 'COMPLETE'):
+                    #print('Performing BLEVCORR')
+                    with trace.span('basic2d', category='calstis', file=input_file):
+                        stistools.basic2d.basic2d(input=input_file,
+                                                  output=output_blev,
+                                                  outblev='',
+                                                  statflag=False,
+                                                  verbose=False,
+                                                  trailer="/dev/null",
+                                                  **switches)
+                else:
+                    #print('Blevcorr alread Performed')
+                    shutil.copy(input_file, output_blev)
+
+                #print('Performing OCRREJECT')
+                with trace.span('ocrreject', category='calstis', file=output_blev):
+                    stistools.ocrreject.ocrreject(input=output_blev,
+                                                  output=output_crj,
+                                                  verbose=False,
+                                                  trailer="/dev/null")
+
+                calcache.store(key, 'calibrate', {'crj': output_crj})
 
         elif (crcorr == "COMPLETE"):
             print("CR rejection already done")
             os.rename(input_file, output_crj)
 
-    fits.setval(output_crj, 'FILENAME', value=os.path.split(output_crj)[-1])
+    with functions.header_edits(output_crj) as header:
+        header['FILENAME'] = os.path.split(output_crj)[-1]
 
-    os.remove(output_blev)
+    functions.RemoveIfThere(output_blev)
 
     return output_crj
 
 #-------------------------------------------------------------------------------
 
+def _executor_class(pool):
+    if pool == 'thread':
+        return ThreadPoolExecutor
+    elif pool == 'process':
+        return ProcessPoolExecutor
+
+    raise ValueError('pool must be "thread" or "process", not {}'.format(pool))
+
+#-------------------------------------------------------------------------------
+
+def calibrate_many(input_list, workers=None, pool='thread'):
+    """ Calibrate many input files at once
+
+    Each file is run through `calibrate` from a pool of workers.  The
+    outputs are named after their own input, so the runs don't interfere
+    with each other.
+
+    Parameters
+    ----------
+    input_list : list
+        list of input bias files
+    workers : int, optional
+        number of files calibrated at a time, defaults to the number of CPUs
+    pool : str, optional
+        'thread' or 'process'.  Threads are enough as the work is done by
+        the calstis executables.
+
+    Returns
+    -------
+    crj_list : list
+        output of `calibrate` for each input, in the same order
+
+    """
+
+    executor_class = _executor_class(pool)
+
+    if not len(input_list):
+        return []
+
+    workers = min(workers or os.cpu_count() or 1, len(input_list))
+    if workers <= 1:
+        return [calibrate(item) for item in input_list]
+
+    with executor_class(max_workers=workers) as executor:
+        return list(executor.map(calibrate, input_list))
+
+#-------------------------------------------------------------------------------
+
+def iter_calibrated(input_list, workers=None, pool='thread'):
+    """ Calibrate many input files, yielding each output once it is done
+
+    Same as `calibrate_many`, but each output is given as soon as it and
+    those of the inputs before it are done, so they can be used while the
+    rest are still running.  They come in the order of the inputs, so
+    anything built from them is the same from run to run.
+
+    Yields
+    ------
+    crj_file : str or None
+        output of `calibrate`
+
+    """
+
+    executor_class = _executor_class(pool)
+
+    if not len(input_list):
+        return
+
+    workers = min(workers or os.cpu_count() or 1, len(input_list))
+    if workers <= 1:
+        for item in input_list:
+            yield calibrate(item)
+        return
+
+    with executor_class(max_workers=workers) as executor:
+        futures = [executor.submit(calibrate, item) for item in input_list]
+        for future in futures:
+            yield future.result()
+
+#-------------------------------------------------------------------------------
+
 def replace_hot_cols(mean_bias, median_image, residual_image, yfrac=1):
     """ Replace hot columns in the mean_bias as identified from the
     residual image with values from the bias_median
 
     'hot' is 3* sigma
 
-    mean_bias will be updated in place
+    yfrac can be a list of fractions of the rows to average the columns
+    over, in which case the columns hot for any of them are replaced, all
+    found in a single pass over the residual image.
+
+    mean_bias will be updated in place, and can be either the name of the
+    file or its science array
 
     """
 
     print('Replacing hot column')
-    residual_columns_2d = functions.make_resicols_image(residual_image,
-                                                        yfrac=yfrac)
+    yfracs = np.atleast_1d(yfrac)
+    hot = np.zeros(residual_image.shape[1], dtype=bool)
+    for residual_columns in functions.column_means(residual_image, yfracs):
+        hot |= functions.hot_columns(residual_columns, nsigma=3.0, maxiters=40)
 
-    resi_cols_mean, resi_cols_median, resi_cols_std = sigma_clipped_stats(residual_columns_2d[0], sigma=3, maxiters=40)
-
-    print('thresh mean,sigma = {} {}'.format(resi_cols_mean, resi_cols_std))
-    replval = resi_cols_mean + 3.0 * resi_cols_std
-    index = np.where(residual_columns_2d >= replval)
+    if isinstance(mean_bias, np.ndarray):
+        mean_bias[:, hot] = median_image[:, hot]
+        return
 
     with fits.open(mean_bias, mode='update') as hdu:
-        hdu[('sci', 1)].data[index] = median_image[index]
+        hdu[('sci', 1)].data[:, hot] = median_image[:, hot]
 
 #-------------------------------------------------------------------------------
 
@@ -223,15 +492,18 @@ def replace_hot_pix(mean_bias, median_image):
 
     Parameters
     ----------
-    mean_bias : str
-        name of the mean bias bias
+    mean_bias : str or np.ndarray
+        name of the mean bias bias, or its science array
     median_image : np.ndarray
         2d median image of the bias
 
     """
 
     print('Replacing hot pixels')
-    residual_image = fits.getdata(mean_bias, ext=('sci', 1)) - median_image
+    if isinstance(mean_bias, np.ndarray):
+        residual_image = mean_bias - median_image
+    else:
+        residual_image = fits.getdata(mean_bias, ext=('sci', 1)) - median_image
     resi_mean, resi_median, resi_std = sigma_clipped_stats(residual_image,
                                                            sigma=5,
                                                            maxiters=40)
@@ -240,12 +512,17 @@ def replace_hot_pix(mean_bias, median_image):
     print("  hot is > {}".format(fivesig))
     index = np.where(residual_image >= fivesig)
 
+    if isinstance(mean_bias, np.ndarray):
+        mean_bias[index] = median_image[index]
+        return
+
     with fits.open(mean_bias, mode='update') as hdu:
         hdu[('sci', 1)].data[index] = median_image[index]
 
 #-------------------------------------------------------------------------------
 
-def make_basebias(input_list, refbias_name='basebias.fits'):
+@trace.traced
+def make_basebias(input_list, refbias_name='basebias.fits', workers=None, pool='thread'):
     """ Make the basebias for an anneal month
 
 
@@ -254,12 +531,23 @@ def make_basebias(input_list, refbias_name='basebias.fits'):
     3- Replace pixels and colums with median values
     4- Set header keywords
 
+    The headers of all inputs are checked before any is calibrated, and
+    single imsets which aren't CR-rejected are left out (see
+    `check_raw_inputs`).  Each bias is added to the average as soon as it,
+    and those before it in the list, have been calibrated, so the result
+    doesn't depend on which calibration finishes first.  Steps 2-4 are
+    done in memory, and the reference file is written once.
+
     Parameters
     ----------
     input_list : list
         list of input bias files.
     refbias_name : str
         name of the output reference file.
+    workers : int, optional
+        number of files calibrated at a time, defaults to the number of CPUs
+    pool : str, optional
+        'thread' or 'process', see `calibrate_many`
 
     """
 
@@ -268,29 +556,32 @@ def make_basebias(input_list, refbias_name='basebias.fits'):
     print('#-------------------------------#')
     print('Output to %s' % refbias_name)
 
+    print('Checking input headers')
+    input_list = check_raw_inputs(input_list)
+
     print('Processing individual files')
-    crj_list = [calibrate(item) for item in input_list]
-    crj_list = [item for item in crj_list if item != None]
+    accumulator = BiasAccumulator()
+    crj_list = []
+    for item in iter_calibrated(input_list, workers, pool):
+        accumulator.add(item)
+        crj_list.append(item)
 
-    mean_bias, totalweight = average_biases(crj_list)
+    mean_hdu, totalweight = accumulator.result()
+    mean_sci = mean_hdu[1].data
 
     print('Replacing hot columns and pixels by median-smoothed values')
-    residual_image, median_image = functions.make_residual(mean_bias)
-
-    replace_hot_cols(mean_bias, median_image, residual_image)
-    #-- then again, but only using the lower 20% of rows
-    replace_hot_cols(mean_bias, median_image, residual_image, yfrac=.2)
+    residual_image, median_image = functions.make_residual(mean_sci)
 
-    replace_hot_pix(mean_bias, median_image)
+    #-- columns hot over all rows, or only over the lower 20% of rows
+    replace_hot_cols(mean_sci, median_image, residual_image, yfrac=(1, .2))
 
-    shutil.copy(mean_bias, refbias_name)
+    replace_hot_pix(mean_sci, median_image)
 
-    functions.update_header_from_input(refbias_name, input_list)
-    fits.setval(refbias_name, 'NCOMBINE', value=totalweight, ext=1)
-    fits.setval(refbias_name, 'TASKNAME', ext=0, value='BASEJOIN')
+    functions.write_reference_file(refbias_name, input_list, mean_sci,
+                                   mean_hdu[2].data, mean_hdu[3].data,
+                                   taskname='BASEJOIN', ncombine=totalweight)
 
     print('Cleaning up...')
-    functions.RemoveIfThere(mean_bias)
     for item in crj_list:
         functions.RemoveIfThere(item)
 
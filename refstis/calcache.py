@@ -0,0 +1,340 @@
+"""Content-addressed cache of calibration outputs.
+
+Re-running a month runs basic2d, ocrreject and calstis again on inputs
+that usually haven't changed.  When the cache is enabled, the output of
+each of those steps is stored under a key made from:
+
+* the name of the step and the switches it was run with
+* the bytes of every input file, after refstis has edited its header
+* the bytes of the reference files given explicitly (the bias file)
+* the bytes of the reference tables the step reads through the header
+  of the input (``REFERENCE_TABLES``), see `reference_tables`
+* the version of stistools
+
+and a later run with the same key copies the stored output into place
+instead of running the step.  The tables are named as ``oref$...`` in the
+header, so a table replaced in ``$oref`` under the same name would not
+change the input bytes.
+
+The cache is enabled by setting the ``REFSTIS_CALCACHE_DIR`` environment
+variable to a directory.  Once the outputs held there are larger than
+``REFSTIS_CALCACHE_BYTES`` (default ``DEFAULT_MAX_BYTES``) the least
+recently used entries are removed.  Every lookup is logged in the cache
+directory, and `report` summarizes the hits and misses of each step.
+
+"""
+
+import hashlib
+import os
+import shutil
+import time
+import uuid
+
+from . import header_index
+
+DEFAULT_MAX_BYTES = 20 * 2**30
+
+#-- reference tables read by each step through the input header
+_BASIC2D_TABLES = ('BPIXTAB', 'CCDTAB', 'OSCNTAB')
+_CRREJECT_TABLES = _BASIC2D_TABLES + ('CRREJTAB',)
+REFERENCE_TABLES = {'basic2d': _BASIC2D_TABLES,
+                    'crreject': _CRREJECT_TABLES,
+                    'calibrate': _CRREJECT_TABLES,
+                    #-- full calstis reads whichever its switches turn on
+                    'calstis': _CRREJECT_TABLES + ('ATODTAB', 'BIASFILE', 'DARKFILE',
+                                                   'PFLTFILE', 'DFLTFILE', 'LFLTFILE',
+                                                   'SHADFILE', 'APDESTAB', 'APERTAB',
+                                                   'PHOTTAB', 'IMPHTTAB', 'TDSTAB',
+                                                   'WCPTAB')}
+
+EVENT_LOG = 'events.log'
+
+#-- file digests already computed by this process: path -> (stat key, digest)
+_digests = {}
+
+#-------------------------------------------------------------------------------
+
+def cache_dir():
+    """Return the cache directory, or None if the cache is disabled"""
+
+    return os.environ.get('REFSTIS_CALCACHE_DIR') or None
+
+#-------------------------------------------------------------------------------
+
+def max_bytes():
+    """Return the size the cache is trimmed to"""
+
+    return int(os.environ.get('REFSTIS_CALCACHE_BYTES', DEFAULT_MAX_BYTES))
+
+#-------------------------------------------------------------------------------
+
+def file_digest(filename):
+    """sha256 of the contents of a file
+
+    Digests are remembered by path and `refstis.header_index.stat_key`,
+    so an unchanged file is only read once per process.
+
+    """
+
+    path = os.path.abspath(filename)
+    stat_key = header_index.stat_key(path)
+    found = _digests.get(path)
+    if found and found[0] == stat_key:
+        return found[1]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+
+    _digests[path] = (stat_key, digest.hexdigest())
+    return digest.hexdigest()
+
+#-------------------------------------------------------------------------------
+
+def reference_tables(filename, step):
+    """Reference tables a step reads through the primary header of an input
+
+    ``oref$`` names are resolved with the ``oref`` environment variable.
+    Tables which are not set, or not found, are left out.
+
+    Parameters
+    ----------
+    filename : str
+        input raw or flt file
+    step : str
+        name of the step, a key of ``REFERENCE_TABLES``
+
+    Returns
+    -------
+    tables : list
+        paths of the tables, in the order of ``REFERENCE_TABLES[step]``
+
+    """
+
+    header = header_index.getheader(filename, 0)
+    tables = []
+    for keyword in REFERENCE_TABLES[step]:
+        name = str(header.get(keyword, '')).strip()
+        if name.startswith('oref$'):
+            name = os.path.join(os.environ.get('oref', ''), name[len('oref$'):])
+        if name and name != 'N/A' and os.path.isfile(name):
+            tables.append(name)
+
+    return tables
+
+#-------------------------------------------------------------------------------
+
+def make_key(step, inputs, references=(), switches=None):
+    """Key of a calibration step, or None if the cache is disabled
+
+    Parameters
+    ----------
+    step : str
+        name of the step, e.g. 'basic2d'
+    inputs : list
+        input files of the step
+    references : list, optional
+        reference files given to the step
+    switches : dict, optional
+        calibration switches and other arguments of the step
+
+    Returns
+    -------
+    key : str or None
+        hex digest identifying the step and its inputs
+
+    """
+
+    if cache_dir() is None:
+        return None
+
+    import stistools
+
+    key = hashlib.sha256()
+    key.update('{}\n{}\n'.format(step, stistools.__version__).encode())
+    for name, value in sorted((switches or {}).items()):
+        key.update('{}={!r}\n'.format(name, value).encode())
+    for filename in inputs:
+        key.update('input {}\n'.format(file_digest(filename)).encode())
+    for filename in references:
+        key.update('reference {}\n'.format(file_digest(filename)).encode())
+
+    return key.hexdigest()
+
+#-------------------------------------------------------------------------------
+
+def _entry_dir(key):
+    return os.path.join(cache_dir(), key[:2], key)
+
+#-------------------------------------------------------------------------------
+
+def _log(step, event, key):
+    line = '{:.3f}\t{}\t{}\t{}\n'.format(time.time(), step, event, key)
+    try:
+        os.makedirs(cache_dir(), exist_ok=True)
+        with open(os.path.join(cache_dir(), EVENT_LOG), 'a') as log:
+            log.write(line)
+    except OSError:
+        pass
+
+#-------------------------------------------------------------------------------
+
+def fetch(key, step, outputs):
+    """Copy the cached outputs of a step into place
+
+    Parameters
+    ----------
+    key : str or None
+        key from `make_key`
+    step : str
+        name of the step, for the report
+    outputs : dict
+        output file for each name the outputs were stored under
+
+    Returns
+    -------
+    found : bool
+        True if every output was copied from the cache
+
+    """
+
+    if key is None:
+        return False
+
+    entry = _entry_dir(key)
+    try:
+        for name, filename in outputs.items():
+            shutil.copyfile(os.path.join(entry, name), filename)
+        os.utime(entry)
+    except OSError:
+        _log(step, 'miss', key)
+        return False
+
+    print('Using cached {} output for {}'.format(step, ', '.join(outputs.values())))
+    _log(step, 'hit', key)
+    return True
+
+#-------------------------------------------------------------------------------
+
+def store(key, step, outputs):
+    """Add the outputs of a step to the cache
+
+    Parameters
+    ----------
+    key : str or None
+        key from `make_key`
+    step : str
+        name of the step, for the report
+    outputs : dict
+        output file for each name to store it under
+
+    """
+
+    if key is None:
+        return
+
+    entry = _entry_dir(key)
+    tmp_entry = os.path.join(cache_dir(), 'tmp-{}'.format(uuid.uuid4().hex))
+    try:
+        os.makedirs(tmp_entry)
+        for name, filename in outputs.items():
+            shutil.copyfile(filename, os.path.join(tmp_entry, name))
+
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        os.rename(tmp_entry, entry)
+    except OSError:
+        #-- most likely stored at the same time by another process
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        return
+
+    _log(step, 'store', key)
+    evict()
+
+#-------------------------------------------------------------------------------
+
+def _entries():
+    """(last use, size, path) of every entry in the cache"""
+
+    entries = []
+    root = cache_dir()
+    for prefix in os.scandir(root):
+        if not prefix.is_dir() or prefix.name.startswith('tmp-'):
+            continue
+        for entry in os.scandir(prefix.path):
+            try:
+                size = sum(item.stat().st_size for item in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+            except OSError:
+                continue
+
+    return entries
+
+#-------------------------------------------------------------------------------
+
+def evict(limit=None):
+    """Remove the least recently used entries until under the size limit
+
+    Parameters
+    ----------
+    limit : int, optional
+        size in bytes to trim the cache to, defaults to `max_bytes`
+
+    """
+
+    if cache_dir() is None:
+        return
+
+    limit = max_bytes() if limit is None else limit
+    entries = sorted(_entries())
+    total = sum(size for last_used, size, path in entries)
+
+    for last_used, size, path in entries:
+        if total <= limit:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+#-------------------------------------------------------------------------------
+
+def report(since=None):
+    """Summary of cache hits and misses
+
+    Parameters
+    ----------
+    since : float, optional
+        only count lookups after this time (seconds since the epoch)
+
+    Returns
+    -------
+    summary : str
+        hits and misses of each step, or '' if the cache is disabled
+
+    """
+
+    if cache_dir() is None:
+        return ''
+
+    counts = {}
+    try:
+        with open(os.path.join(cache_dir(), EVENT_LOG)) as log:
+            for line in log:
+                try:
+                    when, step, event, key = line.split()
+                except ValueError:
+                    continue
+                if since is not None and float(when) < since:
+                    continue
+                counts.setdefault(step, {'hit': 0, 'miss': 0, 'store': 0})[event] += 1
+    except IOError:
+        pass
+
+    lines = ['Calibration cache {}:'.format(cache_dir())]
+    for step, count in sorted(counts.items()):
+        lines.append('  {:10s} {:5d} hits {:5d} misses'.format(step, count['hit'], count['miss']))
+    if not counts:
+        lines.append('  no lookups')
+
+    return '\n'.join(lines)
+
+#-------------------------------------------------------------------------------
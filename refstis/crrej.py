@@ -0,0 +1,404 @@
+"""In-memory cosmic-ray rejection of a stack of STIS CCD imsets.
+
+This is a pure numpy counterpart to the calstis path used by the bias
+builders (msjoin --> basic2d --> ocrreject --> divide by NCOMBINE).  All
+imsets of the input files are read into a 3D stack, overscan subtracted
+and trimmed if that hasn't been done already, and combined with the same
+iterative scheme ocrreject uses:
+
+#. an initial guess for each pixel is taken as the median of the stack
+#. each iteration rejects values more than N sigma from the current
+   guess, with the noise computed from the guess, the readnoise and gain
+#. the guess is replaced by the mean of the remaining values and the
+   next, lower, threshold is used (5, 4 and then 3 sigma by default)
+
+The result is the cosmic-ray rejected *average* of the stack, which is
+what the calstis path produces after dividing the ocrreject sum by
+NCOMBINE.  Sky subtraction and exposure time scaling done by ocrreject
+are not performed, as all imsets of a bias (or dark) week share an
+exposure time and have no sky.
+
+"""
+
+from astropy.io import fits
+import numpy as np
+from scipy.ndimage import binary_dilation
+
+from . import header_index
+
+#-- DQ bits not used in the combination, and set when no value survives
+BADINPDQ = 4 | 8 | 16 | 32 | 128 | 256 | 512
+CR_REJECTED = 8192
+
+#-- used when READNSE isn't present in the input headers (electrons)
+DEFAULT_READNOISE = 5.0
+
+#-------------------------------------------------------------------------------
+
+def subtract_overscan(sci, sci_header, binaxis1=1, binaxis2=1):
+    """Subtract the bias level from the serial overscan and trim the image
+
+    The bias level of each row is the median of the leading serial
+    overscan, and a straight line fit to those levels along the rows is
+    subtracted from the science region.
+
+    Parameters
+    ----------
+    sci : np.ndarray
+        raw science array(s), the last two axes are rows and columns
+    sci_header : astropy.io.fits.Header
+        header of the SCI extension, used for LTV1/LTV2
+    binaxis1, binaxis2 : int
+        on-chip binning
+
+    Returns
+    -------
+    trimmed : np.ndarray
+        overscan subtracted science region as float32
+
+    """
+
+    x0 = int(round(sci_header.get('LTV1', 19)))
+    y0 = int(round(sci_header.get('LTV2', 0)))
+    nx = 1024 // binaxis1
+    ny = 1024 // binaxis2
+
+    #-- leave out the first and last overscan columns, which see bleeding
+    overscan = sci[..., y0:y0 + ny, 1:max(x0 - 1, 2)].astype(np.float64)
+    level = np.median(overscan, axis=-1)
+
+    rows = np.arange(ny)
+    flat_level = level.reshape(-1, ny).T
+    slope, intercept = np.polyfit(rows, flat_level, 1)
+    fit = (slope[:, np.newaxis] * rows + intercept[:, np.newaxis]).reshape(level.shape)
+
+    trimmed = sci[..., y0:y0 + ny, x0:x0 + nx].astype(np.float32)
+    trimmed -= fit[..., np.newaxis].astype(np.float32)
+
+    return trimmed
+
+#-------------------------------------------------------------------------------
+
+def read_imsets(file_list):
+    """Read every imset of the input files into SCI, ERR and DQ stacks
+
+    Imsets without BLEVCORR=COMPLETE are overscan subtracted and trimmed.
+    Empty ERR arrays are filled from the noise model.
+
+    Parameters
+    ----------
+    file_list : list
+        input raw or flt files
+
+    Returns
+    -------
+    sci, err, dq : np.ndarray
+        (nimsets, ny, nx) stacks
+    primary_header, sci_header : astropy.io.fits.Header
+        headers of the first input file
+    readnoise, gain : float
+        readnoise (electrons) and gain used for the noise model
+
+    """
+
+    n_imsets, primary_header, sci_header, readnoise, gain = imset_info(file_list)
+
+    sci = err = dq = None
+    for i, (image, image_err, image_dq) in enumerate(iter_imsets(file_list, primary_header,
+                                                                 readnoise, gain)):
+        if sci is None:
+            sci = np.empty((n_imsets,) + image.shape, dtype=np.float32)
+            err = np.empty_like(sci)
+            dq = np.zeros(sci.shape, dtype=np.uint16)
+        sci[i] = image
+        err[i] = image_err
+        if image_dq is not None:
+            dq[i] = image_dq
+
+    return sci, err, dq, primary_header, sci_header, readnoise, gain
+
+#-------------------------------------------------------------------------------
+
+def imset_info(file_list):
+    """Number of imsets, headers and noise model of the input files
+
+    Returns
+    -------
+    n_imsets : int
+        total number of imsets
+    primary_header, sci_header : astropy.io.fits.Header
+        headers of the first input file
+    readnoise, gain : float
+        readnoise (electrons) and gain used for the noise model
+
+    """
+
+    header_index.populate(file_list)
+    n_imsets = sum(header_index.getval(item, 'NEXTEND') // 3 for item in file_list)
+
+    primary_header = header_index.getheader(file_list[0], 0).copy()
+    sci_header = header_index.getheader(file_list[0], 1).copy()
+    gain = float(primary_header.get('ATODGAIN') or primary_header['CCDGAIN'])
+    readnoise = float(primary_header.get('READNSE') or DEFAULT_READNOISE)
+
+    return n_imsets, primary_header, sci_header, readnoise, gain
+
+#-------------------------------------------------------------------------------
+
+def iter_imsets(file_list, primary_header, readnoise, gain):
+    """Read the imsets of the input files one at a time
+
+    Imsets are prepared as in `read_imsets`, only one input file is open
+    at a time.
+
+    Parameters
+    ----------
+    file_list : list
+        input raw or flt files
+    primary_header : astropy.io.fits.Header
+        primary header of the first input, giving the binning
+    readnoise, gain : float
+        noise model used for empty ERR arrays
+
+    Yields
+    ------
+    sci, err : np.ndarray
+        science and error arrays of an imset
+    dq : np.ndarray or None
+        DQ array, None if the DQ extension is empty
+
+    """
+
+    binaxis1 = primary_header['BINAXIS1']
+    binaxis2 = primary_header['BINAXIS2']
+
+    for filename in file_list:
+        with fits.open(filename) as hdu:
+            blev_done = hdu[0].header.get('BLEVCORR', 'OMIT') == 'COMPLETE'
+            for ext in range(1, hdu[0].header['NEXTEND'], 3):
+                image = hdu[ext].data
+                if not blev_done:
+                    image = subtract_overscan(image, hdu[ext].header, binaxis1, binaxis2)
+                image = image.astype(np.float32, copy=False)
+
+                if hdu[ext + 1].data is not None and hdu[ext + 1].data.any():
+                    err = _trim_like(hdu[ext + 1].data, image, hdu[ext].header, blev_done)
+                else:
+                    err = np.sqrt((readnoise / gain) ** 2 + np.maximum(image, 0) / gain)
+
+                dq = None
+                if hdu[ext + 2].data is not None:
+                    dq = _trim_like(hdu[ext + 2].data, image, hdu[ext].header, blev_done)
+
+                yield image, err, dq
+
+#-------------------------------------------------------------------------------
+
+def _trim_like(array, image, sci_header, blev_done):
+    """Cut an ERR or DQ array down to the trimmed science region"""
+
+    if blev_done or array.shape == image.shape:
+        return array
+
+    x0 = int(round(sci_header.get('LTV1', 19)))
+    y0 = int(round(sci_header.get('LTV2', 0)))
+    return array[y0:y0 + image.shape[0], x0:x0 + image.shape[1]]
+
+#-------------------------------------------------------------------------------
+
+def crreject_stack(sci, err, dq, sigmas=(5, 4, 3), readnoise=DEFAULT_READNOISE,
+                   gain=1.0, scalenoise=0.0, crradius=1.5, crthresh=0.8,
+                   badinpdq=BADINPDQ, chunk_rows=64):
+    """Cosmic-ray reject and average a stack of imsets
+
+    Parameters
+    ----------
+    sci, err, dq : np.ndarray
+        (nimsets, ny, nx) stacks; ERR and DQ may be None
+    sigmas : tuple
+        rejection thresholds for each iteration
+    readnoise : float
+        readnoise in electrons
+    gain : float
+        electrons per DN
+    scalenoise : float
+        multiplicative noise term, as a fraction of the signal
+    crradius : float
+        neighbours within this radius (pixels) of a rejected value are also
+        rejected when they exceed ``crthresh`` times the threshold. 0 turns
+        this off.
+    crthresh : float
+        threshold fraction used for the neighbours of rejected values
+    badinpdq : int
+        DQ bits which exclude a value from the combination
+    chunk_rows : int
+        number of rows processed at a time, to bound the temporary memory
+
+    Returns
+    -------
+    out_sci, out_err : np.ndarray
+        cosmic-ray rejected average and its error
+    out_dq : np.ndarray
+        OR of the DQ of the values used, with 8192 where none were left
+    ncombine : int
+        number of imsets combined
+
+    """
+
+    n_imsets, ny, nx = sci.shape
+    if err is None:
+        err = np.sqrt((readnoise / gain) ** 2 + np.maximum(sci, 0) / gain)
+    if dq is None:
+        dq = np.zeros(sci.shape, dtype=np.uint16)
+
+    out_sci = np.empty((ny, nx), dtype=np.float32)
+    out_err = np.empty((ny, nx), dtype=np.float32)
+    out_dq = np.empty((ny, nx), dtype=np.uint16)
+
+    halo = chunk_halo(sigmas, crradius)
+
+    for start in range(0, ny, chunk_rows):
+        stop = min(start + chunk_rows, ny)
+        lo = max(start - halo, 0)
+        hi = min(stop + halo, ny)
+
+        chunk = _reject_chunk(sci[:, lo:hi], err[:, lo:hi], dq[:, lo:hi],
+                              sigmas, readnoise, gain, scalenoise,
+                              crradius, crthresh, badinpdq)
+
+        inner = slice(start - lo, start - lo + (stop - start))
+        out_sci[start:stop] = chunk[0][inner]
+        out_err[start:stop] = chunk[1][inner]
+        out_dq[start:stop] = chunk[2][inner]
+
+    return out_sci, out_err, out_dq, n_imsets
+
+#-------------------------------------------------------------------------------
+
+def chunk_halo(sigmas=(5, 4, 3), crradius=1.5):
+    """Rows read above and below each chunk by `crreject_stack`"""
+
+    #-- rejections spread by crradius each iteration, so the halo has to
+    #-- cover every iteration for chunks to match the full-frame result
+    radius = int(np.ceil(crradius)) if crradius > 0 else 0
+    return radius * len(sigmas)
+
+#-------------------------------------------------------------------------------
+
+def _reject_chunk(sci, err, dq, sigmas, readnoise, gain, scalenoise,
+                  crradius, crthresh, badinpdq):
+    """Run the rejection iterations on a block of rows"""
+
+    sci = sci.astype(np.float64)
+    good = (dq & badinpdq) == 0
+
+    guess = np.nanmedian(np.where(good, sci, np.nan), axis=0)
+    no_good = np.isnan(guess)
+    guess[no_good] = np.median(sci, axis=0)[no_good]
+
+    if crradius > 0:
+        y, x = np.mgrid[-int(crradius):int(crradius) + 1, -int(crradius):int(crradius) + 1]
+        footprint = ((x ** 2 + y ** 2) <= crradius ** 2)[np.newaxis]
+
+    rn2 = (readnoise / gain) ** 2
+    accept = good
+    for sigma in sigmas:
+        variance = rn2 + np.maximum(guess, 0) / gain + (scalenoise * guess) ** 2
+        resid2 = (sci - guess) ** 2
+
+        accept = good & (resid2 <= sigma ** 2 * variance)
+        if crradius > 0:
+            near_cr = binary_dilation(good & ~accept, structure=footprint)
+            accept &= ~(near_cr & (resid2 > (crthresh * sigma) ** 2 * variance))
+
+        n_good = accept.sum(axis=0)
+        total = np.where(accept, sci, 0).sum(axis=0)
+        guess = np.where(n_good > 0, total / np.maximum(n_good, 1), guess)
+
+    n_good = accept.sum(axis=0)
+    var_sum = np.where(accept, err.astype(np.float64) ** 2, 0).sum(axis=0)
+    out_err = np.sqrt(var_sum) / np.maximum(n_good, 1)
+    out_dq = np.bitwise_or.reduce(np.where(accept, dq, 0), axis=0).astype(np.uint16)
+    out_dq[n_good == 0] |= CR_REJECTED
+
+    return guess, out_err, out_dq
+
+#-------------------------------------------------------------------------------
+
+def combine_files(file_list, output_name=None, **kwargs):
+    """Cosmic-ray reject all imsets of the input files into a single imset
+
+    The output holds the rejected average in the same layout as the
+    ``_crj_div`` file from `refstis.functions.crreject`, so the
+    downstream steps of the builders can work from either.  Without an
+    output name the arrays are returned instead, and nothing is written.
+
+    Parameters
+    ----------
+    file_list : list
+        input raw or flt files
+    output_name : str, optional
+        name of the single-imset output file
+    **kwargs
+        passed on to `crreject_stack`
+
+    Returns
+    -------
+    output_name : str
+        name of the output file, or if no output name was given
+    out_sci, out_err, out_dq, ncombine
+        output of `crreject_stack`
+
+    """
+
+    sci, err, dq, primary_header, sci_header, readnoise, gain = read_imsets(file_list)
+    kwargs.setdefault('readnoise', readnoise)
+    kwargs.setdefault('gain', gain)
+
+    out_sci, out_err, out_dq, ncombine = crreject_stack(sci, err, dq, **kwargs)
+    del sci, err, dq
+
+    if output_name is None:
+        return out_sci, out_err, out_dq, ncombine
+
+    return write_combined(output_name, primary_header, sci_header,
+                          out_sci, out_err, out_dq, ncombine)
+
+#-------------------------------------------------------------------------------
+
+def write_combined(output_name, primary_header, sci_header, out_sci, out_err, out_dq, ncombine):
+    """Write the result of `crreject_stack` as a single-imset file
+
+    The headers are those of the first input, updated for the combined
+    and trimmed imset.
+
+    Returns
+    -------
+    output_name : str
+        name of the output file
+
+    """
+
+    primary_header['NEXTEND'] = 3
+    primary_header['FILENAME'] = output_name.split('/')[-1]
+    primary_header['BLEVCORR'] = 'COMPLETE'
+    primary_header['CRCORR'] = 'COMPLETE'
+
+    for key in ('BZERO', 'BSCALE'):
+        sci_header.remove(key, ignore_missing=True)
+    for key in ('LTV1', 'LTV2'):
+        if key in sci_header:
+            sci_header[key] = 0.0
+    sci_header['NCOMBINE'] = ncombine
+
+    hdu = fits.HDUList([fits.PrimaryHDU(header=primary_header),
+                        fits.ImageHDU(out_sci, header=sci_header, name='SCI'),
+                        fits.ImageHDU(out_err, name='ERR'),
+                        fits.ImageHDU(out_dq, name='DQ')])
+    for ext in hdu[1:]:
+        ext.header['EXTVER'] = 1
+    hdu.writeto(output_name, output_verify='exception', overwrite=True)
+
+    return output_name
+
+#-------------------------------------------------------------------------------
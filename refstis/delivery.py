@@ -7,9 +7,6 @@ to CDBS
 '''
 
 from astropy.io import fits as pyfits
-import matplotlib as mpl
-mpl.use('Agg')
-import matplotlib.pyplot as plt
 import numpy as np
 import os
 import glob
@@ -17,19 +14,21 @@ import shutil
 import sys
 from datetime import date
 
-from crds import certify
-import stistools
-from stistools.calstis import calstis
-
-from .functions import send_email
+from .functions import send_email, header_edits
+from . import trace
 
 #----------------------------------------------------------------
 
+@trace.traced
 def plot_obset(folder):
     '''
     Check collapsed columns and rows against last month for irregularities
     '''
 
+    import matplotlib as mpl
+    mpl.use('Agg')
+    import matplotlib.pyplot as plt
+
     plt.ioff()
 
     print('#----------#')
@@ -168,12 +167,15 @@ def set_descrip(folder):
 
 #----------------------------------------------------------------
 
+@trace.traced
 def regress(folder):
     """ Run `*drk` and `*bia` files in folder through CalSTIS to check
     for errors in processing
 
     """
 
+    from stistools.calstis import calstis
+
     start_dir = os.getcwd()
 
     print('#------------------#')
@@ -235,15 +237,14 @@ def regress(folder):
             else:
                 wavefile = ''
 
-            pyfits.setval(rawfile, 'DARKFILE', value=dark, ext=0)
-            pyfits.setval(rawfile, 'BIASFILE', value=bias, ext=0)
-            pyfits.setval(rawfile, 'IMPHTTAB', value='oref$x9r1607mo_imp.fits', ext=0)
-            if wavefile:
-                pyfits.setval(wavefile, 'DARKFILE', value=dark, ext=0)
-                pyfits.setval(wavefile, 'BIASFILE', value=bias, ext=0)
-                pyfits.setval(wavefile, 'IMPHTTAB', value='oref$x9r1607mo_imp.fits', ext=0)
+            for filename in [rawfile, wavefile] if wavefile else [rawfile]:
+                with header_edits(filename) as header:
+                    header['DARKFILE'] = dark
+                    header['BIASFILE'] = bias
+                    header['IMPHTTAB'] = 'oref$x9r1607mo_imp.fits'
 
-            status = calstis(rawfile, wavecal=wavefile)
+            with trace.span('calstis', category='calstis', file=rawfile):
+                status = calstis(rawfile, wavecal=wavefile)
 
             if status: sys.exit('Calstis Error detected for %s' % (dark[5:9]))
 
@@ -258,7 +259,8 @@ def regress(folder):
 
     print('Setting IMPHTTAB in datasets')
     for item in raws:
-        pyfits.setval(item, 'IMPHTTAB', value='oref$x9r1607mo_imp.fits', ext=0)
+        with header_edits(item) as header:
+            header['IMPHTTAB'] = 'oref$x9r1607mo_imp.fits'
 
     for bias in bias_biwk_refs:
 
@@ -270,10 +272,12 @@ def regress(folder):
 
         for rawfile in raws:
 
-            pyfits.setval(rawfile, 'BIASFILE', value=bias, ext=0)
-            pyfits.setval(rawfile, 'DARKFILE', value=darkrefs[0], ext=0)
+            with header_edits(rawfile) as header:
+                header['BIASFILE'] = bias
+                header['DARKFILE'] = darkrefs[0]
 
-            status = calstis(input=rawfile)
+            with trace.span('calstis', category='calstis', file=rawfile):
+                status = calstis(input=rawfile)
 
             if status: sys.exit('Calstis Error detected for %s' % (dark[5:9]))
 
@@ -284,6 +288,7 @@ def regress(folder):
 
 
 def send_forms(folder):
+    import stistools.calstis
 
     start_dir = os.getcwd()
     os.chdir(folder)
@@ -422,7 +427,10 @@ def move(source, destination):
 
 #----------------------------------------------------------------
 
+@trace.traced
 def run_crds_checks(folder):
+    from crds import certify
+
     datasets = ' '.join(glob.glob(os.path.join(folder, '*.fits')))
     errors = certify.CertifyScript("crds.certify {}".format(datasets))()
 
@@ -1,19 +1,29 @@
 from astropy.io import fits as pyfits
-from astropy.stats import sigma_clipped_stats
 import numpy as np
 import os
 import stat
 import shutil
-from scipy.signal import medfilt
-from scipy.ndimage.filters import median_filter
 from astropy.time import Time
 import math
 import sqlite3
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from . import calcache
+from . import header_index
+from . import trace
+from .medfilt import median_filter
+from .robust_stats import sigma_clipped_stats
+
+#-- temperature scaling of side-2 darks, following STIS TIR 2004-01
+DARK_V_TEMP = 0.07
+S2REF_TEMP = 18.0
+
+#-- Side 1 operations ended on May 16, 2001 and side 2 operations started
+#-- on July 10, 2001.  52091.0 corresponds to July 1, 2001
+SIDE2_START = 52091.0
 
-from stistools.calstis import calstis
-from stistools.ocrreject import ocrreject
-from stistools.basic2d import basic2d
 #--------------------------------------------------------------------------------
 
 def send_email(subject=None, message=None, from_addr=None, to_addr=None):
@@ -86,6 +96,90 @@ def update_header_from_input(filename, input_list):
     If a header keyword is not consistent in this step, an error will be
     raised
 
+    """
+
+    with pyfits.open(filename) as ref:
+        write_reference_file(filename, input_list,
+                             ref[1].data, ref[2].data, ref[3].data)
+
+#------------------------------------------------------------------------
+
+def reference_hdulist(filename, input_list, sci, err, dq):
+    """ Assemble a reference file from its arrays and the input data
+
+    Parameters
+    ----------
+    filename : str
+        name the reference file will be written to
+    input_list : list
+        input datasets, used to fill in the primary header
+    sci, err, dq : np.ndarray
+        arrays of the single imset
+
+    Returns
+    -------
+    hdu_out : astropy.io.fits.HDUList
+        reference file ready to be written
+
+    """
+
+    hdu_out = pyfits.HDUList(pyfits.PrimaryHDU(header=reference_primary_header(filename,
+                                                                                input_list)))
+    for extname, data in (('SCI', sci), ('ERR', err), ('DQ', dq)):
+        hdu_out.append(pyfits.ImageHDU(data=data))
+        hdu_out[-1].header['EXTNAME'] = extname
+        hdu_out[-1].header['EXTVER'] = 1
+        hdu_out[-1].header['PCOUNT'] = 0
+        hdu_out[-1].header['GROUNT'] = 1
+
+    return hdu_out
+
+#------------------------------------------------------------------------
+
+def write_reference_file(filename, input_list, sci, err, dq, taskname=None, ncombine=None):
+    """ Write a reference file from its arrays in a single pass
+
+    The primary header is assembled from the input data by
+    `reference_primary_header`.  The file is written under a temporary
+    name and then moved into place, so the reference file is never seen
+    half written.
+
+    Parameters
+    ----------
+    filename : str
+        name of the reference file
+    input_list : list
+        input datasets, used to fill in the primary header
+    sci, err, dq : np.ndarray
+        arrays of the single imset
+    taskname : str, optional
+        TASKNAME keyword of the primary header
+    ncombine : int, optional
+        NCOMBINE keyword of the SCI extension
+
+    """
+
+    hdu_out = reference_hdulist(filename, input_list, sci, err, dq)
+    if taskname:
+        hdu_out[0].header['TASKNAME'] = taskname
+    if ncombine is not None:
+        hdu_out[1].header['NCOMBINE'] = ncombine
+
+    tmp_name = '{}.{}.tmp'.format(filename, os.getpid())
+    try:
+        hdu_out.writeto(tmp_name, overwrite=True, output_verify='exception')
+        os.replace(tmp_name, filename)
+    finally:
+        RemoveIfThere(tmp_name)
+
+#------------------------------------------------------------------------
+
+def reference_primary_header(filename, input_list):
+    """ Build the primary header of a reference file from the input data
+
+    If a header keyword is not consistent in this step, an error will be
+    raised
+
     """
     targname = get_keyword(input_list, 'TARGNAME', 0)
     if targname == 'BIAS':
@@ -107,8 +201,8 @@ def update_header_from_input(filename, input_list):
 
     nimsets = count_imsets(input_list)
 
-    proposals = list(set([pyfits.getval(item, 'PROPOSID') for item in input_list]))
-    prop_titles = list(set([pyfits.getval(item, 'PROPTTL1') for item in input_list]))
+    proposals = list(set([header_index.getval(item, 'PROPOSID') for item in input_list]))
+    prop_titles = list(set([header_index.getval(item, 'PROPTTL1') for item in input_list]))
 
     data_start_pedigree, data_end_pedigree, data_start_mjd, data_end_mjd = get_start_and_endtimes(input_list)
     #anneal_weeks = divide_anneal_month(data_start_mjd, data_end_mjd, '/grp/hst/stis/calibration/anneals/', N_period)
@@ -224,34 +318,15 @@ def update_header_from_input(filename, input_list):
         hdu_out[0].header.add_history('a median-filtered (kernel = 5x5 pixels) version of')
         hdu_out[0].header.add_history('the baseline dark.')
 
-    with pyfits.open(filename) as ref:
-        hdu_out.append(pyfits.ImageHDU(data=ref[1].data))
-        hdu_out[1].header['EXTNAME'] = 'SCI'
-        hdu_out[1].header['EXTVER'] = 1
-        hdu_out[1].header['PCOUNT'] = 0
-        hdu_out[1].header['GROUNT'] = 1
-
-        hdu_out.append(pyfits.ImageHDU(data=ref[2].data))
-        hdu_out[2].header['EXTNAME'] = 'ERR'
-        hdu_out[2].header['EXTVER'] = 1
-        hdu_out[2].header['PCOUNT'] = 0
-        hdu_out[2].header['GROUNT'] = 1
-
-        hdu_out.append(pyfits.ImageHDU(data=ref[3].data))
-        hdu_out[3].header['EXTNAME'] = 'DQ'
-        hdu_out[3].header['EXTVER'] = 1
-        hdu_out[3].header['PCOUNT'] = 0
-        hdu_out[3].header['GROUNT'] = 1
-
-    hdu_out.writeto(filename, overwrite=True, output_verify='exception')
+    return hdu_out[0].header
 
 #------------------------------------------------------------------------
 
 def get_start_and_endtimes(input_list):
     times = []
     for ifile in input_list:
-        times.append(pyfits.getval(ifile, 'texpstrt', 0))
-        times.append(pyfits.getval(ifile, 'texpend', 0))
+        times.append(header_index.getval(ifile, 'texpstrt', 0))
+        times.append(header_index.getval(ifile, 'texpend', 0))
     times.sort()
     start_mjd = times[0]
     end_mjd = times[-1]
@@ -268,29 +343,103 @@ def get_start_and_endtimes(input_list):
 #------------------------------------------------------------------------
 
 def make_resicols_image(residual_image, yfrac=1):
-    print("Making residual column image")
+    """ Image with every row holding the column means of the residual image
 
-    ystart = 0
-    yend = min(1024, int(np.floor(yfrac * residual_image.shape[0] + .5)))
+    Kept for compatibility, `column_means` and `hot_columns` work on the
+    column means directly.
+
+    """
 
-    residual_columns = np.mean(residual_image[ystart:yend], axis=0)
-    print(ystart, '-->', yend)
+    print("Making residual column image")
+
+    residual_columns = column_means(residual_image, [yfrac])[0]
     residual_columns_image = residual_columns * np.ones(residual_image.shape[1])[:, np.newaxis]
 
     return residual_columns_image
 
 #------------------------------------------------------------------------
 
+def column_means(residual_image, yfracs=(1,)):
+    """ Mean of every column over the lowest rows of the image
+
+    The means for all the fractions are computed in a single pass over
+    the rows: each band of rows is summed once, and the sums accumulated
+    from the bottom of the image up.
+
+    Parameters
+    ----------
+    residual_image : np.ndarray
+        2d residual image
+    yfracs : sequence, optional
+        fractions of the rows to average, from row 0 and at most 1024 rows
+
+    Returns
+    -------
+    means : np.ndarray
+        column means, one row for each fraction
+
+    """
+
+    yends = [min(1024, int(np.floor(yfrac * residual_image.shape[0] + .5))) for yfrac in yfracs]
+
+    means = np.empty((len(yends), residual_image.shape[1]))
+    total = np.zeros(residual_image.shape[1])
+    ystart = 0
+    for i in np.argsort(yends, kind='stable'):
+        total += residual_image[ystart:yends[i]].sum(axis=0, dtype=np.float64)
+        ystart = yends[i]
+        print(0, '-->', yends[i])
+        means[i] = total / yends[i]
+
+    return means
+
+#------------------------------------------------------------------------
+
+def hot_columns(residual_columns, nsigma=3.0, maxiters=40):
+    """ Boolean mask of the hot columns
+
+    A column is hot if its mean residual is at least nsigma standard
+    deviations above the clipped mean of all columns.
+
+    Parameters
+    ----------
+    residual_columns : np.ndarray
+        1d column means, see `column_means`
+    nsigma : float, optional
+        threshold in standard deviations
+    maxiters : int, optional
+        iterations of the 3 sigma clipping
+
+    Returns
+    -------
+    hot : np.ndarray
+        True for every hot column
+
+    """
+
+    resi_cols_mean, resi_cols_median, resi_cols_std = sigma_clipped_stats(residual_columns,
+                                                                          sigma=3,
+                                                                          maxiters=maxiters)
+    print('thresh mean,sigma = {} {}'.format(resi_cols_mean, resi_cols_std))
+
+    return residual_columns >= resi_cols_mean + nsigma * resi_cols_std
+
+#------------------------------------------------------------------------
+
 def make_residual(mean_bias, kern=(3, 15)):
     """Create residual image
 
     Median filter the median with a 15 x 3 box and subtract from the mean
     to produce the residual image.
 
+    mean_bias can be the name of the file or its science array.
 
     """
-    mean_hdu = pyfits.open(mean_bias)
-    mean_image = mean_hdu[('sci', 1)].data
+    if isinstance(mean_bias, np.ndarray):
+        mean_image = mean_bias
+    else:
+        with pyfits.open(mean_bias) as mean_hdu:
+            mean_image = mean_hdu[('sci', 1)].data.copy()
 
     median_image = median_filter(mean_image, kern)
 
@@ -323,31 +472,137 @@ def normalize_crj(filename):
 
 #------------------------------------------------------------------------
 
-def msjoin(imset_list, out_name='joined_out.fits'):
+def normalized_imset(filename):
+    """ Read the first imset of a crj file, normalized by exptime/gain
+
+    The in-memory counterpart of `normalize_crj`, for products which are
+    assembled from the arrays rather than edited in place.
+
+    Returns
+    -------
+    sci, err, dq : np.ndarray
+        arrays of the first imset, the file is left untouched
+
+    """
+
+    with pyfits.open(filename) as hdu:
+        exptime = hdu[0].header['TEXPTIME']
+        gain = hdu[0].header['ATODGAIN']
+
+        norm_factor = float(exptime)/gain
+        print('Normalizing by ', norm_factor)
+        sci = hdu[('sci', 1)].data / norm_factor
+        err = hdu[('err', 1)].data / abs(norm_factor)
+        dq = np.array(hdu[('dq', 1)].data)
+
+    return sci, err, dq
+
+#------------------------------------------------------------------------
+
+def msjoin(imset_list, out_name='joined_out.fits', scale_temperature=False):
     """ Replicate msjoin functionality in pure python
 
+    The primary header is written first, with NEXTEND already set to the
+    total from all inputs, and then each extension is appended to the
+    output in turn.  Only one extension is held in memory at a time and
+    each input is closed before the next is opened.
+
+    With scale_temperature, side-2 darks which haven't been temperature
+    corrected are scaled as they are joined, as `apply_dark_correction`
+    would, and the inputs are left as they are.
+
     """
 
-    hdu = pyfits.open( imset_list[0] )
+    header_index.populate(imset_list)
+    n_extensions = [header_index.getval(dataset, 'NEXTEND') for dataset in imset_list]
+    to_scale = [scale_temperature and needs_dark_correction(dataset) for dataset in imset_list]
 
-    ext_count = 0
-    n_offset = (len( hdu[1:] ) // 3) + 1
-    for dataset in imset_list[1:]:
-        add_hdu = pyfits.open( dataset )
-        for extension in add_hdu[1:]:
-            extension.header['EXTVER'] = (ext_count // 3) + n_offset
-            hdu.append( extension )
-            ext_count += 1
+    primary = header_index.getheader(imset_list[0], 0).copy()
+    primary['NEXTEND'] = sum(n_extensions)
+    if any(to_scale) and all(scaled or 'TEMPCORR' in header_index.getheader(dataset, 0)
+                             for scaled, dataset in zip(to_scale, imset_list)):
+        primary['TEMPCORR'] = 'COMPLETE'
+    pyfits.PrimaryHDU(header=primary).writeto(out_name, output_verify='exception',
+                                              overwrite=True)
 
-    hdu[0].header['NEXTEND'] = len( hdu ) - 1
-    hdu.writeto(out_name, output_verify='exception', overwrite=True)
+    ext_count = 0
+    n_offset = (n_extensions[0] // 3) + 1
+    for i, dataset in enumerate(imset_list):
+        with pyfits.open(dataset) as add_hdu:
+            scaling = {}
+            if to_scale[i]:
+                sci_exts, factors, occdhtav = temperature_factors(add_hdu)
+                scaling = dict(zip(sci_exts, zip(factors, occdhtav)))
+
+            for ext, extension in enumerate(add_hdu[1:], 1):
+                #-- the first dataset keeps its own numbering
+                header = extension.header.copy()
+                if i:
+                    header['EXTVER'] = (ext_count // 3) + n_offset
+                    ext_count += 1
+
+                data = extension.data
+                if ext in scaling:
+                    factor, temperature = scaling[ext]
+                    print('{}, ext {}: Scaling data by '.format(dataset, ext), factor, ' for temperature: ', temperature)
+                    scale_imset(data, None, header, factor, temperature)
+                elif ext - 1 in scaling and data is not None:
+                    data *= abs(scaling[ext - 1][0])
+
+                pyfits.append(out_name, data, header, verify=False)
+                del extension.data
 
     if not os.path.exists(out_name):
         raise IOError('Error in refstis:functions:msjoin() -- output file not written!')
 
 #------------------------------------------------------------------------
 
+@contextmanager
+def header_edits(filename, ext=0):
+    """Edit the header of an extension with a single open of the file
+
+    Every ``pyfits.setval`` opens, parses and writes the file again, so a
+    run of them on the same file is best replaced by one of these::
+
+        with header_edits(filename) as header:
+            header['CRCORR'] = 'PERFORM'
+            header['APERTURE'] = '50CCD'
+
+    The edits are written when the block exits.  As long as the header
+    still fits in the FITS blocks it occupies only the header is written,
+    but a header which grows past them makes astropy rewrite the whole
+    file, which is reported.
+
+    Parameters
+    ----------
+    filename : str
+        FITS file to edit
+    ext : int or str, optional
+        extension holding the header
+
+    """
+
+    try:
+        with pyfits.open(filename, mode='update') as hdu:
+            header = hdu[ext].header
+            n_bytes = len(header.tostring())
+
+            yield header
+
+            grown = len(header.tostring()) - n_bytes
+            if grown > 0:
+                print('Header of {}[{}] grew by {} bytes, the whole file will be rewritten'.format(
+                    filename, ext, grown))
+    finally:
+        #-- also if the edit failed part way, the file may have been written
+        header_index.invalidate(filename)
+
+#------------------------------------------------------------------------
+
 def crreject(input_file, workdir=None):
+    from stistools.basic2d import basic2d
+    from stistools.ocrreject import ocrreject
+
     if not 'oref' in os.environ:
         os.environ['oref'] = '/grp/hst/cdbs/oref/'
 
@@ -371,33 +626,59 @@ def crreject(input_file, workdir=None):
         raise ValueError('nimset <=1 and CRCORR not complete')
 
     if (crcorr != "COMPLETE"):
-        if (nrptexp != nimset):
-            pyfits.setval(input_file,'NRPTEXP',value=nimset)
-            pyfits.setval(input_file,'CRSPLIT',value=1)
-
-        pyfits.setval(input_file, 'CRCORR', value='PERFORM')
-        #pyfits.setval(input_file, 'DQICORR', value='PERFORM')
-        pyfits.setval(input_file, 'APERTURE', value='50CCD')
-        pyfits.setval(input_file, 'APER_FOV', value='50x50')
-        if (blevcorr != 'COMPLETE') :
-            print('Performing BLEVCORR')
-            pyfits.setval(input_file, 'BLEVCORR', value='PERFORM')
-            status = basic2d(input_file,
-                             output_blev,
-                             outblev='',
-                             dqicorr='perform',
-                             blevcorr='perform',
-                             doppcorr='omit',
-                             lorscorr='omit',
-                             glincorr='omit',
-                             lflgcorr='omit',
-                             biascorr='omit',
-                             darkcorr='omit',
-                             flatcorr='omit',
-                             photcorr='omit',
-                             statflag=False,
-                             verbose=False,
-                             trailer=trailerfile)
+        with header_edits(input_file) as header:
+            if (nrptexp != nimset):
+                header['NRPTEXP'] = nimset
+                header['CRSPLIT'] = 1
+
+            header['CRCORR'] = 'PERFORM'
+            #header['DQICORR'] = 'PERFORM'
+            header['APERTURE'] = '50CCD'
+            header['APER_FOV'] = '50x50'
+            if (blevcorr != 'COMPLETE') :
+                header['BLEVCORR'] = 'PERFORM'
+
+        switches = dict(dqicorr='perform',
+                        blevcorr='perform',
+                        doppcorr='omit',
+                        lorscorr='omit',
+                        glincorr='omit',
+                        lflgcorr='omit',
+                        biascorr='omit',
+                        darkcorr='omit',
+                        flatcorr='omit',
+                        photcorr='omit')
+        key = calcache.make_key('crreject', [input_file],
+                                calcache.reference_tables(input_file, 'crreject'), switches)
+        if not calcache.fetch(key, 'crreject', {'crj': output_crj}):
+            if (blevcorr != 'COMPLETE') :
+                print('Performing BLEVCORR')
+                with trace.span('basic2d', category='calstis', file=input_file):
+                    status = basic2d(input_file,
+                                     output_blev,
+                                     outblev='',
+                                     statflag=False,
+                                     verbose=False,
+                                     trailer=trailerfile,
+                                     **switches)
+                if status != 0:
+                    try:
+                        print()
+                        with open(trailerfile) as tr:
+                            for line in tr.readlines():
+                                print('    {}'.format(line.strip()))
+                    finally:
+                        raise Exception('BASIC2D failed to properly reduce {}'.format(input_file))
+            else:
+                print('Blevcorr already Performed')
+                shutil.copy(input_file,output_blev)
+
+            print('Performing OCRREJECT')
+            with trace.span('ocrreject', category='calstis', file=output_blev):
+                status = ocrreject(input=output_blev,
+                                   output=output_crj,
+                                   verbose=False,
+                                   trailer=trailerfile)
             if status != 0:
                 try:
                     print()
@@ -405,30 +686,16 @@ def crreject(input_file, workdir=None):
                         for line in tr.readlines():
                             print('    {}'.format(line.strip()))
                 finally:
-                    raise Exception('BASIC2D failed to properly reduce {}'.format(input_file))
-        else:
-            print('Blevcorr already Performed')
-            shutil.copy(input_file,output_blev)
-
-        print('Performing OCRREJECT')
-        status = ocrreject(input=output_blev,
-                           output=output_crj,
-                           verbose=False,
-                           trailer=trailerfile)
-        if status != 0:
-            try:
-                print()
-                with open(trailerfile) as tr:
-                    for line in tr.readlines():
-                        print('    {}'.format(line.strip()))
-            finally:
-                raise Exception('OCRREJECT failed to properly reduce {}'.format(output_blev))
+                    raise Exception('OCRREJECT failed to properly reduce {}'.format(output_blev))
+
+            calcache.store(key, 'crreject', {'crj': output_crj})
 
     elif (crcorr == "COMPLETE"):
         print("CR rejection already done")
         os.rename(input_file, output_crj)
 
-    pyfits.setval(output_crj, 'FILENAME', value=output_crj)
+    with header_edits(output_crj) as header:
+        header['FILENAME'] = output_crj
 
     with pyfits.open(output_crj) as hdu:
         gain = hdu[0].header['atodgain']
@@ -454,13 +721,75 @@ def crreject(input_file, workdir=None):
     hdu[('err', 1)].data /= ncombine
     hdu.writeto(out_div, output_verify='exception', overwrite=True)
 
-    os.remove(output_blev)
+    RemoveIfThere(output_blev)
     os.remove(output_crj)
 
     return out_div
 
 #------------------------------------------------------------------------
 
+def crreject_imsets(input_list, output_name, method='calstis'):
+    """Combine and cosmic-ray reject all imsets of the input files
+
+    The result is a single imset holding the cosmic-ray rejected average
+    of the inputs.
+
+    Parameters
+    ----------
+    input_list : list
+        list of input raw or flt files
+    output_name : str
+        name of the combined file made by the calstis method, and removed
+        once it is read
+    method : str, optional
+        'calstis' joins the inputs with `msjoin` and runs `crreject`
+        (basic2d and ocrreject), 'numpy' uses the engine in
+        `refstis.crrej` and writes no intermediate files, or for more
+        than `refstis.imcube.MAX_IN_MEMORY_IMSETS` imsets only a scratch
+        `refstis.imcube.ImsetCube`.
+
+    Returns
+    -------
+    sci, err, dq : np.ndarray
+        arrays of the combined imset
+    ncombine : int
+        number of imsets combined
+
+    """
+
+    if method == 'calstis':
+        joined_out = output_name.replace('.fits', '_joined.fits')
+        print('Joining images to %s' % joined_out)
+        msjoin(input_list, joined_out)
+
+        print('Checking for cosmic ray rejection')
+        crj_filename = crreject(joined_out)
+        shutil.move(crj_filename, output_name)
+        RemoveIfThere(joined_out)
+
+        with pyfits.open(output_name) as hdu:
+            sci = np.array(hdu[('sci', 1)].data)
+            err = np.array(hdu[('err', 1)].data)
+            dq = np.array(hdu[('dq', 1)].data)
+            ncombine = hdu[('sci', 1)].header['NCOMBINE']
+        RemoveIfThere(output_name)
+
+        return sci, err, dq, ncombine
+    elif method == 'numpy':
+        from . import crrej, imcube
+
+        if count_imsets(input_list) > imcube.MAX_IN_MEMORY_IMSETS:
+            print('Cosmic ray rejecting {} files out of core'.format(len(input_list)))
+            return imcube.combine_files(input_list,
+                                        scratch_dir=os.path.dirname(os.path.abspath(output_name)))
+
+        print('Cosmic ray rejecting {} files in memory'.format(len(input_list)))
+        return crrej.combine_files(input_list)
+
+    raise ValueError('crreject method {} not understood'.format(method))
+
+#------------------------------------------------------------------------
+
 def count_imsets(file_list):
     """Count the total number of imsets in a file list.
 
@@ -484,7 +813,7 @@ def count_imsets(file_list):
 
     total = 0
     for item in file_list:
-        total += pyfits.getval(item,'NEXTEND',ext=0) / 3
+        total += header_index.getval(item,'NEXTEND',ext=0) / 3
 
     return total
 
@@ -498,7 +827,7 @@ def get_keyword(file_list,keyword,ext=0):
 
     """
 
-    kw_set = set([pyfits.getval(item,keyword,ext=ext) for item in file_list])
+    kw_set = set([header_index.getval(item,keyword,ext=ext) for item in file_list])
     assert len(kw_set) == 1,' multiple values found for kw: % s'% (keyword)
 
     return list(kw_set)[0]
@@ -789,8 +1118,9 @@ def bd_crreject(joinedfile):
         print('FYI: CR rejection not already done')
         print(('Keyword NRPTEXP = ' + str(nrptexp) + ' while nr. of imsets = ' + str(nimset)))
         if (nrptexp != nimset):
-            pyfits.setval( joinedfile,'NRPTEXP',value=nimset)
-            pyfits.setval( joinedfile,'CRSPLIT',value=1)
+            with header_edits(joinedfile) as header:
+                header['NRPTEXP'] = nimset
+                header['CRSPLIT'] = 1
 
             print(('>>>> Updated keyword NRPTEXP to '+str(nimset) ))
             print('    (and set keyword CRSPLIT to 1)' )
@@ -819,15 +1149,17 @@ def bd_calstis(joinedfile, thebiasfile=None):
 
     """
 
-    with pyfits.open(joinedfile, 'update') as hdu:
-        hdu[0].header['CRCORR'] = 'PERFORM'
-        hdu[0].header['APERTURE'] = '50CCD'
-        hdu[0].header['APER_FOV'] = '50x50'
-        hdu[0].header['DARKCORR'] = 'OMIT'
-        hdu[0].header['FLATCORR'] = 'OMIT'
+    from stistools.calstis import calstis
+
+    with header_edits(joinedfile) as header:
+        header['CRCORR'] = 'PERFORM'
+        header['APERTURE'] = '50CCD'
+        header['APER_FOV'] = '50x50'
+        header['DARKCORR'] = 'OMIT'
+        header['FLATCORR'] = 'OMIT'
 
         if thebiasfile:
-            hdu[0].header['BIASFILE'] = thebiasfile
+            header['BIASFILE'] = thebiasfile
 
     crj_file = joinedfile.replace('.fits', '_crj.fits')
 
@@ -843,14 +1175,21 @@ def bd_calstis(joinedfile, thebiasfile=None):
         print('Deleting old file: %s' % trailerfile)
         os.remove(trailerfile)
 
+    references = [thebiasfile] if thebiasfile and os.path.exists(thebiasfile) else []
+    references += calcache.reference_tables(joinedfile, 'calstis')
+    key = calcache.make_key('calstis', [joinedfile], references)
+    if calcache.fetch(key, 'calstis', {'crj': crj_file}):
+        return
+
     print('Running CalSTIS on %s' % joinedfile)
     print('to create: %s' % crj_file)
-    status = calstis(joinedfile,
-                     wavecal="",
-                     outroot="",
-                     savetmp=False,
-                     verbose=False,
-                     trailer=trailerfile)
+    with trace.span('calstis', category='calstis', file=joinedfile):
+        status = calstis(joinedfile,
+                         wavecal="",
+                         outroot="",
+                         savetmp=False,
+                         verbose=False,
+                         trailer=trailerfile)
     if status != 0:
         try:
             print()
@@ -860,7 +1199,9 @@ def bd_calstis(joinedfile, thebiasfile=None):
         finally:
             raise Exception('CalSTIS failed to properly reduce {}'.format(joinedfile))
 
-    pyfits.setval(crj_file, 'FILENAME', value=os.path.split(crj_file)[1])
+    with header_edits(crj_file) as header:
+        header['FILENAME'] = os.path.split(crj_file)[1]
+    calcache.store(key, 'calstis', {'crj': crj_file})
 
 #------------------------------------------------------------------------
 
@@ -937,11 +1278,61 @@ def refaver(reffiles, combined_name):
 
 #------------------------------------------------------------------------
 
+def temperature_factors(hdu):
+    """Temperature scaling factor of every imset of an open dark
+
+    The factors are computed from the OCCDHTAV keyword of every SCI
+    extension before any data is read.
+
+    Parameters
+    ----------
+    hdu : astropy.io.fits.HDUList
+        open file of one or more imsets
+
+    Returns
+    -------
+    sci_exts : np.ndarray
+        index of each SCI extension
+    factors : np.ndarray
+        factor to multiply each imset by
+    occdhtav : np.ndarray
+        housing temperature of each imset
+
+    """
+
+    sci_exts = np.arange(1, hdu[0].header['NEXTEND'], 3)
+    occdhtav = np.array([float(hdu[ext].header['OCCDHTAV']) for ext in sci_exts])
+    factors = 1.0 / (1.0 + DARK_V_TEMP * (occdhtav - S2REF_TEMP))
+
+    return sci_exts, factors, occdhtav
+
+#-------------------------------------------------------------------------------
+
+def needs_dark_correction(filename):
+    """True for side-2 darks which haven't been temperature corrected"""
+
+    header = header_index.getheader(filename, 0)
+    return header['TEXPSTRT'] > SIDE2_START and 'TEMPCORR' not in header
+
+#-------------------------------------------------------------------------------
+
+def scale_imset(sci, err, sci_header, factor, occdhtav):
+    """Scale the SCI and ERR arrays of an imset in place for temperature"""
+
+    sci *= factor
+    if err is not None:
+        err *= abs(factor)
+
+    sci_header.add_history('File scaled for Side-2 temperature uncertainty by data * (1.0 + %f * (%f - %f)) following description is STIS TIR 2004-01' %(DARK_V_TEMP, occdhtav, S2REF_TEMP))
+
+#-------------------------------------------------------------------------------
+
 def apply_dark_correction(filename, expstart):
     """Perform temperature scaling to input dark file
 
     All science extensions in the input filename will be scaled to the reference
-    temperatue of 18.0 c.
+    temperatue of 18.0 c.  The factors of all imsets are found from the
+    headers first, and the arrays are then scaled in place.
 
     Parameters
     ----------
@@ -952,26 +1343,24 @@ def apply_dark_correction(filename, expstart):
 
     """
 
-    dark_v_temp = 0.07
-    s2ref_temp = 18.0
     with pyfits.open(filename, mode = 'update') as ofile:
         if 'tempcorr' not in ofile[0].header:
-            nextend = ofile[0].header['nextend']
+            sci_exts, factors, occdhtav = temperature_factors(ofile)
 
-            for ext in np.arange(1, nextend, 3):
-                occdhtav = ofile[ext].header['OCCDHTAV']
-                factor = 1.0 / (1.0 + dark_v_temp * (float(occdhtav) - s2ref_temp))
-                ofile[ext].data = ofile[ext].data * factor
-                print('{}, ext {}: Scaling data by '.format(filename, ext), factor, ' for temperature: ', occdhtav)
-                ofile[ext+1].data = np.sqrt((ofile[ext+1].data)**2 * (factor**2)) #Modify the error array
-                ofile[ext].header.add_history('File scaled for Side-2 temperature uncertainty by data * (1.0 + %f * (%f - %f)) following description is STIS TIR 2004-01' %(dark_v_temp, occdhtav, s2ref_temp))
+            for ext, factor, temperature in zip(sci_exts, factors, occdhtav):
+                print('{}, ext {}: Scaling data by '.format(filename, ext), factor, ' for temperature: ', temperature)
+                scale_imset(ofile[ext].data, ofile[ext+1].data, ofile[ext].header,
+                            factor, temperature)
 
             ofile[0].header['tempcorr'] = 'COMPLETE'
         else:
             print('TEMPCORR = %s, no temperature correction applied to %s' %(ofile[0].header['tempcorr'], filename))
 
+    header_index.invalidate(filename)
+
 #-------------------------------------------------------------------------------
 
+@trace.traced
 def bias_subtract_data(filename, biasfile, outdir=''):
     """Perform bias subtraction on input dataset
 
@@ -994,6 +1383,8 @@ def bias_subtract_data(filename, biasfile, outdir=''):
 
     """
 
+    from stistools.basic2d import basic2d
+
     with pyfits.open(filename) as hdu:
         if (hdu[0].header['BLEVCORR'] == 'COMPLETE') or (hdu[0].header['BIASCORR'] == 'COMPLETE'):
             print("BIAS correction already done for {}".format(filename))
@@ -1007,8 +1398,9 @@ def bias_subtract_data(filename, biasfile, outdir=''):
     name, ext = os.path.splitext(name)
     if outdir:
         path = outdir
-    trailerfile = os.path.join(path, name + '_bias_subtract_log.txt')
+    trailerfile = bias_subtract_trailer(filename, outdir)
 
+    bias_path = biasfile
     biasfile = make_path_safe(biasfile)
 
     output_filename = name.rsplit('_raw', 1)[0] + ('_flc' if cte_corrected else '_flt') + '.fits'
@@ -1027,21 +1419,30 @@ def bias_subtract_data(filename, biasfile, outdir=''):
         raise IOError('Directory with input data does not allow write access. ' + \
                       f'Please specify an explicit outdir.  {filename}')
 
-    pyfits.setval(filename, 'BIASFILE', ext=0, value=biasfile, comment='')
-    status = basic2d(filename,
-                     output=output_filename,
-                     dqicorr='perform',
-                     blevcorr='perform',
-                     biascorr='perform',
-                     doppcorr='omit',
-                     lorscorr='omit',
-                     glincorr='omit',
-                     lflgcorr='omit',
-                     darkcorr='omit',
-                     flatcorr='omit',
-                     photcorr='omit',
-                     verbose=False,
-                     trailer=trailerfile)
+    with header_edits(filename) as header:
+        header['BIASFILE'] = (biasfile, '')
+
+    switches = dict(dqicorr='perform',
+                    blevcorr='perform',
+                    biascorr='perform',
+                    doppcorr='omit',
+                    lorscorr='omit',
+                    glincorr='omit',
+                    lflgcorr='omit',
+                    darkcorr='omit',
+                    flatcorr='omit',
+                    photcorr='omit')
+    key = calcache.make_key('basic2d', [filename],
+                            [bias_path] + calcache.reference_tables(filename, 'basic2d'), switches)
+    if calcache.fetch(key, 'basic2d', {'flt': output_filename}):
+        return output_filename
+
+    with trace.span('basic2d', category='calstis', file=filename):
+        status = basic2d(filename,
+                         output=output_filename,
+                         verbose=False,
+                         trailer=trailerfile,
+                         **switches)
     if status != 0:
         try:
             print()
@@ -1051,10 +1452,80 @@ def bias_subtract_data(filename, biasfile, outdir=''):
         finally:
             raise Exception(f'BASIC2D failed to properly reduce {filename}')
 
+    calcache.store(key, 'basic2d', {'flt': output_filename})
+
     return output_filename
 
 #-------------------------------------------------------------------------------
 
+def bias_subtract_trailer(filename, outdir=''):
+    """Name of the basic2d trailer file written by `bias_subtract_data`"""
+
+    path, name = os.path.split(filename)
+    name, ext = os.path.splitext(name)
+    if outdir:
+        path = outdir
+
+    return os.path.join(path, name + '_bias_subtract_log.txt')
+
+#-------------------------------------------------------------------------------
+
+def bias_subtract_data_many(file_list, biasfile, outdir='', workers=None):
+    """Perform bias subtraction on many datasets at once
+
+    `bias_subtract_data` is run on each file from a pool of threads, so
+    that several basic2d processes run at the same time.  Each file keeps
+    its own trailer file.  Every file is attempted, and if any of them
+    failed a single exception listing all failures is raised at the end.
+
+    Parameters
+    ----------
+    file_list : list
+        full paths to the input FITS files
+    biasfile : str
+        full path to the bias FITS file to be subtracted
+    outdir : str, optional
+        if specified, the directory to send the bias-subtracted output files
+    workers : int, optional
+        number of basic2d runs at a time, defaults to the number of CPUs
+
+    Returns
+    -------
+    flt_list : list
+        full paths to the bias subtracted files, in the order of file_list
+
+    """
+
+    if not len(file_list):
+        return []
+
+    #-- set up refdir once, rather than from every thread
+    make_path_safe(biasfile)
+
+    workers = workers or os.cpu_count() or 1
+    workers = min(workers, len(file_list))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(bias_subtract_data, filename, biasfile, outdir)
+                   for filename in file_list]
+
+    flt_list = []
+    failures = []
+    for filename, future in zip(file_list, futures):
+        try:
+            flt_list.append(future.result())
+        except Exception as e:
+            failures.append('{}: {} (see {})'.format(filename, e,
+                                                     bias_subtract_trailer(filename, outdir)))
+
+    if failures:
+        raise Exception('Bias subtraction failed for {} of {} files:\n    {}'.format(
+            len(failures), len(file_list), '\n    '.join(failures)))
+
+    return flt_list
+
+#-------------------------------------------------------------------------------
+
 def make_path_safe(filename):
     """Make a full path to file safe for use in FITS headers.
 
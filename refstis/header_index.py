@@ -0,0 +1,246 @@
+"""Persistent index of FITS header keywords for the pipeline inputs.
+
+Sorting an anneal month into weeks, checking gains and binnings, and
+writing the HISTORY of each reference file all need a handful of header
+keywords (TARGNAME, CCDGAIN, EXPSTART, TEXPSTRT/TEXPEND, BINAXIS1/2,
+NEXTEND, PROPOSID, PROPTTL1...) from every raw and flt file.  Rather than
+re-opening each file for every keyword, the primary and first extension
+headers of a file are read once and stored in an SQLite database.
+
+Entries are keyed by the absolute path of the file and validated with
+its `stat_key`: the modification and status change times, size and inode.
+A file that is moved, rewritten or has a keyword updated is re-read the
+next time it is asked for, while a file that hasn't changed is only
+stat'ed.  An edit keeping the size within a single clock tick could go
+unnoticed, so code in refstis which edits headers in place also calls
+`invalidate` once it is done.  The same rule is used by
+`refstis.calcache` and `refstis.refcache`.
+
+The database lives at ``~/.refstis_header_index.db`` unless the
+``REFSTIS_HEADER_INDEX`` environment variable points elsewhere.  If the
+database can't be opened, headers are read directly from the files.
+
+"""
+
+import os
+import sqlite3
+import threading
+
+from astropy.io import fits
+
+DEFAULT_INDEX = os.path.join(os.path.expanduser('~'), '.refstis_header_index.db')
+
+#-- Extensions stored in the index, all others are read from the file
+INDEXED_EXTENSIONS = (0, 1)
+
+_local = threading.local()
+
+#-- headers already parsed by this process: path -> (stat key, {ext: header})
+_parsed = {}
+
+#-------------------------------------------------------------------------------
+
+def index_path():
+    """Return the location of the header index database"""
+
+    return os.environ.get('REFSTIS_HEADER_INDEX', DEFAULT_INDEX)
+
+#-------------------------------------------------------------------------------
+
+def _connect():
+    """Return a connection to the index for this process and thread
+
+    Connections can't be shared between threads or across a fork, so one
+    is kept per thread and re-made when the process id or index path
+    changes.  None is returned if the database can't be used.
+
+    """
+
+    db_path = index_path()
+    key = (os.getpid(), db_path)
+
+    if getattr(_local, 'key', None) != key:
+        try:
+            db = sqlite3.connect(db_path, timeout=60)
+            db.execute("""CREATE TABLE IF NOT EXISTS header_entries
+                          (path text, ext integer, mtime_ns integer, ctime_ns integer,
+                           size integer, inode integer, header text,
+                           PRIMARY KEY (path, ext))""")
+            db.commit()
+        except sqlite3.Error as e:
+            print('Header index {} not available: {}'.format(db_path, e))
+            db = None
+
+        _local.key = key
+        _local.db = db
+
+    return _local.db
+
+#-------------------------------------------------------------------------------
+
+def stat_key(filename):
+    """Key telling whether a file has changed, without reading it
+
+    Parameters
+    ----------
+    filename : str
+        any file
+
+    Returns
+    -------
+    key : tuple
+        modification time, status change time (both in ns), size and inode
+
+    """
+
+    stats = os.stat(filename)
+    return (stats.st_mtime_ns, stats.st_ctime_ns, stats.st_size, stats.st_ino)
+
+#-------------------------------------------------------------------------------
+
+def _read_headers(filename):
+    """Read all indexed headers from a file with a single open
+
+    Returns
+    -------
+    headers : dict
+        ext -> header
+
+    """
+
+    headers = {}
+    with fits.open(filename) as hdu:
+        for ext in INDEXED_EXTENSIONS:
+            if ext < len(hdu):
+                headers[ext] = hdu[ext].header.copy()
+
+    return headers
+
+#-------------------------------------------------------------------------------
+
+def populate(file_list):
+    """Make sure every file in the list has an up-to-date index entry
+
+    Files which haven't changed are not parsed again.
+
+    Parameters
+    ----------
+    file_list : list
+        list of FITS files to index
+
+    """
+
+    if not isinstance(file_list, (list, tuple)):
+        file_list = [file_list]
+
+    db = _connect()
+    rows = []
+    for filename in file_list:
+        path = os.path.abspath(filename)
+        key = stat_key(path)
+
+        found = _parsed.get(path)
+        if found and found[0] == key:
+            continue
+
+        if db is not None:
+            found = db.execute("""SELECT ext, header FROM header_entries
+                                  WHERE path=? AND mtime_ns=? AND ctime_ns=?
+                                  AND size=? AND inode=?""", (path,) + key).fetchall()
+            if found:
+                _parsed[path] = (key, {ext: fits.Header.fromstring(text) for ext, text in found})
+                continue
+
+        headers = _read_headers(path)
+        _parsed[path] = (key, headers)
+        for ext, header in headers.items():
+            rows.append((path, ext) + key + (header.tostring(),))
+
+    if db is not None and rows:
+        try:
+            db.executemany("""INSERT OR REPLACE INTO header_entries VALUES (?,?,?,?,?,?,?)""",
+                           rows)
+            db.commit()
+        except sqlite3.Error as e:
+            print('Could not update header index: {}'.format(e))
+
+#-------------------------------------------------------------------------------
+
+def invalidate(filename):
+    """Forget the index entry of a file whose headers have been edited
+
+    Parameters
+    ----------
+    filename : str
+        FITS file
+
+    """
+
+    path = os.path.abspath(filename)
+    _parsed.pop(path, None)
+
+    db = _connect()
+    if db is not None:
+        try:
+            db.execute("""DELETE FROM header_entries WHERE path=?""", (path,))
+            db.commit()
+        except sqlite3.Error as e:
+            print('Could not update header index: {}'.format(e))
+
+#-------------------------------------------------------------------------------
+
+def getheader(filename, ext=0):
+    """Return a header of the input file from the index
+
+    The returned header is shared with the index and should not be
+    modified.  Extensions not kept in the index are read from the file.
+
+    Parameters
+    ----------
+    filename : str
+        FITS file
+    ext : int, optional
+        extension number
+
+    Returns
+    -------
+    header : astropy.io.fits.Header
+        header of the requested extension
+
+    """
+
+    if ext not in INDEXED_EXTENSIONS:
+        return fits.getheader(filename, ext)
+
+    path = os.path.abspath(filename)
+    populate([path])
+
+    try:
+        return _parsed[path][1][ext]
+    except KeyError:
+        raise IndexError('Extension {} not found in {}'.format(ext, filename))
+
+#-------------------------------------------------------------------------------
+
+def getval(filename, keyword, ext=0):
+    """Return the value of a header keyword, like `astropy.io.fits.getval`
+
+    Parameters
+    ----------
+    filename : str
+        FITS file
+    keyword : str
+        header keyword
+    ext : int, optional
+        extension number
+
+    Returns
+    -------
+    value
+        value of the keyword
+
+    """
+
+    return getheader(filename, ext)[keyword]
+
+#-------------------------------------------------------------------------------
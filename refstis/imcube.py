@@ -0,0 +1,182 @@
+"""Out-of-core stack of imsets, for cosmic-ray rejecting large weeks.
+
+`refstis.crrej.combine_files` reads every imset of a week into memory,
+10 bytes per pixel per imset for the float32 SCI and ERR and uint16 DQ
+stacks, or 1.3 GB for 120 full frames, before the rejection adds its own
+temporaries.  Weeks with more imsets than that used to be split in two,
+and the two refbias files averaged with `refstis.functions.refaver`,
+which only approximates a rejection of the whole week.
+
+An `ImsetCube` keeps the three stacks as memory-mapped ``.npy`` files in
+a scratch folder instead.  The imsets are written into it one at a time,
+and `refstis.crrej.crreject_stack` reads it back in blocks of rows sized
+to keep the memory used under a budget, so any number of imsets is
+combined in a single pass with the same result as in memory.
+
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from . import crrej
+
+#-- stacks with more imsets than this are combined out of core
+MAX_IN_MEMORY_IMSETS = 120
+
+#-- memory used by the rejection of a block of rows, in bytes
+MEMORY_BUDGET = 1024 ** 3
+
+#-- bytes used by crreject_stack per stacked value: the memory-mapped
+#-- inputs, their float64 copies and the temporaries of each iteration
+BYTES_PER_VALUE = 64
+
+#-------------------------------------------------------------------------------
+
+class ImsetCube(object):
+    """SCI, ERR and DQ stacks memory mapped from a scratch folder
+
+    The stacks are created when the first imset is added, and removed
+    with the scratch folder by `close`.  A cube is also a context manager
+    closing itself on exit.
+
+    Parameters
+    ----------
+    n_imsets : int
+        number of imsets the cube will hold
+    scratch_dir : str, optional
+        folder in which the scratch folder is made, the default temporary
+        folder if not given
+
+    """
+
+    def __init__(self, n_imsets, scratch_dir=None):
+        self.n_imsets = n_imsets
+        self.folder = tempfile.mkdtemp(prefix='imcube_', dir=scratch_dir)
+        self.sci = self.err = self.dq = None
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _allocate(self, shape):
+        shape = (self.n_imsets,) + shape
+        for name, dtype in (('sci', np.float32), ('err', np.float32), ('dq', np.uint16)):
+            #-- new files read as zeros, so unset DQ values are 0
+            setattr(self, name, np.lib.format.open_memmap(os.path.join(self.folder, name + '.npy'),
+                                                          mode='w+', dtype=dtype, shape=shape))
+
+    def append(self, sci, err, dq=None):
+        """Write the next imset into the cube
+
+        Parameters
+        ----------
+        sci, err : np.ndarray
+            science and error arrays of the imset
+        dq : np.ndarray, optional
+            DQ array, left as 0 if not given
+
+        """
+
+        if self.count >= self.n_imsets:
+            raise ValueError('cube is full, it holds {} imsets'.format(self.n_imsets))
+        if self.sci is None:
+            self._allocate(sci.shape)
+
+        self.sci[self.count] = sci
+        self.err[self.count] = err
+        if dq is not None:
+            self.dq[self.count] = dq
+        self.count += 1
+
+    def chunk_rows(self, memory=MEMORY_BUDGET, halo=0):
+        """Rows to reject at a time to stay within a memory budget
+
+        Parameters
+        ----------
+        memory : int, optional
+            bytes available to the rejection
+        halo : int, optional
+            rows read above and below each block, see
+            `refstis.crrej.chunk_halo`
+
+        Returns
+        -------
+        chunk_rows : int
+            rows per block, at least 1
+
+        """
+
+        row_bytes = BYTES_PER_VALUE * self.n_imsets * self.sci.shape[2]
+        return max(1, memory // row_bytes - 2 * halo)
+
+    def close(self):
+        """Release the stacks and remove the scratch folder"""
+
+        #-- the maps are unmapped once no array refers to them
+        self.sci = self.err = self.dq = None
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+#-------------------------------------------------------------------------------
+
+def combine_files(file_list, output_name=None, scratch_dir=None, memory=MEMORY_BUDGET, **kwargs):
+    """Cosmic-ray reject all imsets of the input files out of core
+
+    Gives the same output as `refstis.crrej.combine_files`, with the
+    imsets held in an `ImsetCube` rather than in memory.
+
+    Parameters
+    ----------
+    file_list : list
+        input raw or flt files
+    output_name : str, optional
+        name of the single-imset output file, the arrays are returned
+        instead if not given
+    scratch_dir : str, optional
+        folder for the cube, the folder of the output (or the default
+        temporary folder) if not given
+    memory : int, optional
+        bytes available to the rejection of a block of rows
+    **kwargs
+        passed on to `refstis.crrej.crreject_stack`
+
+    Returns
+    -------
+    output_name : str
+        name of the output file, or if no output name was given
+    out_sci, out_err, out_dq, ncombine
+        output of `refstis.crrej.crreject_stack`
+
+    """
+
+    n_imsets, primary_header, sci_header, readnoise, gain = crrej.imset_info(file_list)
+    kwargs.setdefault('readnoise', readnoise)
+    kwargs.setdefault('gain', gain)
+
+    if scratch_dir is None and output_name is not None:
+        scratch_dir = os.path.dirname(os.path.abspath(output_name))
+
+    with ImsetCube(n_imsets, scratch_dir) as cube:
+        print('Writing {} imsets to {}'.format(n_imsets, cube.folder))
+        for sci, err, dq in crrej.iter_imsets(file_list, primary_header, readnoise, gain):
+            cube.append(sci, err, dq)
+
+        halo = crrej.chunk_halo(kwargs.get('sigmas', (5, 4, 3)), kwargs.get('crradius', 1.5))
+        kwargs.setdefault('chunk_rows', cube.chunk_rows(memory, halo))
+        print('Rejecting {} rows at a time'.format(kwargs['chunk_rows']))
+
+        out_sci, out_err, out_dq, ncombine = crrej.crreject_stack(cube.sci, cube.err, cube.dq,
+                                                                  **kwargs)
+
+    if output_name is None:
+        return out_sci, out_err, out_dq, ncombine
+
+    return crrej.write_combined(output_name, primary_header, sci_header,
+                                out_sci, out_err, out_dq, ncombine)
+
+#-------------------------------------------------------------------------------
@@ -0,0 +1,221 @@
+"""Record of how each product of a month was built, to rebuild only what changed.
+
+The pipeline used to skip a product whenever its file existed, so new raw
+files in a week folder, a rebuilt basebias or a change of parameters went
+unnoticed until the month was `reset` and built again from scratch.
+
+A `Manifest` is kept in the anneal month folder.  For every product it
+records the input files (raw data and upstream products alike), with the
+modification time, size and sha256 of each, the parameters the product
+was made with, and the state of the product file itself.  A product is
+up to date when it still matches that record.  Modification times are
+only a shortcut: a file whose time or size has changed is hashed again,
+and only counts as changed if its contents differ.
+
+Products made before the manifest existed have no record.  If such a
+product exists it is adopted as up to date, so upgrading doesn't rebuild
+every month already on disk.
+
+"""
+
+import json
+import os
+
+from .calcache import file_digest
+
+MANIFEST_NAME = 'manifest.json'
+
+#-- bump to rebuild everything made by an incompatible older pipeline
+MANIFEST_VERSION = 1
+
+#-------------------------------------------------------------------------------
+
+class Manifest(object):
+    """Build record of the products of a month
+
+    Parameters
+    ----------
+    filename : str
+        manifest file, normally ``MANIFEST_NAME`` in the month folder.
+        Paths are recorded relative to the folder it is in.
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.root = os.path.dirname(os.path.abspath(filename))
+        self.products = {}
+
+        #-- products to record once the task making them has finished:
+        #-- task name -> (product, inputs, params)
+        self.pending = {}
+
+        try:
+            with open(filename) as f:
+                contents = json.load(f)
+        except (IOError, ValueError):
+            contents = {}
+
+        if contents.get('version') == MANIFEST_VERSION:
+            self.products = contents.get('products', {})
+
+    def _key(self, filename):
+        return os.path.relpath(os.path.abspath(filename), self.root)
+
+    def _state(self, filename, recorded=None):
+        """mtime, size and sha256 of a file, None if it doesn't exist
+
+        The digest in ``recorded`` is reused if the file's modification
+        time and size still match it.
+
+        """
+
+        try:
+            stats = os.stat(filename)
+        except OSError:
+            return None
+
+        state = {'mtime_ns': stats.st_mtime_ns, 'size': stats.st_size}
+        if recorded and (recorded['mtime_ns'], recorded['size']) == (state['mtime_ns'], state['size']):
+            state['sha256'] = recorded['sha256']
+        else:
+            state['sha256'] = file_digest(filename)
+
+        return state
+
+    def stale_reason(self, product, inputs, params=None, rebuilding=()):
+        """Why a product must be rebuilt, or None if it is up to date
+
+        Parameters
+        ----------
+        product : str
+            product file
+        inputs : list
+            every file the product is made from
+        params : dict, optional
+            parameters the product is made with, must be JSON serializable
+        rebuilding : set, optional
+            products which are being rebuilt in this run
+
+        Returns
+        -------
+        reason : str or None
+            description of the first difference found
+
+        """
+
+        params = _normalize(params)
+        rebuilding = {self._key(item) for item in rebuilding}
+        record = self.products.get(self._key(product))
+
+        if record is None:
+            return 'no build record'
+
+        for filename in inputs:
+            if self._key(filename) in rebuilding:
+                return '{} is being rebuilt'.format(filename)
+
+        if record['params'] != params:
+            return 'parameters changed from {} to {}'.format(record['params'], params)
+
+        recorded_inputs = record['inputs']
+        keys = [self._key(filename) for filename in inputs]
+        added = sorted(set(keys) - set(recorded_inputs))
+        removed = sorted(set(recorded_inputs) - set(keys))
+        if added or removed:
+            return 'inputs changed, {} added and {} removed'.format(len(added), len(removed))
+
+        touched = False
+        for key, filename in zip(keys, inputs):
+            recorded = recorded_inputs[key]
+            state = self._state(filename, recorded)
+            if state is None:
+                return '{} is missing'.format(filename)
+            if recorded is None or state['sha256'] != recorded['sha256']:
+                return '{} changed'.format(filename)
+            if state != recorded:
+                recorded_inputs[key] = state
+                touched = True
+
+        state = self._state(product, record['product'])
+        if state is None:
+            return 'product is missing'
+        if record['product'] is None or state['sha256'] != record['product']['sha256']:
+            return 'product was modified after it was built'
+        if state != record['product']:
+            record['product'] = state
+            touched = True
+
+        #-- remember new times of unchanged files, to avoid hashing them again
+        if touched:
+            self.save()
+
+        return None
+
+    def needs_build(self, product, inputs, params=None, rebuilding=()):
+        """Decide whether a product must be built, adopting untracked products
+
+        A product without a record which exists, and none of whose inputs
+        are being rebuilt, is recorded as it is and not rebuilt.
+
+        See `stale_reason` for the parameters.
+
+        Returns
+        -------
+        build : bool
+            True if the product must be built
+
+        """
+
+        reason = self.stale_reason(product, inputs, params, rebuilding)
+        if reason == 'no build record' and os.path.exists(product) and \
+                not {self._key(item) for item in rebuilding} & {self._key(item) for item in inputs}:
+            print('{} was built without a manifest, adopting it'.format(product))
+            self.record(product, inputs, params)
+            self.save()
+            return False
+
+        if reason is None:
+            print('{} is up to date, skipping'.format(product))
+            return False
+
+        print('{} will be rebuilt: {}'.format(product, reason))
+        return True
+
+    def record(self, product, inputs, params=None):
+        """Record the current state of a product and its inputs"""
+
+        self.products[self._key(product)] = {
+            'params': _normalize(params),
+            'inputs': {self._key(filename): self._state(filename) for filename in inputs},
+            'product': self._state(product)}
+
+    def add_pending(self, task_name, product, inputs, params=None):
+        """Record a product once the task making it has finished"""
+
+        self.pending[task_name] = (product, inputs, params)
+
+    def task_done(self, task_name, value=None):
+        """Callback for `refstis.scheduler.run_tasks`"""
+
+        if task_name in self.pending:
+            self.record(*self.pending.pop(task_name))
+            self.save()
+
+    def save(self):
+        """Write the manifest, replacing the old one in a single step"""
+
+        tmp_name = '{}.{}.tmp'.format(self.filename, os.getpid())
+        with open(tmp_name, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'products': self.products},
+                      f, indent=1, sort_keys=True)
+        os.replace(tmp_name, self.filename)
+
+#-------------------------------------------------------------------------------
+
+def _normalize(params):
+    """Parameters as they will read back from the manifest"""
+
+    return json.loads(json.dumps(params or {}, sort_keys=True))
+
+#-------------------------------------------------------------------------------
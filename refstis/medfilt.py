@@ -0,0 +1,124 @@
+"""Median filtering of CCD frames with small rectangular kernels.
+
+The builders smooth full frames with (3, 15) and (5, 5) median filters to
+find hot pixels and columns.  For kernels this small it is quicker to
+view the padded frame as a stack of windows and let `numpy.partition`
+pick the middle value of each than to go through the general filters in
+scipy.  The frame is filtered in blocks of rows, each with the kernel
+half-height of neighbouring rows as a halo, so the temporary window
+copies stay small and the blocks can be shared between threads
+(`numpy.partition` releases the GIL).  Only one thread is used unless
+more are asked for, as the pipeline already runs its tasks in parallel.
+
+Kernel sizes must be odd, so the median is always one of the input
+values and the output is identical to the scipy functions these replace:
+
+* `median_filter` to `scipy.ndimage.median_filter` (edges reflected)
+* `medfilt` to `scipy.signal.medfilt` (edges padded with zeros)
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+#-- scipy.ndimage boundary modes and their numpy.pad equivalents
+PAD_MODES = {'reflect': 'symmetric',
+             'mirror': 'reflect',
+             'nearest': 'edge',
+             'constant': 'constant',
+             'wrap': 'wrap'}
+
+#-------------------------------------------------------------------------------
+
+def median_filter(data, size, mode='reflect', workers=1, chunk_rows=32):
+    """Median filter a 2D array with a rectangular kernel
+
+    Parameters
+    ----------
+    data : np.ndarray
+        2D input array
+    size : int or tuple
+        (rows, columns) of the kernel, both odd
+    mode : str, optional
+        how the edges are extended, as in `scipy.ndimage.median_filter`
+    workers : int or None, optional
+        number of threads, one per CPU if None
+    chunk_rows : int, optional
+        output rows filtered at a time
+
+    Returns
+    -------
+    filtered : np.ndarray
+        median filtered array of the same shape and type as the input
+
+    """
+
+    data = np.asarray(data)
+    if data.ndim != 2:
+        raise ValueError('Only 2D arrays can be filtered, not {}D'.format(data.ndim))
+
+    if np.isscalar(size):
+        size = (size, size)
+    ky, kx = (int(item) for item in size)
+    if not (ky % 2 and kx % 2):
+        raise ValueError('Kernel size must be odd, not {}'.format(size))
+
+    try:
+        pad_mode = PAD_MODES[mode]
+    except KeyError:
+        raise ValueError('Unknown mode {}'.format(mode))
+
+    #-- FITS data is big-endian, which partitions much more slowly
+    data = data.astype(data.dtype.newbyteorder('='), copy=False)
+    padded = np.pad(data, ((ky // 2, ky // 2), (kx // 2, kx // 2)), mode=pad_mode)
+
+    ny, nx = data.shape
+    middle = ky * kx // 2
+    filtered = np.empty_like(data)
+
+    def filter_rows(start):
+        stop = min(start + chunk_rows, ny)
+        windows = sliding_window_view(padded[start:stop + ky - 1], (ky, kx))
+        windows = windows.reshape(stop - start, nx, ky * kx)
+        filtered[start:stop] = np.partition(windows, middle, axis=-1)[..., middle]
+
+    starts = range(0, ny, chunk_rows)
+    workers = min(workers or os.cpu_count() or 1, len(starts))
+    if workers <= 1:
+        for start in starts:
+            filter_rows(start)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(filter_rows, starts))
+
+    return filtered
+
+#-------------------------------------------------------------------------------
+
+def medfilt(data, kernel_size=3, workers=1):
+    """Median filter a 2D array, padding the edges with zeros
+
+    Same as `scipy.signal.medfilt` for 2D arrays.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        2D input array
+    kernel_size : int or tuple, optional
+        (rows, columns) of the kernel, both odd
+    workers : int or None, optional
+        number of threads, one per CPU if None
+
+    Returns
+    -------
+    filtered : np.ndarray
+        median filtered array of the same shape and type as the input
+
+    """
+
+    return median_filter(data, kernel_size, mode='constant', workers=workers)
+
+#-------------------------------------------------------------------------------
@@ -6,17 +6,14 @@ import sqlite3
 import glob
 import os
 import sys
-from astropy.io import fits
 import argparse
 import textwrap
 import time
 import shutil
 import re
 import numpy as np
-import yaml
 import getpass
 
-from .delivery import check_all
 from .functions import figure_number_of_periods, translate_date_string, mjd_to_greg
 from .retrieval import submit_xml_request, build_xml_request, everything_retrieved
 from . import pop_db
@@ -25,7 +22,22 @@ from . import weekdark
 from . import refbias
 from . import weekbias
 from . import basejoint
+from . import calcache
 from . import functions
+from . import header_index
+from . import trace
+from .manifest import Manifest, MANIFEST_NAME
+from .scheduler import Task, Result, run_tasks
+
+#-- number of imsets below which a week uses the weekbias procedure,
+#-- keyed by (CCDGAIN, BINAXIS1, BINAXIS2)
+BIAS_THRESHOLD = {(1, 1, 1) : 98,
+                  (1, 1, 2) : 25,
+                  (1, 2, 1) : 25,
+                  (1, 2, 2) : 7,
+                  (1, 4, 1) : 7,
+                  (1, 4, 2) : 4,
+                  (4, 1, 1) : 1}
 
 #-------------------------------------------------------------------------------
 
@@ -125,7 +137,8 @@ def split_files(all_files):
 
     """
 
-    all_info = [(fits.getval(filename,'EXPSTART', 1), filename)
+    header_index.populate(all_files)
+    all_info = [(header_index.getval(filename,'EXPSTART', 1), filename)
                 for filename in all_files]
     all_info.sort()
     all_files = [line[1] for line in all_info]
@@ -189,9 +202,7 @@ def grab_between(file_list, mjd_start, mjd_end):
     """
 
     for filename in file_list:
-        with pyfits.open(filename) as hdu:
-            data_start = hdu[0].header['TEXPSTRT']
-            data_end = hdu[0].header['TEXPEND']
+        data_start = header_index.getval(filename, 'TEXPSTRT', 0)
 
         if mjd_start < data_start < mjd_end:
             yield filename
@@ -262,41 +273,128 @@ def get_anneal_month(proposal_id, anneal_id):
 
 #-------------------------------------------------------------------------------
 
-def make_pipeline_reffiles(root_folder, last_basedark=None, last_basebias=None):
-    """Make reference files like the refstis pipeline
+def plan_week_bias(folder, crreject_method='calstis'):
+    """Decide how the weekly bias of a week folder will be made
 
-    1.  Separate dark and bias datasets into week folders
-    2.
+    The weekbias procedure is used for weeks with too few imsets,
+    otherwise refbias.  With calstis, weeks with more than 120 imsets are
+    split in two and the two refbias files averaged; the numpy rejection
+    combines any number of imsets in one pass (see `refstis.imcube`).
+
+    Parameters
+    ----------
+    folder : str
+        week folder containing the raw biases
+    crreject_method : str, optional
+        'calstis' or 'numpy', see `refstis.functions.crreject_imsets`
+
+    Returns
+    -------
+    weekbias_name : str
+        name of the weekly bias
+    raw_files : list
+        raw biases of the week
+    procedure : str
+        'weekbias', 'refbias' or 'split'
 
     """
 
-    if not 'oref' in os.environ:
-        raise ValueError("oref hasn't been defined in the environment")
+    proposal, wk, visit = pull_info(folder)
 
-    bias_threshold = {(1, 1, 1) : 98,
-                      (1, 1, 2) : 25,
-                      (1, 2, 1) : 25,
-                      (1, 2, 2) : 7,
-                      (1, 4, 1) : 7,
-                      (1, 4, 2) : 4,
-                      (4, 1, 1) : 1}
+    raw_files = glob.glob(os.path.join(folder, '*raw.fits'))
+    n_imsets = functions.count_imsets(raw_files)
 
-    print('#-----------------------------#')
-    print('#  Making all ref files for   #')
-    print(root_folder)
-    print('#-----------------------------#')
+    gain = functions.get_keyword(raw_files, 'CCDGAIN', 0)
+    xbin = functions.get_keyword(raw_files, 'BINAXIS1', 0)
+    ybin = functions.get_keyword(raw_files, 'BINAXIS2', 0)
 
-    if not os.path.exists(root_folder):
-        raise IOError('Root folder does not exist')
+    weekbias_name = os.path.join(folder,
+                                 'weekbias_%s_%s_%s_bia.fits'%(proposal, visit, wk))
 
-    # separate raw files in folder into periods
-    separate_period(root_folder)
+    if n_imsets < BIAS_THRESHOLD[(gain, xbin, ybin)]:
+        procedure = 'weekbias'
+    elif n_imsets > 120 and crreject_method == 'calstis':
+        procedure = 'split'
+    else:
+        procedure = 'refbias'
 
-    print('###################')
-    print(' make the basebias ')
-    print('###################')
-    raw_files = []
+    return weekbias_name, raw_files, procedure
+
+#-------------------------------------------------------------------------------
+
+def weekbias_for_darks(root_folder, dark_folder):
+    """Name of the gain 1 weekbias used to calibrate a week of darks"""
 
+    proposal, wk, visit = pull_info(dark_folder)
+    return os.path.join(root_folder,
+                        'biases/1-1x1',
+                        wk,
+                        'weekbias_%s_%s_%s_bia.fits'%(proposal, visit, wk))
+
+#-------------------------------------------------------------------------------
+
+def build_task_graph(root_folder, last_basedark=None, last_basebias=None,
+                     crreject_method='calstis', delivery_dir=None, manifest=None,
+                     task_workers=1):
+    """Lay out the steps to make a month of reference files as a task graph
+
+    * basebias, from all gain 1 biases of the month
+    * per week: weekbias or refbias (or, for large weeks with calstis, two
+      refbias and refaver), every gain 1 week waiting on the basebias, as
+      making it edits the headers of their raw biases
+    * per raw dark: bias subtraction, once the weekbias of its week is done
+    * basedark, once for the month from all bias subtracted darks
+    * basedark products, the statistics and median filter of the basedark
+      shared by the weekdarks, once the basedark is done
+    * per week: weekdark, once its darks, basedark products and weekbias
+      are done
+    * delivery checks, once everything else is done
+
+    Products which are up to date with their inputs and parameters, as
+    recorded in the manifest of the month, are not remade.  Anything made
+    from a product that is remade is remade as well.  See
+    `refstis.manifest`.
+
+    Parameters
+    ----------
+    root_folder : str
+        anneal month folder, already separated into week folders
+    last_basedark : str, optional
+        basedark to use instead of making one
+    last_basebias : str, optional
+        basebias to use instead of making one
+    crreject_method : str, optional
+        'calstis' or 'numpy', see `refstis.functions.crreject_imsets`
+    delivery_dir : str, optional
+        if given, the products are checked and moved here for delivery
+    manifest : refstis.manifest.Manifest, optional
+        build record of the month, read from the month folder if not
+        given.  The products to build are added to its pending records.
+    task_workers : int, optional
+        number of files a task works on at a time, for the tasks which
+        calibrate many files
+
+    Returns
+    -------
+    tasks : list
+        list of `refstis.scheduler.Task`
+
+    """
+
+    if manifest is None:
+        manifest = Manifest(os.path.join(root_folder, MANIFEST_NAME))
+    rebuilding = set()
+
+    def needs_build(product, inputs, params=None):
+        if manifest.needs_build(product, inputs, params, rebuilding):
+            rebuilding.add(product)
+            return True
+        return False
+
+    tasks = []
+    crj_kwargs = {'crreject_method': crreject_method}
+
+    raw_files = []
     for root, dirs, files in os.walk(os.path.join(root_folder, 'biases')):
         if not '1-1x1' in root:
             continue
@@ -304,118 +402,228 @@ def make_pipeline_reffiles(root_folder, last_basedark=None, last_basebias=None):
         for filename in files:
             if filename.startswith('o') and filename.endswith('_raw.fits'):
                 raw_files.append(os.path.join(root, filename))
+    raw_files.sort()
 
     basebias_name = os.path.join(root_folder, 'basebias.fits')
-    if os.path.exists(basebias_name):
-        print('{} already exists, skipping')
-    else:
-        basejoint.make_basebias(raw_files, basebias_name)
+    basebias_task = []
+    if needs_build(basebias_name, raw_files):
+        tasks.append(Task('basebias', basejoint.make_basebias, (raw_files, basebias_name),
+                          {'workers': task_workers}))
+        manifest.add_pending('basebias', basebias_name, raw_files)
+        basebias_task = ['basebias']
 
-    print('#######################')
-    print(' make the weekly biases')
-    print('#######################')
-    #-- Find the premade folders if they exist
-    gain_folders, week_folders = pull_out_subfolders(root_folder)
+    #-- basejoint.calibrate edits the headers of the gain 1 raw biases in
+    #-- place, so nothing else may read them until the basebias is done
+    raw_bias_task = basebias_task
 
     #-- use last basefiles if supplied
-    basebias_name = last_basebias or basebias_name
+    if last_basebias:
+        basebias_name = last_basebias
+        basebias_task = []
 
+    gain_folders, week_folders = pull_out_subfolders(root_folder)
     bias_folders = [item for item in week_folders if '/biases/' in item]
-    print(bias_folders)
+    dark_folders = [item for item in week_folders if '/darks/' in item]
 
+    weekbias_tasks = {}
     for folder in sorted(bias_folders):
-        print('Processing {}'.format(folder))
-
-        proposal, wk, visit = pull_info(folder)
-
-        raw_files = glob.glob(os.path.join(folder, '*raw.fits'))
-        n_imsets = functions.count_imsets(raw_files)
-
-        gain = functions.get_keyword(raw_files, 'CCDGAIN', 0)
-        xbin = functions.get_keyword(raw_files, 'BINAXIS1', 0)
-        ybin = functions.get_keyword(raw_files, 'BINAXIS2', 0)
-
-        weekbias_name = os.path.join(folder,
-                                     'weekbias_%s_%s_%s_bia.fits'%(proposal, visit, wk))
-        if os.path.exists(weekbias_name):
-            print('{} already exists, skipping')
+        weekbias_name, raw_files, procedure = plan_week_bias(folder, crreject_method)
+        raw_files = sorted(raw_files)
+        inputs = raw_files + [basebias_name] if procedure == 'weekbias' else raw_files
+        params = {'procedure': procedure, 'crreject_method': crreject_method}
+        if not needs_build(weekbias_name, inputs, params):
             continue
 
-        #make weekbias if too few imsets
-
-        if n_imsets < bias_threshold[(gain, xbin, ybin)]:
-            weekbias.make_weekbias(raw_files, weekbias_name, basebias_name)
+        name = 'weekbias {}'.format(os.path.relpath(folder, root_folder))
+        depends = raw_bias_task if '1-1x1' in folder else []
+        if procedure == 'weekbias':
+            tasks.append(Task(name, weekbias.make_weekbias,
+                              (raw_files, weekbias_name, basebias_name), crj_kwargs,
+                              depends=basebias_task + depends))
+        elif procedure == 'refbias':
+            tasks.append(Task(name, refbias.make_refbias,
+                              (raw_files, weekbias_name), crj_kwargs,
+                              depends=depends))
         else:
-            if n_imsets > 120:
-                super_list = split_files(raw_files)
-                all_subnames = []
-                for i, sub_list in enumerate(super_list):
-                    subname = weekbias_name.replace('.fits', '_grp0'+str(i+1)+'.fits')
-                    print('Making sub-file for datasets')
-                    print(sub_list)
-                    refbias.make_refbias(sub_list, subname)
-                    all_subnames.append(subname)
-                functions.refaver(all_subnames, weekbias_name)
-
-            else:
-                refbias.make_refbias(raw_files, weekbias_name)
+            all_subnames = []
+            for i, sub_list in enumerate(split_files(raw_files)):
+                subname = weekbias_name.replace('.fits', '_grp0'+str(i+1)+'.fits')
+                tasks.append(Task('{} grp0{}'.format(name, i+1), refbias.make_refbias,
+                                  (sub_list, subname), crj_kwargs,
+                                  depends=depends))
+                all_subnames.append(subname)
+            tasks.append(Task(name, functions.refaver, (all_subnames, weekbias_name),
+                              depends=['{} grp0{}'.format(name, i+1)
+                                       for i in range(len(all_subnames))]))
+
+        manifest.add_pending(name, weekbias_name, inputs, params)
+        weekbias_tasks[os.path.normpath(weekbias_name)] = name
+
+    #-- one basedark for the month, made from every bias subtracted dark
+    proposal, wk, visit = pull_info(root_folder)
+    basedark_name = last_basedark or \
+        os.path.join(root_folder, 'basedark_%s_%s.fits'%(proposal, visit))
+
+    dark_inputs = {}
+    for folder in sorted(dark_folders):
+        dark_inputs[folder] = sorted(glob.glob(os.path.join(folder, '*raw.fits')))
 
+    basedark_inputs = [item for folder in sorted(dark_folders) for item in dark_inputs[folder]]
+    basedark_inputs += sorted({weekbias_for_darks(root_folder, folder) for folder in dark_folders})
+    build_basedark = bool(dark_folders) and not last_basedark and \
+        needs_build(basedark_name, basedark_inputs)
 
-    print('#######################')
-    print(' make the weekly darks ')
-    print('#######################')
-    all_flt_darks = []
-    dark_folders = [item for item in week_folders if '/darks/' in item]
-    print(dark_folders)
+    weekdarks = []
     for folder in sorted(dark_folders):
-        print('Prepping {}'.format(folder))
-
         proposal, wk, visit = pull_info(folder)
+        weekdark_name = os.path.join(folder,
+                                     'weekdark_%s_%s_%s_drk.fits'%(proposal, visit, wk))
+        weekbias_name = weekbias_for_darks(root_folder, folder)
+        inputs = dark_inputs[folder] + [weekbias_name, basedark_name]
+        if needs_build(weekdark_name, inputs):
+            weekdarks.append((folder, weekdark_name, weekbias_name, inputs))
+
+    #-- the darks are only bias subtracted for the products being remade
+    biassub_folders = sorted(dark_folders) if build_basedark else \
+        [folder for folder, weekdark_name, weekbias_name, inputs in weekdarks]
+
+    biassub_tasks = {}
+    for folder in biassub_folders:
+        weekbias_name = weekbias_for_darks(root_folder, folder)
+        depends = [weekbias_tasks[os.path.normpath(weekbias_name)]] \
+            if os.path.normpath(weekbias_name) in weekbias_tasks else []
+
+        biassub_tasks[folder] = []
+        for item in dark_inputs[folder]:
+            name = 'bias subtract {}'.format(os.path.relpath(item, root_folder))
+            tasks.append(Task(name, functions.bias_subtract_data, (item, weekbias_name),
+                              depends=depends))
+            biassub_tasks[folder].append(name)
+
+    basedark_task = []
+    if build_basedark:
+        all_flt_darks = [Result(name) for folder in sorted(dark_folders)
+                         for name in biassub_tasks[folder]]
+        tasks.append(Task('basedark', basedark.make_basedark,
+                          (all_flt_darks, basedark_name),
+                          {'cache_dir': root_folder, 'workers': task_workers}))
+        manifest.add_pending('basedark', basedark_name, basedark_inputs)
+        basedark_task = ['basedark']
+
+    #-- computed once here rather than by each worker making a weekdark
+    if weekdarks:
+        tasks.append(Task('basedark products', weekdark.prepare_basedark,
+                          (basedark_name,), depends=basedark_task))
+        basedark_task = ['basedark products']
+
+    for folder, weekdark_name, weekbias_name, inputs in weekdarks:
+        depends = [weekbias_tasks[os.path.normpath(weekbias_name)]] \
+            if os.path.normpath(weekbias_name) in weekbias_tasks else []
+
+        name = 'weekdark {}'.format(os.path.relpath(folder, root_folder))
+        tasks.append(Task(name,
+                          weekdark.make_weekdark,
+                          ([Result(item) for item in biassub_tasks[folder]],
+                           weekdark_name,
+                           basedark_name,
+                           weekbias_name),
+                          {'workers': task_workers},
+                          depends=depends + basedark_task))
+        manifest.add_pending(name, weekdark_name, inputs)
+
+    if delivery_dir:
+        from .delivery import check_all
+        tasks.append(Task('delivery', check_all, (root_folder, delivery_dir),
+                          depends=[task.name for task in tasks]))
+
+    return tasks
 
-        weekbias_name = os.path.join(root_folder,
-                                     'biases/1-1x1',
-                                     wk,
-                                     'weekbias_%s_%s_%s_bia.fits'%(proposal, visit, wk))
+#-------------------------------------------------------------------------------
 
-        raw_files = glob.glob(os.path.join(folder, '*raw.fits'))
-        for item in raw_files:
-            print("bias subtracting")
-            flt_name = functions.bias_subtract_data(item, weekbias_name)
-            all_flt_darks.append(flt_name)
+def make_pipeline_reffiles(root_folder, last_basedark=None, last_basebias=None,
+                           crreject_method='calstis', workers=1, delivery_dir=None,
+                           trace_dir=None):
+    """Make reference files like the refstis pipeline
 
+    1.  Separate dark and bias datasets into week folders
+    2.  Make the basebias from all gain 1 biases of the month
+    3.  Make the weekly biases
+    4.  Bias subtract the darks with the weekly biases
+    5.  Make the basedark and weekly darks
+    6.  Optionally check and move the products for delivery
 
-    for folder in sorted(dark_folders):
-        print('Processing {}'.format(folder))
-        raw_files = glob.glob(os.path.join(folder, '*flt.fits'))
-        n_imsets = functions.count_imsets(raw_files)
+    Steps 2-6 are run as a graph of tasks (see `build_task_graph`), so
+    with more than one worker each step starts as soon as its own inputs
+    are ready.
 
-        gain = functions.get_keyword(raw_files, 'CCDGAIN', 0)
-        xbin = functions.get_keyword(raw_files, 'BINAXIS1', 0)
-        ybin = functions.get_keyword(raw_files, 'BINAXIS2', 0)
+    Parameters
+    ----------
+    root_folder : str
+        anneal month folder containing the raw data
+    last_basedark : str, optional
+        basedark to use instead of making one
+    last_basebias : str, optional
+        basebias to use instead of making one
+    crreject_method : str, optional
+        'calstis' or 'numpy', how the weekly biases are cosmic-ray
+        rejected.  See `refstis.functions.crreject_imsets`.
+    workers : int, optional
+        number of processes used to run the tasks, and with one process
+        the number of files each task works on at a time
+    delivery_dir : str, optional
+        if given, run `refstis.delivery.check_all` into this folder
+    trace_dir : str, optional
+        if given, the time spent in each step is written here as a
+        Chrome trace file, see `refstis.trace`
 
-        proposal, wk, visit = pull_info(folder)
-        weekdark_name = os.path.join(folder,
-                                     'weekdark_%s_%s_%s_drk.fits'%(proposal, visit, wk))
-        if os.path.exists(weekdark_name):
-            print('{} already exists, skipping')
-            continue
+    """
 
+    if not 'oref' in os.environ:
+        raise ValueError("oref hasn't been defined in the environment")
 
-        #-- create a base-dark for everyweek
-        weekbias_name = os.path.join(root_folder,
-                                     'biases/1-1x1',
-                                     wk,
-                                     'weekbias_%s_%s_%s_bia.fits'%(proposal, visit, wk))
-        basedark_name = os.path.join(folder, 'basedark_%s_%s_%s.fits'%(proposal, visit, wk))
+    print('#-----------------------------#')
+    print('#  Making all ref files for   #')
+    print(root_folder)
+    print('#-----------------------------#')
 
-        if not os.path.exists(basedark_name):
-            basedark.make_basedark(all_flt_darks, basedark_name, weekbias_name)
+    if not os.path.exists(root_folder):
+        raise IOError('Root folder does not exist')
 
-        basedark_name = last_basedark or basedark_name
-        weekdark.make_weekdark(raw_files,
-                               weekdark_name,
-                               basedark_name,
-                               weekbias_name)
+    old_trace_dir = os.environ.get('REFSTIS_TRACE_DIR')
+    if trace_dir:
+        run_dir = trace.start_run(trace_dir, os.path.basename(os.path.normpath(root_folder)))
+
+    try:
+        with trace.span('make_pipeline_reffiles', folder=root_folder):
+            # separate raw files in folder into periods
+            separate_period(root_folder)
+
+            start = time.time()
+            manifest = Manifest(os.path.join(root_folder, MANIFEST_NAME))
+            tasks = build_task_graph(root_folder,
+                                     last_basedark=last_basedark,
+                                     last_basebias=last_basebias,
+                                     crreject_method=crreject_method,
+                                     delivery_dir=delivery_dir,
+                                     manifest=manifest,
+                                     #-- more than one worker runs the tasks in
+                                     #-- a process pool, so each task only gets
+                                     #-- one worker rather than a pool of its own
+                                     task_workers=1 if workers > 1 else workers)
+            run_tasks(tasks, workers, on_done=manifest.task_done)
+
+        if calcache.cache_dir():
+            print(calcache.report(since=start))
+    finally:
+        if trace_dir:
+            trace_file = run_dir + '.json'
+            n_events = trace.export(run_dir, trace_file)
+            print('Wrote {} timing spans to {}'.format(n_events, trace_file))
+
+            if old_trace_dir is None:
+                del os.environ['REFSTIS_TRACE_DIR']
+            else:
+                os.environ['REFSTIS_TRACE_DIR'] = old_trace_dir
 
 #-------------------------------------------------------------------------------
 
@@ -447,12 +655,16 @@ def reset(folder):
 
     os.system('rm -fR {}'.format(os.path.join(folder, 'darks')))
     os.system('rm -fR {}'.format(os.path.join(folder, 'biases')))
+    os.system('rm -fR {}'.format(os.path.join(folder, '.refcache')))
     for item in glob.glob('{}/basedark.fits'.format(folder)):
         os.remove(item)
 
     for item in glob.glob('{}/basedark_?????_*.fits'.format(folder)):
         os.remove(item)
 
+    for item in glob.glob('{}/basedark_memo_*.fits'.format(folder)):
+        os.remove(item)
+
     for item in glob.glob('{}/basebias.fits'.format(folder)):
         os.remove(item)
 
@@ -474,6 +686,9 @@ def reset(folder):
     for item in glob.glob('{}/*.txt'.format(folder)):
         os.remove(item)
 
+    for item in glob.glob('{}/{}'.format(folder, MANIFEST_NAME)):
+        os.remove(item)
+
 #-------------------------------------------------------------------------------
 
 def get_new_obs(file_type, start, end, settings):
@@ -566,6 +781,7 @@ def collect_new(observations_to_get, settings):
 
 #-----------------------------------------------------------------------
 
+@trace.traced
 def separate_period(base_dir):
     """Separate observations in the base dir into needed folders.
 
@@ -583,8 +799,10 @@ def separate_period(base_dir):
         print("nothing to move")
         return
 
-    mjd_times = np.array([fits.getval(item, 'EXPSTART', ext=1)
-                          for item in all_files])
+    header_index.populate(all_files)
+    expstart = {item: header_index.getval(item, 'EXPSTART', ext=1)
+                for item in all_files}
+    mjd_times = np.array(list(expstart.values()))
     month_begin = mjd_times.min()
     month_end = mjd_times.max()
     print('All data goes from', month_begin, ' to ',  month_end)
@@ -599,9 +817,9 @@ def separate_period(base_dir):
 
         obs_list = []
         for item in all_files:
-            with fits.open(item) as hdu:
-                if (hdu[0].header['TARGNAME'] == file_type) and (hdu[0].header['CCDGAIN'] == gain):
-                    obs_list.append(item)
+            header = header_index.getheader(item, 0)
+            if (header['TARGNAME'] == file_type) and (header['CCDGAIN'] == gain):
+                obs_list.append(item)
 
         if not len(obs_list):
             print('{} No obs to move.  Skipping'.format(mode))
@@ -658,21 +876,19 @@ def separate_period(base_dir):
 
             print('week goes from: ', begin, end)
             obs_to_move = [item for item in obs_list if
-                           (begin <= fits.getval(item, 'EXPSTART', ext=1) <= end)]
+                           (begin <= expstart[item] <= end)]
 
             if not len(obs_to_move):
                 raise ValueError('error, empty list to move')
 
             for item in obs_to_move:
                 print('Moving ', item,  ' to:', output_path)
+                has_imphttab = 'IMPHTTAB' in header_index.getheader(item, 0)
                 shutil.move(item,  output_path)
-                if not 'IMPHTTAB' in fits.getheader(os.path.join(output_path,
-                                                                 item.split('/')[-1]), 0):
+                if not has_imphttab:
                     ###Dynamic at some point
-                    fits.setval(os.path.join(output_path, item.split('/')[-1]),
-                                'IMPHTTAB',
-                                ext=0,
-                                value='oref$x9r1607mo_imp.fits')
+                    with functions.header_edits(os.path.join(output_path, item.split('/')[-1])) as header:
+                        header['IMPHTTAB'] = 'oref$x9r1607mo_imp.fits'
 
                 obs_list.remove(item)
                 all_files.remove(item)
@@ -687,8 +903,10 @@ def separate_obs(base_dir, month_begin, month_end):
 
     all_files = glob.glob(os.path.join(base_dir, '*raw.fits'))
 
-    mjd_times = np.array([fits.getval(item, 'EXPSTART', ext=1)
-                          for item in all_files])
+    header_index.populate(all_files)
+    expstart = {item: header_index.getval(item, 'EXPSTART', ext=1)
+                for item in all_files}
+    mjd_times = np.array(list(expstart.values()))
     print('All data goes from', mjd_times.min(), ' to ',  mjd_times.max())
 
     select_gain = {'WK' : 1,
@@ -701,9 +919,9 @@ def separate_obs(base_dir, month_begin, month_end):
 
         obs_list = []
         for item in all_files:
-            with fits.open(item) as hdu:
-                if (hdu[0].header['TARGNAME'] == file_type) and (hdu[0].header['CCDGAIN'] == gain):
-                    obs_list.append(item)
+            header = header_index.getheader(item, 0)
+            if (header['TARGNAME'] == file_type) and (header['CCDGAIN'] == gain):
+                obs_list.append(item)
 
         if not len(obs_list):
             print('%s No obs to move.  Skipping'%(mode))
@@ -749,22 +967,20 @@ def separate_obs(base_dir, month_begin, month_end):
 
             print('week goes from: ', begin, end)
             obs_to_move = [item for item in obs_list if
-                            ((fits.getval(item, 'EXPSTART', ext=1) >= begin) and
-                             (fits.getval(item, 'EXPSTART', ext=1) < end))]
+                            ((expstart[item] >= begin) and
+                             (expstart[item] < end))]
 
             if not len(obs_to_move):
                 print('error, empty list to move')
 
             for item in obs_to_move:
                 print('Moving ', item,  ' to:', output_path)
+                has_imphttab = 'IMPHTTAB' in header_index.getheader(item, 0)
                 shutil.move(item,  output_path)
-                if not 'IMPHTTAB' in fits.getheader(os.path.join(output_path,
-                                                                 item.split('/')[-1]), 0):
+                if not has_imphttab:
                     ###Dynamic at some point
-                    fits.setval(os.path.join(output_path, item.split('/')[-1]),
-                                'IMPHTTAB',
-                                ext=0,
-                                value='oref$x9r1607mo_imp.fits')
+                    with functions.header_edits(os.path.join(output_path, item.split('/')[-1])) as header:
+                        header['IMPHTTAB'] = 'oref$x9r1607mo_imp.fits'
                 obs_list.remove(item)
                 all_files.remove(item)
 
@@ -850,6 +1066,8 @@ Procedure
 def run(config_file='config.yaml'):
     """Run the reference file pipeline """
 
+    import yaml
+
     args = parse_args()
 
     print(args)
@@ -875,6 +1093,17 @@ def run(config_file='config.yaml'):
 
     pop_db.main()
 
+    crreject_method = data.get('crreject_method', 'calstis')
+    workers = data.get('workers', 1)
+    trace_dir = data.get('trace_dir')
+
+    #-- set through the environment so the worker processes see it too
+    if data.get('calcache_dir'):
+        os.environ['REFSTIS_CALCACHE_DIR'] = data['calcache_dir']
+        os.makedirs(data['calcache_dir'], exist_ok=True)
+    if data.get('calcache_bytes'):
+        os.environ['REFSTIS_CALCACHE_BYTES'] = str(data['calcache_bytes'])
+
     all_folders = get_new_periods(data['products_directory'], data)
 
 
@@ -884,20 +1113,20 @@ def run(config_file='config.yaml'):
         print("----------------------------------")
         print('all_folders: {}'.format(all_folders))
         for folder in all_folders:
-            make_pipeline_reffiles(folder)
             tail = folder.rstrip(os.sep).split(os.sep)[-1]
             destination = os.path.join(data['delivery_directory'], tail)
-            check_all(folder, destination)
+            make_pipeline_reffiles(folder, crreject_method=crreject_method, workers=workers,
+                                   delivery_dir=destination, trace_dir=trace_dir)
 
     # AER 11 Aug 2016
     if not args.redo_all and not args.reprocess_month:
         print("-----------------------------------")
         print("Processing most recent anneal month")
         print("-----------------------------------")
-        make_pipeline_reffiles(all_folders[0])
         tail = all_folders[0].rstrip(os.sep).split(os.sep)[-1]
         destination = os.path.join(data['delivery_directory'], tail)
-        check_all(all_folders[0], destination)
+        make_pipeline_reffiles(all_folders[0], crreject_method=crreject_method, workers=workers,
+                               delivery_dir=destination, trace_dir=trace_dir)
 
     # AER 12 Aug 2016
     if args.reprocess_month:
@@ -915,7 +1144,7 @@ def run(config_file='config.yaml'):
                     fltfiles = glob.glob(''.join([root, '/*_flt.fits']))
                     if len(fltfiles) != 0:
                         onefile = np.sort(fltfiles)[0]
-                        obsdate = fits.getval(onefile, 'TDATEOBS', ext = 0)
+                        obsdate = header_index.getval(onefile, 'TDATEOBS', ext = 0)
                         if (obsdate <= args.reprocess_month[1] and obsdate >= args.reprocess_month[0]):
                             filestoprocess.append(root)
         print('filestoprocess:  {}'.format(filestoprocess))
@@ -926,8 +1155,8 @@ def run(config_file='config.yaml'):
         all_folders = set(folders1)
 
         for folder in all_folders:
-            make_pipeline_reffiles(folder)
             tail = folder.rstrip(os.sep).split(os.sep)[-1]
             destination = os.path.join(data['delivery_directory'], tail)
-            check_all(folder, destination)
+            make_pipeline_reffiles(folder, crreject_method=crreject_method, workers=workers,
+                                   delivery_dir=destination, trace_dir=trace_dir)
 #-----------------------------------------------------------------------
@@ -74,7 +74,7 @@ def grab_anneal_mjds():
 
 #-------------------------------------------------------------------------------
 
-def pop_database(anneal_info):
+def pop_database(anneal_info, database="anneal_info.db"):
     """  Populate anneal database with information gained pulled from anneal
     monitor observations
 
@@ -82,6 +82,8 @@ def pop_database(anneal_info):
     ----------
     anneal_info
         list, list of tuples to be populated into db
+    database
+        str, database file to write
 
     returns
     -------
@@ -90,7 +92,7 @@ def pop_database(anneal_info):
     """
 
     print('Populating Anneal database')
-    db = sqlite3.connect("anneal_info.db")
+    db = sqlite3.connect(database)
     c = db.cursor()
     table = 'anneals'
     try:
@@ -113,6 +115,8 @@ def pop_database(anneal_info):
     for row in c:
         print(row)
 
+    db.close()
+
 #-------------------------------------------------------------------------------
 
 def main():
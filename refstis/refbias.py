@@ -10,12 +10,12 @@ Basic premise for making a refbias.
 """
 
 from astropy.io import fits
-from astropy.stats import sigma_clipped_stats
 import numpy as np
-from scipy.signal import medfilt
-import shutil
 
 from . import functions
+from . import trace
+from .medfilt import medfilt
+from .robust_stats import sigma_clipped_stats
 
 #-------------------------------------------------------------------------------
 
@@ -27,6 +27,24 @@ def flag_hot_pixels(refbias_name):
 
     .. note:: The input file is updated in-place.
 
+    Parameters
+    ----------
+    refbias_name : str
+        name of the reference file to flag
+
+    """
+
+    with fits.open(refbias_name, mode='update') as refbias_hdu:
+        refbias_hdu[('dq', 1)].data = hot_pixel_dq(refbias_hdu[('sci', 1)].data,
+                                                   refbias_hdu[('dq', 1)].data)
+
+#-------------------------------------------------------------------------------
+
+def hot_pixel_dq(sci, dq):
+    """DQ array with the hot pixels of a bias flagged
+
+    See `flag_hot_pixels`.
+
     .. note::
       The IRAF version of this pipeline specified a 2x15 pixel median filter
       to calculate the smoothed imaged, but the IRAF task documentation says that
@@ -35,35 +53,40 @@ def flag_hot_pixels(refbias_name):
 
     Parameters
     ----------
-    refbias_name : str
-        name of the reference file to flag
+    sci : np.ndarray
+        science array of the bias
+    dq : np.ndarray
+        DQ array of the bias
+
+    Returns
+    -------
+    dq : np.ndarray
+        new DQ array
 
     """
 
-    with fits.open(refbias_name, mode='update') as refbias_hdu:
-        smooth_bias = medfilt(refbias_hdu[('sci', 1)].data, (3, 15))
+    smooth_bias = medfilt(sci, (3, 15))
 
-        smooth_bias_mean, smooth_bias_med, smooth_bias_std = sigma_clipped_stats(smooth_bias, sigma=3, maxiters=30)
-        bias_mean, bias_median, bias_std = sigma_clipped_stats(refbias_hdu[('sci', 1)].data, sigma=3, maxiters=30)
+    smooth_bias_mean, smooth_bias_med, smooth_bias_std = sigma_clipped_stats(smooth_bias, sigma=3, maxiters=30)
+    bias_mean, bias_median, bias_std = sigma_clipped_stats(sci, sigma=3, maxiters=30)
 
 
-        smooth_bias += (bias_mean - smooth_bias_mean)
+    smooth_bias += (bias_mean - smooth_bias_mean)
 
-        bias_residual = refbias_hdu[('sci', 1)].data - smooth_bias
+    bias_residual = sci - smooth_bias
 
-        resid_mean, resid_median, resid_std = sigma_clipped_stats(bias_residual,
-                                                               sigma=3,
-                                                               maxiters=30)
-        r_five_sigma = resid_mean + 5.0 * resid_std
+    resid_mean, resid_median, resid_std = sigma_clipped_stats(bias_residual,
+                                                           sigma=3,
+                                                           maxiters=30)
+    r_five_sigma = resid_mean + 5.0 * resid_std
 
-        print('Updating DQ values of hot pixels above a level of ', r_five_sigma)
-        refbias_hdu[('dq', 1)].data = np.where(bias_residual > r_five_sigma,
-                                               16,
-                                               refbias_hdu[('dq', 1)].data)
+    print('Updating DQ values of hot pixels above a level of ', r_five_sigma)
+    return np.where(bias_residual > r_five_sigma, 16, dq)
 
 #-------------------------------------------------------------------------------
 
-def make_refbias(input_list, refbias_name='refbias.fits'):
+@trace.traced
+def make_refbias(input_list, refbias_name='refbias.fits', crreject_method='calstis'):
     """Create a refbias FITS file
 
     Parameters
@@ -72,6 +95,8 @@ def make_refbias(input_list, refbias_name='refbias.fits'):
         list of input bias files
     refbias_name : str
         name of the output bias reference file
+    crreject_method : str, optional
+        'calstis' or 'numpy', see `refstis.functions.crreject_imsets`
 
     """
 
@@ -79,22 +104,14 @@ def make_refbias(input_list, refbias_name='refbias.fits'):
     print('#        Running refbias        #')
     print('#-------------------------------#')
     print('Making refbias %s' % (refbias_name))
-    joined_out = refbias_name.replace('.fits', '_joined.fits')
-
-    print('Joining images to %s' % joined_out)
-    functions.msjoin(input_list, joined_out)
-
-    print('Checking for cosmic ray rejection')
-    crj_filename = functions.crreject(joined_out)
 
-    shutil.copy(crj_filename, refbias_name)
-    flag_hot_pixels(refbias_name)
-    functions.update_header_from_input(refbias_name, input_list)
-    fits.setval(refbias_name, 'TASKNAME', ext=0, value='refbias')
+    crj_filename = refbias_name.replace('.fits', '_crj.fits')
+    sci, err, dq, ncombine = functions.crreject_imsets(input_list, crj_filename,
+                                                       crreject_method)
+    dq = hot_pixel_dq(sci, dq)
 
-    print('Cleaning up...')
-    functions.RemoveIfThere(crj_filename)
-    functions.RemoveIfThere(joined_out)
+    functions.write_reference_file(refbias_name, input_list, sci, err, dq,
+                                   taskname='refbias')
 
     print('refbias done for {}'.format(refbias_name))
 
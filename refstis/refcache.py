@@ -0,0 +1,253 @@
+"""In-memory cache of the monthly reference products used by the weeklies.
+
+Every week of an anneal month is built against the same basebias and
+basedark.  Each weekly builder used to read those arrays again, and the
+weekdark recomputed the clipped statistics and 5x5 median filter of the
+basedark every time.  The functions here keep the decoded arrays and the
+products derived from them in a least-recently-used cache, bounded by the
+total size of the arrays held.
+
+Entries are keyed by the absolute path of the file with its
+`refstis.header_index.stat_key`, the same rule as the header index and
+calibration cache use, so a rebuilt reference file is read again.  The cache
+belongs to the process, so all weeks built by the same process (or the
+same pipeline worker) share it.  Cached arrays are read-only.
+
+The derived products (`clipped_stats` and `medfilt`) are also saved in a
+``.refcache`` folder next to the file they are derived from, so that the
+pipeline workers, each with its own cache, compute them only once.  The
+pipeline does so in a task run before the weeks which need them, see
+`refstis.weekdark.prepare_basedark`.
+
+The size limit is ``DEFAULT_MAX_BYTES`` unless the ``REFSTIS_REFCACHE_BYTES``
+environment variable is set.
+
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+
+from astropy.io import fits
+import numpy as np
+
+from . import header_index
+from .medfilt import medfilt as _medfilt
+from .robust_stats import sigma_clipped_stats as _sigma_clipped_stats
+
+DEFAULT_MAX_BYTES = 256 * 2**20
+
+#-------------------------------------------------------------------------------
+
+class ReferenceCache(object):
+    """Least-recently-used cache bounded by the size of the values
+
+    Parameters
+    ----------
+    max_bytes : int
+        largest total size of the cached values
+
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, filename, product, compute, persist=False):
+        """Return a product of a file, computing it if it isn't cached
+
+        Parameters
+        ----------
+        filename : str
+            file the product is derived from
+        product : tuple
+            hashable description of the product
+        compute : callable
+            called with no arguments to make the product on a miss
+        persist : bool, optional
+            also keep the product next to the file, for other processes.
+            It must be an array or a tuple of arrays and numbers.
+
+        Returns
+        -------
+        value
+            the cached or newly computed product
+
+        """
+
+        stat_key = header_index.stat_key(filename)
+        key = (os.path.abspath(filename), stat_key, product)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+
+        value = _load_saved(filename, stat_key, product) if persist else None
+        if value is None:
+            value = compute()
+            if persist:
+                _save(filename, stat_key, product, value)
+        value = _freeze(value)
+        nbytes = _sizeof(value)
+        if nbytes > self.max_bytes:
+            return value
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (value, nbytes)
+                self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                old_key, (old_value, old_nbytes) = self._entries.popitem(last=False)
+                self.nbytes -= old_nbytes
+
+        return value
+
+    def clear(self):
+        """Remove every entry"""
+
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+#-------------------------------------------------------------------------------
+
+def _saved_name(filename, product):
+    digest = hashlib.sha1(repr(product).encode()).hexdigest()[:16]
+    folder, name = os.path.split(os.path.abspath(filename))
+    return os.path.join(folder, '.refcache', '{}.{}.npz'.format(name, digest))
+
+#-------------------------------------------------------------------------------
+
+def _load_saved(filename, stat_key, product):
+    """Product saved by `_save`, None if missing or out of date"""
+
+    try:
+        with np.load(_saved_name(filename, product)) as saved:
+            if str(saved['stat_key']) != repr(stat_key):
+                return None
+            items = [saved['item{}'.format(i)] for i in range(int(saved['n_items']))]
+            if not bool(saved['is_tuple']):
+                return items[0]
+    except (IOError, ValueError, KeyError):
+        return None
+
+    return tuple(item if item.ndim else item.item() for item in items)
+
+#-------------------------------------------------------------------------------
+
+def _save(filename, stat_key, product, value):
+    """Save a product next to its file, replacing any older one"""
+
+    is_tuple = isinstance(value, tuple)
+    items = value if is_tuple else (value,)
+    saved_name = _saved_name(filename, product)
+    tmp_name = '{}.{}.tmp.npz'.format(saved_name, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(saved_name), exist_ok=True)
+        np.savez(tmp_name, stat_key=repr(stat_key),
+                 is_tuple=is_tuple, n_items=len(items),
+                 **{'item{}'.format(i): item for i, item in enumerate(items)})
+        os.replace(tmp_name, saved_name)
+    except OSError as e:
+        print('Could not save {}: {}'.format(saved_name, e))
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+
+#-------------------------------------------------------------------------------
+
+def _freeze(value):
+    """Make cached arrays read-only, so no builder can change them"""
+
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, tuple):
+        for item in value:
+            _freeze(item)
+
+    return value
+
+#-------------------------------------------------------------------------------
+
+def _sizeof(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, tuple):
+        return sum(_sizeof(item) for item in value)
+
+    return 64
+
+#-------------------------------------------------------------------------------
+
+_cache = ReferenceCache(int(os.environ.get('REFSTIS_REFCACHE_BYTES', DEFAULT_MAX_BYTES)))
+
+def cache():
+    """Return the cache shared by this process"""
+
+    return _cache
+
+#-------------------------------------------------------------------------------
+
+def getdata(filename, ext=('sci', 1)):
+    """Array of an extension, like `astropy.io.fits.getdata`
+
+    Parameters
+    ----------
+    filename : str
+        FITS file
+    ext : int or tuple, optional
+        extension
+
+    Returns
+    -------
+    data : np.ndarray
+        read-only array of the extension
+
+    """
+
+    def read():
+        with fits.open(filename) as hdu:
+            return hdu[ext].data.copy()
+
+    return _cache.get(filename, ('data', ext), read)
+
+#-------------------------------------------------------------------------------
+
+def clipped_stats(filename, ext=('sci', 1), sigma=3.0, maxiters=5):
+    """Sigma-clipped mean, median and standard deviation of an extension
+
+    See `refstis.robust_stats.sigma_clipped_stats`.
+
+    """
+
+    return _cache.get(filename, ('clipped_stats', ext, sigma, maxiters),
+                      lambda: tuple(float(item) for item in
+                                    _sigma_clipped_stats(getdata(filename, ext),
+                                                         sigma=sigma,
+                                                         maxiters=maxiters)),
+                      persist=True)
+
+#-------------------------------------------------------------------------------
+
+def medfilt(filename, ext=('sci', 1), kernel_size=3):
+    """Median filtered array of an extension
+
+    See `refstis.medfilt.medfilt`.
+
+    """
+
+    return _cache.get(filename, ('medfilt', ext, kernel_size),
+                      lambda: _medfilt(getdata(filename, ext), kernel_size),
+                      persist=True)
+
+#-------------------------------------------------------------------------------
@@ -0,0 +1,147 @@
+"""Sigma-clipped statistics computed from a single sort of the data.
+
+The hot pixel and hot column searches of the builders all call
+`astropy.stats.sigma_clipped_stats` on full frames with up to 50
+iterations.  Each of those iterations finds the median and standard
+deviation of the surviving values, and then masks the whole array again.
+
+Clipping around the median only ever removes values from the two ends of
+the distribution, so once the values are sorted the survivors of every
+iteration are a contiguous range of the sorted array.  With running sums
+of the sorted values each iteration becomes two binary searches and a few
+arithmetic operations, whatever the size of the frame.
+
+`sigma_clipped_stats` is a drop-in replacement for the astropy function
+as used in refstis (median centre, standard deviation with ddof=0, the
+same ``sigma`` on both sides, and non-finite values ignored).  When the
+same data needs to be clipped more than once, `SortedSample` keeps the
+sorted values so they can be reused.
+
+"""
+
+import numpy as np
+
+#-------------------------------------------------------------------------------
+
+class SortedSample(object):
+    """Sorted finite values of an array, ready for repeated clipping
+
+    Parameters
+    ----------
+    data : np.ndarray
+        input values, of any shape
+
+    """
+
+    def __init__(self, data):
+        #-- sorting in the input type is quicker, and the order is the same
+        values = np.sort(np.asarray(data).ravel())
+        if len(values) and not (np.isfinite(values[0]) and np.isfinite(values[-1])):
+            values = values[np.isfinite(values)]
+        self.values = values.astype(np.float64, copy=False)
+
+        #-- running sums are taken about the median to keep the variance
+        #-- from losing precision for data far from zero
+        self._shift = self.median(0, len(self.values)) if len(self.values) else 0.0
+        offset = self.values - self._shift
+        self._sum = np.concatenate(([0.0], np.cumsum(offset)))
+        self._sumsq = np.concatenate(([0.0], np.cumsum(offset * offset)))
+
+    def __len__(self):
+        return len(self.values)
+
+    def median(self, lo, hi):
+        """Median of the sorted values lo:hi"""
+
+        n = hi - lo
+        mid = lo + n // 2
+        if n % 2:
+            return self.values[mid]
+        return 0.5 * (self.values[mid - 1] + self.values[mid])
+
+    def mean_std(self, lo, hi):
+        """Mean and standard deviation of the sorted values lo:hi"""
+
+        n = hi - lo
+        total = (self._sum[hi] - self._sum[lo]) / n
+        variance = (self._sumsq[hi] - self._sumsq[lo]) / n - total * total
+        return self._shift + total, np.sqrt(max(variance, 0.0))
+
+    def clip(self, sigma=3.0, maxiters=5):
+        """Find the range of sorted values surviving sigma clipping
+
+        Parameters
+        ----------
+        sigma : float
+            clipping threshold in standard deviations about the median
+        maxiters : int or None
+            maximum number of iterations, None to iterate until no more
+            values are rejected
+
+        Returns
+        -------
+        lo, hi : int
+            the surviving values are ``values[lo:hi]``
+
+        """
+
+        lo, hi = 0, len(self.values)
+        iteration = 0
+        while hi > lo and (maxiters is None or iteration < maxiters):
+            iteration += 1
+            centre = self.median(lo, hi)
+            std = self.mean_std(lo, hi)[1]
+
+            new_lo = max(lo, np.searchsorted(self.values, centre - sigma * std, side='left'))
+            new_hi = min(hi, np.searchsorted(self.values, centre + sigma * std, side='right'))
+            if (new_lo, new_hi) == (lo, hi):
+                break
+            lo, hi = new_lo, new_hi
+
+        return lo, hi
+
+    def sigma_clipped_stats(self, sigma=3.0, maxiters=5):
+        """Mean, median and standard deviation after sigma clipping
+
+        See `sigma_clipped_stats` for the parameters.
+
+        """
+
+        lo, hi = self.clip(sigma, maxiters)
+        if hi <= lo:
+            return np.nan, np.nan, np.nan
+
+        #-- the final numbers are taken directly from the survivors rather
+        #-- than the running sums
+        kept = self.values[lo:hi]
+        return kept.mean(), self.median(lo, hi), kept.std()
+
+#-------------------------------------------------------------------------------
+
+def sigma_clipped_stats(data, sigma=3.0, maxiters=5):
+    """Mean, median and standard deviation of sigma clipped data
+
+    Values further than ``sigma`` standard deviations from the median are
+    rejected until none are left to reject or ``maxiters`` is reached,
+    like `astropy.stats.sigma_clipped_stats` with its default centre and
+    deviation functions.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        input values, non-finite values are ignored
+    sigma : float, optional
+        clipping threshold in standard deviations
+    maxiters : int or None, optional
+        maximum number of iterations, None to iterate until converged
+
+    Returns
+    -------
+    mean, median, std : float
+        statistics of the clipped data
+
+    """
+
+    return SortedSample(data).sigma_clipped_stats(sigma, maxiters)
+
+#-------------------------------------------------------------------------------
@@ -0,0 +1,223 @@
+"""Run a graph of dependent tasks, each as soon as its inputs are ready.
+
+The reference file pipeline is a set of steps with clear dependencies
+(the weekly biases need the basebias, bias subtraction of the darks needs
+the weekly bias of that week, and so on).  Expressing those steps as
+`Task` objects lets `run_tasks` start any step whose dependencies are
+complete instead of waiting for a whole stage to finish.
+
+A task can use the return value of another task by passing ``Result(name)``
+as one of its arguments (directly, or inside a list or tuple), which is
+replaced by that task's return value when it is submitted.
+
+"""
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import time
+
+#-------------------------------------------------------------------------------
+
+class Result(object):
+    """Placeholder for the return value of another task"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'Result({!r})'.format(self.name)
+
+#-------------------------------------------------------------------------------
+
+class Task(object):
+    """A single step of the pipeline
+
+    Parameters
+    ----------
+    name : str
+        unique name of the task
+    func : callable
+        module level function to run
+    args : tuple, optional
+        positional arguments, may contain `Result` placeholders
+    kwargs : dict, optional
+        keyword arguments, may contain `Result` placeholders
+    depends : list, optional
+        names of tasks which must finish first.  Tasks referenced through
+        `Result` are added automatically.
+
+    """
+
+    def __init__(self, name, func, args=(), kwargs=None, depends=()):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        self.depends = set(depends)
+        self.depends.update(_referenced(self.args))
+        self.depends.update(_referenced(list(self.kwargs.values())))
+
+    def __repr__(self):
+        return 'Task({!r})'.format(self.name)
+
+#-------------------------------------------------------------------------------
+
+def _referenced(value):
+    """Names of all tasks referenced by Result placeholders in value"""
+
+    if isinstance(value, Result):
+        return {value.name}
+    elif isinstance(value, (list, tuple)):
+        names = set()
+        for item in value:
+            names.update(_referenced(item))
+        return names
+
+    return set()
+
+#-------------------------------------------------------------------------------
+
+def _resolve(value, results):
+    """Replace Result placeholders with the values they stand for"""
+
+    if isinstance(value, Result):
+        return results[value.name]
+    elif isinstance(value, list):
+        return [_resolve(item, results) for item in value]
+    elif isinstance(value, tuple):
+        return tuple(_resolve(item, results) for item in value)
+
+    return value
+
+#-------------------------------------------------------------------------------
+
+def check_graph(tasks):
+    """Make sure the task graph can be run
+
+    Task names must be unique, every dependency must be one of the tasks
+    and there can't be any cycles.
+
+    Parameters
+    ----------
+    tasks : list
+        list of `Task`
+
+    Returns
+    -------
+    order : list
+        task names in an order that satisfies all dependencies
+
+    """
+
+    names = [task.name for task in tasks]
+    if len(set(names)) != len(names):
+        raise ValueError('Task names are not unique')
+
+    by_name = {task.name: task for task in tasks}
+    for task in tasks:
+        missing = task.depends - set(by_name)
+        if missing:
+            raise ValueError('{} depends on unknown tasks {}'.format(task.name, sorted(missing)))
+
+    order = []
+    done = set()
+    remaining = list(names)
+    while remaining:
+        ready = [name for name in remaining if by_name[name].depends <= done]
+        if not ready:
+            raise ValueError('Cycle found between tasks {}'.format(remaining))
+        for name in ready:
+            order.append(name)
+            done.add(name)
+            remaining.remove(name)
+
+    return order
+
+#-------------------------------------------------------------------------------
+
+def run_tasks(tasks, workers=1, on_done=None):
+    """Run all tasks, starting each one once its dependencies are done
+
+    With one worker the tasks run in this process one after the other.
+    With more, they are run in a pool of processes and any task whose
+    dependencies have finished is started as soon as a worker is free.
+
+    If a task fails no new tasks are started, the ones already running
+    are allowed to finish, and the exception is raised.
+
+    Parameters
+    ----------
+    tasks : list
+        list of `Task`
+    workers : int, optional
+        number of processes to use
+    on_done : callable, optional
+        called in this process as ``on_done(name, result)`` as each task
+        finishes successfully
+
+    Returns
+    -------
+    results : dict
+        return value of each task, keyed by task name
+
+    """
+
+    order = check_graph(tasks)
+    by_name = {task.name: task for task in tasks}
+    results = {}
+
+    if workers <= 1:
+        for name in order:
+            results[name] = _run_one(by_name[name], results)
+            if on_done:
+                on_done(name, results[name])
+        return results
+
+    pending = list(order)
+    running = {}
+    error = None
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            if error is None:
+                ready = [name for name in pending if by_name[name].depends <= set(results)]
+                for name in ready:
+                    task = by_name[name]
+                    print('Starting task {}'.format(name))
+                    future = executor.submit(task.func,
+                                             *_resolve(task.args, results),
+                                             **{key: _resolve(value, results)
+                                                for key, value in task.kwargs.items()})
+                    running[future] = name
+                    pending.remove(name)
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                    print('Finished task {}'.format(name))
+                    if on_done:
+                        on_done(name, results[name])
+                except Exception as e:
+                    print('Task {} failed: {}'.format(name, e))
+                    if error is None:
+                        error = e
+
+    if error is not None:
+        raise error
+
+    return results
+
+#-------------------------------------------------------------------------------
+
+def _run_one(task, results):
+    print('Starting task {}'.format(task.name))
+    start = time.time()
+    value = task.func(*_resolve(task.args, results),
+                      **{key: _resolve(value, results) for key, value in task.kwargs.items()})
+    print('Finished task {} in {:.1f}s'.format(task.name, time.time() - start))
+    return value
+
+#-------------------------------------------------------------------------------
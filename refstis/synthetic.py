@@ -0,0 +1,396 @@
+"""Synthetic STIS CCD bias and dark exposures, for testing and benchmarks.
+
+Real anneal months come from the archive, and the pipeline only finds
+them through the anneal database and paths on the STScI network.  The
+functions here write a month of raw files which look enough like the
+real thing for every step of refstis to run on them:
+
+* primary and SCI headers with the keywords the pipeline reads (TARGNAME,
+  CCDGAIN, ATODGAIN, BINAXIS1/2, NEXTEND, NRPTEXP, TEXPSTRT/TEXPEND,
+  EXPSTART, OCCDHTAV, LTV1/LTV2...) and the calibration switches and
+  reference file names of a raw file
+* full frames of 1024x1024 pixels with the serial and parallel overscan,
+  a bias level with a slope along the rows, read noise, a fixed bias
+  pattern and hot columns, dark current scaled with the CCD housing
+  temperature, hot pixels which appear as the month goes on, and cosmic
+  rays
+* an ``anneal_info.db`` with the anneals either side of the month, as
+  written by `refstis.pop_db`
+
+The detector (bias pattern, hot columns and hot pixels) is drawn from
+``seed``, so all files of a month share it and the same seed always
+gives the same month.
+
+"""
+
+import os
+
+from astropy.io import fits
+from astropy.time import Time
+import numpy as np
+
+from .pop_db import pop_database
+
+#-- size of the raw 1x1 frame: 19 leading and trailing serial overscan
+#-- columns and 20 parallel (virtual) overscan rows
+SERIAL_OVERSCAN = 19
+PARALLEL_OVERSCAN = 20
+
+BIAS_LEVEL = 1500.
+READNOISE = {1: 5.4, 4: 7.8}
+
+#-- e-/s, at the reference temperature
+DARK_CURRENT = 0.004
+DARK_V_TEMP = 0.07
+REF_TEMP = 18.0
+
+#-- cosmic ray events per pixel per second
+CR_RATE = 2e-6
+
+BIAS_EXPTIME = 0.
+DARK_EXPTIME = 1100.
+
+#-- seconds of readout during which a bias still collects cosmic rays
+READOUT_TIME = 30.
+
+#-------------------------------------------------------------------------------
+
+class Detector(object):
+    """Fixed features of the CCD shared by all exposures of a month
+
+    Parameters
+    ----------
+    seed : int
+        seed of the random features
+    month_begin, month_end : float
+        MJD range over which new hot pixels appear
+    n_hot_columns : int, optional
+        number of columns with a raised bias level
+    hot_fraction : float, optional
+        fraction of pixels which are hot by the end of the month
+
+    """
+
+    def __init__(self, seed=1, month_begin=57000., month_end=57028.,
+                 n_hot_columns=12, hot_fraction=0.005):
+        rng = np.random.default_rng(seed)
+        self.seed = seed
+
+        #-- DN in the science region, per 1x1 pixel
+        self.bias_pattern = rng.normal(0, 0.8, (1024, 1024)).astype(np.float32)
+        self.hot_columns = rng.choice(1024, n_hot_columns, replace=False)
+        self.hot_column_level = rng.uniform(3, 20, n_hot_columns).astype(np.float32)
+
+        #-- e-/s, with the day each hot pixel appears
+        n_hot = int(hot_fraction * 1024 * 1024)
+        self.hot_index = rng.choice(1024 * 1024, n_hot, replace=False)
+        self.hot_rate = rng.exponential(0.05, n_hot).astype(np.float32)
+        self.hot_onset = rng.uniform(month_begin - (month_end - month_begin),
+                                     month_end, n_hot)
+
+    def dark_rate(self, mjd, temperature):
+        """Dark current image in e-/s at a time and housing temperature"""
+
+        rate = np.full(1024 * 1024, DARK_CURRENT, dtype=np.float32)
+        active = self.hot_onset <= mjd
+        rate[self.hot_index[active]] += self.hot_rate[active]
+        rate *= 1.0 + DARK_V_TEMP * (temperature - REF_TEMP)
+
+        return rate.reshape(1024, 1024)
+
+#-------------------------------------------------------------------------------
+
+def _bin(image, binaxis1, binaxis2):
+    ny, nx = image.shape
+    return image.reshape(ny // binaxis2, binaxis2, nx // binaxis1, binaxis1).sum(axis=(1, 3))
+
+#-------------------------------------------------------------------------------
+
+def make_frame(detector, rng, targname='BIAS', ccdgain=1, exptime=BIAS_EXPTIME,
+               mjd=57000., temperature=REF_TEMP, binaxis1=1, binaxis2=1):
+    """One raw SCI array, including the overscan
+
+    Parameters
+    ----------
+    detector : Detector
+        fixed features of the CCD
+    rng : np.random.Generator
+        source of the noise and cosmic rays
+    targname : str, optional
+        'BIAS' or 'DARK'
+    ccdgain : int, optional
+        1 or 4
+    exptime : float, optional
+        exposure time in seconds
+    mjd : float, optional
+        start of the exposure, for the hot pixels
+    temperature : float, optional
+        CCD housing temperature (OCCDHTAV)
+    binaxis1, binaxis2 : int, optional
+        on-chip binning
+
+    Returns
+    -------
+    frame : np.ndarray
+        uint16 array of ``(1044 / binaxis2, 1062 / binaxis1)``
+
+    """
+
+    gain = float(ccdgain)
+    nx, ny = 1024 // binaxis1, 1024 // binaxis2
+    x0, y0 = SERIAL_OVERSCAN // binaxis1, 0
+    shape = (ny + PARALLEL_OVERSCAN // binaxis2, nx + 2 * x0)
+
+    #-- electrons in the science region
+    signal = np.zeros((1024, 1024), dtype=np.float32)
+    if targname == 'DARK':
+        signal += rng.poisson(detector.dark_rate(mjd, temperature) * exptime)
+
+    n_cr = rng.poisson(CR_RATE * 1024 * 1024 * (exptime + READOUT_TIME))
+    y = rng.integers(0, 1024, n_cr)
+    x = rng.integers(0, 1024, n_cr)
+    energy = rng.exponential(600, n_cr).astype(np.float32)
+    for step in range(rng.integers(1, 4)):
+        np.add.at(signal, (np.clip(y + step, 0, 1023), x), energy)
+    signal = _bin(signal, binaxis1, binaxis2)
+
+    #-- DN over the whole frame
+    frame = rng.normal(0, READNOISE[ccdgain] / gain, shape).astype(np.float32)
+    frame += (BIAS_LEVEL + 0.002 * np.arange(shape[0], dtype=np.float32))[:, np.newaxis]
+
+    science = frame[y0:y0 + ny, x0:x0 + nx]
+    science += _bin(detector.bias_pattern, binaxis1, binaxis2) / (binaxis1 * binaxis2)
+    science[:, detector.hot_columns // binaxis1] += detector.hot_column_level
+    science += signal / gain
+
+    return np.clip(np.round(frame), 0, 65535).astype(np.uint16)
+
+#-------------------------------------------------------------------------------
+
+def raw_headers(rootname, targname, ccdgain, proposid, expstart, exptime, nimsets,
+                temperature=REF_TEMP, binaxis1=1, binaxis2=1):
+    """Primary and SCI headers of a raw bias or dark
+
+    Returns
+    -------
+    primary : astropy.io.fits.Header
+        primary header
+    sci_headers : list
+        SCI header of each imset
+
+    """
+
+    overhead = (exptime + READOUT_TIME + 60.) / 86400.
+    starts = [expstart + i * overhead for i in range(nimsets)]
+    texpend = starts[-1] + exptime / 86400.
+    date_obs, time_obs = Time(expstart, format='mjd').isot.split('T')
+
+    primary = fits.Header()
+    primary['NEXTEND'] = 3 * nimsets
+    primary['FILENAME'] = '{}_raw.fits'.format(rootname)
+    primary['FILETYPE'] = 'SCI'
+    primary['TELESCOP'] = 'HST'
+    primary['INSTRUME'] = 'STIS'
+    primary['DETECTOR'] = 'CCD'
+    primary['ROOTNAME'] = rootname
+    primary['TARGNAME'] = targname
+    primary['PROPOSID'] = proposid
+    primary['PROPTTL1'] = 'CCD {} Monitor'.format(targname.capitalize())
+    primary['OBSET_ID'] = rootname[1:3]
+    primary['TDATEOBS'] = date_obs
+    primary['TTIMEOBS'] = time_obs[:8]
+    primary['TEXPSTRT'] = expstart
+    primary['TEXPEND'] = texpend
+    primary['TEXPTIME'] = exptime * nimsets
+    primary['OBSTYPE'] = 'IMAGING'
+    primary['OBSMODE'] = 'ACCUM'
+    primary['OPT_ELEM'] = 'MIRVIS'
+    primary['APERTURE'] = '50CCD'
+    primary['APER_FOV'] = '50x50'
+    primary['CCDAMP'] = 'D'
+    primary['CCDGAIN'] = ccdgain
+    primary['CCDOFFST'] = 3
+    primary['ATODGAIN'] = float(ccdgain)
+    primary['READNSE'] = READNOISE[ccdgain]
+    primary['BINAXIS1'] = binaxis1
+    primary['BINAXIS2'] = binaxis2
+    primary['NRPTEXP'] = nimsets
+    primary['CRSPLIT'] = 1
+    for switch in ('DQICORR', 'BLEVCORR', 'BIASCORR', 'DARKCORR', 'FLATCORR',
+                   'CRCORR'):
+        primary[switch] = 'PERFORM' if switch in ('DQICORR', 'BLEVCORR') else 'OMIT'
+    primary['BPIXTAB'] = 'oref$h1v1541bo_bpx.fits'
+    primary['CCDTAB'] = 'oref$16j16005o_ccd.fits'
+    primary['OSCNTAB'] = 'oref$16j1600do_osc.fits'
+    primary['BIASFILE'] = 'oref$xxxxxxxxx_bia.fits'
+    primary['DARKFILE'] = 'oref$xxxxxxxxx_drk.fits'
+    primary['IMPHTTAB'] = 'oref$x9r1607mo_imp.fits'
+
+    sci_headers = []
+    for i, start in enumerate(starts):
+        header = fits.Header()
+        header['EXTNAME'] = 'SCI'
+        header['EXTVER'] = i + 1
+        header['EXPSTART'] = start
+        header['EXPEND'] = start + exptime / 86400.
+        header['EXPTIME'] = exptime
+        header['OCCDHTAV'] = temperature
+        header['LTV1'] = float(SERIAL_OVERSCAN // binaxis1)
+        header['LTV2'] = 0.0
+        header['LTM1_1'] = 1.0 / binaxis1
+        header['LTM2_2'] = 1.0 / binaxis2
+        sci_headers.append(header)
+
+    return primary, sci_headers
+
+#-------------------------------------------------------------------------------
+
+def write_raw(filename, detector, rng, targname='BIAS', ccdgain=1, proposid=14425,
+              expstart=57000., nimsets=1, temperature=REF_TEMP, binaxis1=1, binaxis2=1):
+    """Write a synthetic raw bias or dark
+
+    Like archive raw files, the ERR and DQ extensions hold no data.
+
+    Parameters
+    ----------
+    filename : str
+        output ``<rootname>_raw.fits``
+    detector : Detector
+        fixed features of the CCD
+    rng : np.random.Generator
+        source of the noise and cosmic rays
+    targname : str, optional
+        'BIAS' or 'DARK'
+    ccdgain : int, optional
+        1 or 4
+    proposid : int, optional
+        proposal of the exposure
+    expstart : float, optional
+        MJD of the start of the first imset
+    nimsets : int, optional
+        number of imsets
+    temperature : float, optional
+        CCD housing temperature (OCCDHTAV)
+    binaxis1, binaxis2 : int, optional
+        on-chip binning
+
+    """
+
+    exptime = DARK_EXPTIME if targname == 'DARK' else BIAS_EXPTIME
+    rootname = os.path.basename(filename)[:9]
+    primary, sci_headers = raw_headers(rootname, targname, ccdgain, proposid, expstart,
+                                       exptime, nimsets, temperature, binaxis1, binaxis2)
+
+    hdu = fits.HDUList(fits.PrimaryHDU(header=primary))
+    for i, sci_header in enumerate(sci_headers):
+        frame = make_frame(detector, rng, targname, ccdgain, exptime,
+                           sci_header['EXPSTART'], temperature, binaxis1, binaxis2)
+        hdu.append(fits.ImageHDU(frame, header=sci_header))
+        for extname in ('ERR', 'DQ'):
+            header = fits.Header()
+            header['EXTNAME'] = extname
+            header['EXTVER'] = i + 1
+            header['NPIX1'] = frame.shape[1]
+            header['NPIX2'] = frame.shape[0]
+            header['PIXVALUE'] = 0
+            hdu.append(fits.ImageHDU(header=header))
+
+    hdu.writeto(filename, overwrite=True)
+
+#-------------------------------------------------------------------------------
+
+def make_anneal_month(folder, proposid=14425, visit=1, month_begin=57000., n_days=28,
+                      bias_per_week=6, bias_imsets=4, dark_per_week=2, dark_imsets=2,
+                      gain4_bias_per_biweek=2, gain4_bias_imsets=4, seed=1):
+    """Write a month of synthetic raw biases and darks
+
+    Exposures are spread evenly over the month, so `refstis.pipeline.separate_period`
+    puts the same number of files in every week.
+
+    Parameters
+    ----------
+    folder : str
+        anneal month folder, named ``<proposid>_<visit>`` by the pipeline
+    proposid : int, optional
+        proposal of the exposures
+    visit : int, optional
+        visit of the anneal which ends the month
+    month_begin : float, optional
+        MJD of the end of the previous anneal
+    n_days : int, optional
+        length of the month
+    bias_per_week, bias_imsets : int, optional
+        gain 1 biases per week and imsets in each
+    dark_per_week, dark_imsets : int, optional
+        darks per week and imsets in each
+    gain4_bias_per_biweek, gain4_bias_imsets : int, optional
+        gain 4 biases per bi-week and imsets in each
+    seed : int, optional
+        seed of the detector and the noise
+
+    Returns
+    -------
+    raw_files : list
+        files written
+
+    """
+
+    os.makedirs(folder, exist_ok=True)
+    month_end = month_begin + n_days
+    detector = Detector(seed, month_begin, month_end)
+    rng = np.random.default_rng(seed + 1)
+
+    #-- counts are per 7 days, the pipeline may split the month into
+    #-- fewer, longer weeks.  The extra file closes the month.
+    n_weeks = max(n_days // 7, 1)
+    plan = [('BIAS', 1, 'b', bias_per_week * n_weeks + 1, bias_imsets),
+            ('DARK', 1, 'd', dark_per_week * n_weeks + 1, dark_imsets),
+            ('BIAS', 4, 'g', gain4_bias_per_biweek * max(n_weeks // 2, 1) + 1,
+             gain4_bias_imsets)]
+
+    raw_files = []
+    for targname, ccdgain, kind, n_files, nimsets in plan:
+        if n_files <= 1 or nimsets < 1:
+            continue
+        starts = np.linspace(month_begin + 0.01, month_end - 0.2, n_files)
+        for i, expstart in enumerate(starts):
+            filename = os.path.join(folder, 'o{:02d}{}{:05d}_raw.fits'.format(visit, kind, i))
+            temperature = REF_TEMP + 4 * rng.random()
+            write_raw(filename, detector, rng, targname, ccdgain, proposid,
+                      expstart, nimsets, temperature)
+            raw_files.append(filename)
+
+    return raw_files
+
+#-------------------------------------------------------------------------------
+
+def write_anneal_db(database, proposid=14425, visit=1, month_begin=57000., n_days=28,
+                    n_months=1):
+    """Write an anneal database for consecutive synthetic months
+
+    Parameters
+    ----------
+    database : str
+        sqlite file to write, the pipeline reads ``anneal_info.db``
+    proposid : int, optional
+        proposal of the anneals
+    visit : int, optional
+        visit of the anneal ending the first month
+    month_begin : float, optional
+        MJD of the end of the anneal before the first month
+    n_days : int, optional
+        length of each month
+    n_months : int, optional
+        number of months
+
+    """
+
+    anneal_length = 0.5
+    anneals = []
+    for i in range(n_months + 1):
+        end = month_begin + i * (n_days + anneal_length)
+        anneals.append((proposid, visit + i - 1, end - anneal_length, end))
+
+    pop_database(anneals, database)
+
+#-------------------------------------------------------------------------------
@@ -0,0 +1,16 @@
+"""Test setup
+
+The header index is kept in a temporary folder while the tests run,
+whichever runner imports them, so the tests never read or write the
+index in the home folder.
+
+"""
+
+import atexit
+import os
+import shutil
+import tempfile
+
+_scratch = tempfile.mkdtemp(prefix='refstis_tests_')
+os.environ['REFSTIS_HEADER_INDEX'] = os.path.join(_scratch, 'header_index.db')
+atexit.register(shutil.rmtree, _scratch, ignore_errors=True)
@@ -0,0 +1,81 @@
+from refstis import basedark
+from refstis.robust_stats import sigma_clipped_stats
+import numpy as np
+import os
+import tempfile
+import time
+
+#-------------------------------------------------------------------------------
+
+def test_flag_hotpix():
+    """ The fused hot pixel flagging should match update_sci followed by
+    find_hotpix as they were originally written
+
+    """
+
+    rng = np.random.default_rng(8)
+    sci = rng.normal(0.01, 0.002, (200, 150)).astype(np.float32)
+    hot = rng.integers(0, sci.size, 300)
+    sci.flat[hot] += rng.exponential(0.3, len(hot)).astype(np.float32)
+    dq = np.zeros(sci.shape, dtype=np.int16)
+    dq[:5] = 4
+
+    #-- update_sci
+    im_mean, im_median, im_std = sigma_clipped_stats(sci, sigma=5, maxiters=50)
+    only_hotpix = np.where(sci >= im_mean + 5.0 * im_std, sci - im_mean, 0)
+    expected = np.where(only_hotpix >= .1, 16, dq)
+
+    #-- find_hotpix
+    im_mean, im_median, im_std = sigma_clipped_stats(sci, sigma=3, maxiters=40)
+    expected[(sci > im_median + 5 * im_std) & (sci > im_mean + 0.1)] = 16
+
+    flagged = basedark.flag_hotpix(sci, dq.copy())
+    assert flagged.dtype == np.int16
+    assert np.array_equal(flagged, expected)
+    assert (flagged == 16).sum() > 100
+
+    assert np.array_equal(basedark.find_hotpix_dq(sci, basedark.update_sci_dq(sci, dq.copy())),
+                          expected)
+
+#-------------------------------------------------------------------------------
+
+def test_basedark_memo():
+    """ The memo key should follow the contents of the inputs and the
+    parameters, and only the most recently used memos be kept
+
+    """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        flt_list = []
+        for i in range(2):
+            flt_list.append(os.path.join(tmpdir, 'o0000000{}_flt.fits'.format(i)))
+            with open(flt_list[-1], 'w') as f:
+                f.write('dark {}'.format(i))
+        bias_files = []
+        for i in range(2):
+            bias_files.append(os.path.join(tmpdir, 'weekbias{}.fits'.format(i)))
+            with open(bias_files[-1], 'w') as f:
+                f.write('bias {}'.format(i))
+
+        key = basedark.basedark_key(flt_list, bias_files[0], 'basedark_1.fits')
+        assert key == basedark.basedark_key(flt_list[::-1], bias_files[0], 'basedark_1.fits')
+        assert key != basedark.basedark_key(flt_list, bias_files[1], 'basedark_1.fits')
+        assert key != basedark.basedark_key(flt_list, bias_files[0], 'basedark_2.fits')
+
+        #-- touching a file doesn't change the key, editing it does
+        os.utime(flt_list[0], (time.time() + 10, time.time() + 10))
+        assert key == basedark.basedark_key(flt_list, bias_files[0], 'basedark_1.fits')
+        with open(flt_list[0], 'w') as f:
+            f.write('dark 2')
+        assert key != basedark.basedark_key(flt_list, bias_files[0], 'basedark_1.fits')
+
+        for i in range(4):
+            memo = os.path.join(tmpdir, 'basedark_memo_{}.fits'.format(i))
+            with open(memo, 'w') as f:
+                f.write('memo')
+            os.utime(memo, (i, i))
+        basedark.prune_memos(tmpdir, keep=2)
+        assert sorted(item for item in os.listdir(tmpdir) if 'memo' in item) == \
+            ['basedark_memo_2.fits', 'basedark_memo_3.fits']
+
+#-------------------------------------------------------------------------------
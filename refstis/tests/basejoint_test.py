@@ -0,0 +1,120 @@
+from refstis import basejoint
+from astropy.io import fits
+import numpy as np
+import os
+import random
+import tempfile
+import time
+
+#-------------------------------------------------------------------------------
+
+def test_calibrate_many_order():
+    """ Results should come back in the order of the inputs, however long
+    each calibration takes, from `calibrate_many` and `iter_calibrated`
+
+    """
+
+    def fake_calibrate(input_file):
+        time.sleep(random.random() / 100.)
+        return input_file.replace('.fits', '_crj.fits')
+
+    original = basejoint.calibrate
+    basejoint.calibrate = fake_calibrate
+    try:
+        input_list = ['o{:08d}_raw.fits'.format(i) for i in range(20)]
+        for calibrate_all in (basejoint.calibrate_many, basejoint.iter_calibrated):
+            crj_list = list(calibrate_all(input_list, workers=4))
+            assert crj_list == [item.replace('.fits', '_crj.fits') for item in input_list], \
+                calibrate_all.__name__
+    finally:
+        basejoint.calibrate = original
+
+    try:
+        basejoint.calibrate_many(input_list, pool='cluster')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Unknown pool accepted')
+
+#-------------------------------------------------------------------------------
+
+def test_average_biases():
+    """ The streaming average should match a direct calculation, and bad
+    inputs should all be reported before any data is read
+
+    """
+
+    rng = np.random.RandomState(5)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bias_list = []
+        for i in range(3):
+            hdu = fits.HDUList([fits.PrimaryHDU(),
+                                fits.ImageHDU(rng.normal(5000, 10, (16, 16)).astype(np.float32)),
+                                fits.ImageHDU(rng.uniform(1, 2, (16, 16)).astype(np.float32)),
+                                fits.ImageHDU(np.full((16, 16), 2 ** i, dtype=np.int16))])
+            hdu[0].header['NEXTEND'] = 3
+            hdu[0].header['TEXPTIME'] = 1.0
+            hdu[1].header['NCOMBINE'] = 5 + i
+            bias_list.append(os.path.join(tmpdir, 'o0000000{}_crj.fits'.format(i)))
+            hdu.writeto(bias_list[-1])
+
+        mean_hdu, totalweight = basejoint.average_bias_arrays(bias_list)
+
+        assert totalweight == 18
+        assert mean_hdu[0].header['TEXPTIME'] == 3.0
+        expected = sum(fits.getdata(item, 1).astype(np.float64) for item in bias_list) / 18
+        assert np.allclose(mean_hdu[1].data, expected, rtol=1e-7)
+        expected = np.sqrt(sum(fits.getdata(item, 2).astype(np.float64) ** 2
+                               for item in bias_list)) / 18
+        assert np.allclose(mean_hdu[2].data, expected, rtol=1e-7)
+        assert (mean_hdu[3].data == 7).all()
+
+        for item in bias_list[1:]:
+            fits.setval(item, 'NCOMBINE', ext=1, value=1)
+        try:
+            basejoint.average_bias_arrays(bias_list)
+        except ValueError as e:
+            assert bias_list[1] in str(e) and bias_list[2] in str(e)
+        else:
+            raise AssertionError('Inputs that were not CR-rejected were accepted')
+
+#-------------------------------------------------------------------------------
+
+def test_check_raw_inputs():
+    """ Single imsets which are not CR-rejected are left out, and every raw
+    bias that can't be combined is reported before any work
+
+    """
+
+    from refstis import synthetic
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        detector = synthetic.Detector()
+        rng = np.random.default_rng(11)
+        good = []
+        for i in range(2):
+            good.append(os.path.join(tmpdir, 'o0000000{}_raw.fits'.format(i)))
+            synthetic.write_raw(good[-1], detector, rng, nimsets=2)
+        basejoint.check_raw_inputs(good)
+
+        single = os.path.join(tmpdir, 'o00000002_raw.fits')
+        synthetic.write_raw(single, detector, rng, nimsets=1)
+        gain4 = os.path.join(tmpdir, 'o00000003_raw.fits')
+        synthetic.write_raw(gain4, detector, rng, nimsets=2, ccdgain=4)
+
+        assert basejoint.check_raw_inputs(good + [single]) == good
+
+        crj = os.path.join(tmpdir, 'o00000004_raw.fits')
+        synthetic.write_raw(crj, detector, rng, nimsets=1)
+        fits.setval(crj, 'CRCORR', value='COMPLETE')
+        assert basejoint.check_raw_inputs([crj] + good) == [crj] + good
+
+        try:
+            basejoint.check_raw_inputs(good + [single, gain4])
+        except ValueError as e:
+            assert gain4 in str(e)
+            assert single not in str(e) and good[1] not in str(e)
+        else:
+            raise AssertionError('Bad inputs accepted')
+
+#-------------------------------------------------------------------------------
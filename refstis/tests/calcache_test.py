@@ -0,0 +1,111 @@
+from refstis import calcache
+from astropy.io import fits
+import os
+import tempfile
+import time
+
+#-------------------------------------------------------------------------------
+
+def test_store_fetch_evict():
+    """ Outputs should be reused only for identical inputs and switches,
+    and the oldest entries dropped once over the size limit
+
+    """
+
+    old_env = {name: os.environ.get(name)
+               for name in ('REFSTIS_CALCACHE_DIR', 'REFSTIS_CALCACHE_BYTES')}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.environ['REFSTIS_CALCACHE_DIR'] = os.path.join(tmpdir, 'cache')
+        os.environ['REFSTIS_CALCACHE_BYTES'] = '250'
+        try:
+            start = time.time()
+            raw = os.path.join(tmpdir, 'o00000000_raw.fits')
+            output = os.path.join(tmpdir, 'o00000000_flt.fits')
+            with open(raw, 'w') as f:
+                f.write('raw data')
+
+            key = calcache.make_key('basic2d', [raw], switches={'biascorr': 'perform'})
+            assert key != calcache.make_key('basic2d', [raw], switches={'biascorr': 'omit'})
+            assert not calcache.fetch(key, 'basic2d', {'flt': output})
+
+            with open(output, 'w') as f:
+                f.write('x' * 100)
+            calcache.store(key, 'basic2d', {'flt': output})
+            os.remove(output)
+
+            assert calcache.fetch(key, 'basic2d', {'flt': output})
+            with open(output) as f:
+                assert f.read() == 'x' * 100
+
+            #-- a different input gives a different key
+            with open(raw, 'w') as f:
+                f.write('new raw data')
+            new_key = calcache.make_key('basic2d', [raw], switches={'biascorr': 'perform'})
+            assert new_key != key
+
+            #-- two more entries push the least recently used one out
+            for other_key in (new_key, 'f' * 64):
+                time.sleep(0.01)
+                calcache.store(other_key, 'basic2d', {'flt': output})
+            assert not calcache.fetch(key, 'basic2d', {'flt': output})
+            assert calcache.fetch(new_key, 'basic2d', {'flt': output})
+
+            summary = calcache.report(since=start)
+            assert 'basic2d' in summary and '2 hits' in summary and '2 misses' in summary
+        finally:
+            for name, value in old_env.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+    assert calcache.make_key('basic2d', []) is None
+
+#-------------------------------------------------------------------------------
+
+def test_reference_tables():
+    """ Tables a step reads through the header, named with oref$, should be
+    part of its key
+
+    """
+
+    old_env = {name: os.environ.get(name) for name in ('REFSTIS_CALCACHE_DIR', 'oref')}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.environ['REFSTIS_CALCACHE_DIR'] = os.path.join(tmpdir, 'cache')
+        os.environ['oref'] = os.path.join(tmpdir, 'oref') + os.sep
+        try:
+            os.mkdir(os.environ['oref'])
+            ccdtab = os.path.join(tmpdir, 'oref', 'ccd.fits')
+            crrejtab = os.path.join(tmpdir, 'oref', 'crr.fits')
+            for table in (ccdtab, crrejtab):
+                with open(table, 'w') as f:
+                    f.write('table')
+
+            raw = os.path.join(tmpdir, 'o00000000_raw.fits')
+            header = fits.Header()
+            header['BPIXTAB'] = 'oref$missing_bpx.fits'
+            header['CCDTAB'] = 'oref$ccd.fits'
+            header['OSCNTAB'] = 'N/A'
+            header['CRREJTAB'] = 'oref$crr.fits'
+            fits.PrimaryHDU(header=header).writeto(raw)
+
+            tables = calcache.reference_tables(raw, 'basic2d')
+            assert [os.path.normpath(item) for item in tables] == [ccdtab]
+            tables = calcache.reference_tables(raw, 'crreject')
+            assert [os.path.normpath(item) for item in tables] == [ccdtab, crrejtab]
+
+            keys = {step: calcache.make_key(step, [raw], calcache.reference_tables(raw, step))
+                    for step in ('basic2d', 'crreject')}
+            with open(crrejtab, 'w') as f:
+                f.write('new table')
+            for step, key in keys.items():
+                new_key = calcache.make_key(step, [raw], calcache.reference_tables(raw, step))
+                assert (new_key != key) == (step == 'crreject'), step
+        finally:
+            for name, value in old_env.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+#-------------------------------------------------------------------------------
@@ -0,0 +1,48 @@
+from refstis import crrej
+import numpy as np
+
+#-------------------------------------------------------------------------------
+
+def make_stack(n_imsets=8, shape=(100, 80), seed=10):
+    rng = np.random.default_rng(seed)
+    sci = rng.normal(0, 5, (n_imsets,) + shape).astype(np.float32)
+
+    #-- a few cosmic rays, each in a single imset
+    sci[0, 10, 10] += 5000
+    sci[3, 50, 40] += 800
+    sci[5, 90, 70] += 300
+
+    return sci
+
+#-------------------------------------------------------------------------------
+
+def test_cosmic_rays_rejected():
+    """ Values hit by cosmic rays should not make it into the average """
+
+    sci = make_stack()
+    out_sci, out_err, out_dq, ncombine = crrej.crreject_stack(sci, None, None,
+                                                              readnoise=5.0,
+                                                              gain=1.0,
+                                                              crradius=0)
+
+    assert ncombine == 8
+    for index, imset in [((10, 10), 0), ((50, 40), 3), ((90, 70), 5)]:
+        others = np.delete(sci[:, index[0], index[1]], imset)
+        assert np.isclose(out_sci[index], others.mean(), atol=1e-3)
+
+    assert abs(out_sci.mean()) < .1, 'Error in average'
+    assert (out_dq == 0).all()
+
+#-------------------------------------------------------------------------------
+
+def test_chunks_match_full_frame():
+    """ Processing in row chunks must not change the result """
+
+    sci = make_stack()
+    full = crrej.crreject_stack(sci, None, None, crradius=1.5, chunk_rows=1000)
+    chunked = crrej.crreject_stack(sci, None, None, crradius=1.5, chunk_rows=7)
+
+    for a, b in zip(full[:3], chunked[:3]):
+        assert (a == b).all(), 'Chunked result differs'
+
+#-------------------------------------------------------------------------------
@@ -1,5 +1,10 @@
+from astropy.io import fits
 from refstis import functions
 import numpy as np
+import contextlib
+import io
+import os
+import tempfile
 
 #-------------------------------------------------------------------------------
 
@@ -34,3 +39,227 @@ def test_translate_date_string():
     pass
 
 #-------------------------------------------------------------------------------
+
+def test_bias_subtract_many_errors():
+    """ Every file should be attempted, with all failures reported together """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        missing = [os.path.join(tmpdir, 'o0000000{}_raw.fits'.format(i)) for i in range(3)]
+
+        try:
+            functions.bias_subtract_data_many(missing, os.path.join(tmpdir, 'bias.fits'),
+                                              workers=2)
+        except Exception as e:
+            message = str(e)
+        else:
+            raise AssertionError('No exception raised for missing files')
+
+        assert '3 of 3' in message
+        for filename in missing:
+            assert filename in message
+
+    assert functions.bias_subtract_data_many([], 'bias.fits') == []
+
+#-------------------------------------------------------------------------------
+
+def test_msjoin():
+    """ All imsets should be joined in order with consecutive EXTVERs """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file_list = []
+        for i in range(3):
+            hdu = fits.HDUList([fits.PrimaryHDU()])
+            hdu[0].header['NEXTEND'] = 6
+            for ver in (1, 2):
+                hdu.append(fits.ImageHDU(np.full((3, 4), 10 * i + ver, dtype=np.uint16),
+                                         name='SCI', ver=ver))
+                hdu.append(fits.ImageHDU(name='ERR', ver=ver))
+                hdu.append(fits.ImageHDU(name='DQ', ver=ver))
+            file_list.append(os.path.join(tmpdir, 'o0000000{}_raw.fits'.format(i)))
+            hdu.writeto(file_list[-1])
+
+        joined = os.path.join(tmpdir, 'joined.fits')
+        functions.msjoin(file_list, joined)
+
+        with fits.open(joined) as hdu:
+            assert hdu[0].header['NEXTEND'] == 18
+            assert len(hdu) == 19
+            for n, ext in enumerate(hdu[1::3]):
+                assert ext.header['EXTVER'] == n + 1
+                assert ext.data.dtype == np.uint16
+                assert (ext.data == 10 * (n // 2) + n % 2 + 1).all()
+
+#-------------------------------------------------------------------------------
+
+def test_temperature_scaling():
+    """ Scaling darks while joining them should match correcting them first """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file_list = []
+        rng = np.random.default_rng(3)
+        for i in range(2):
+            hdu = fits.HDUList([fits.PrimaryHDU()])
+            hdu[0].header['NEXTEND'] = 6
+            hdu[0].header['TEXPSTRT'] = 57000.0 + i
+            for ver in (1, 2):
+                hdu.append(fits.ImageHDU(rng.normal(10, 1, (5, 4)).astype(np.float32),
+                                         name='SCI', ver=ver))
+                hdu[-1].header['OCCDHTAV'] = 18.0 + i + ver
+                hdu.append(fits.ImageHDU(np.ones((5, 4), dtype=np.float32), name='ERR', ver=ver))
+                hdu.append(fits.ImageHDU(np.zeros((5, 4), dtype=np.int16), name='DQ', ver=ver))
+            file_list.append(os.path.join(tmpdir, 'o0000000{}_flt.fits'.format(i)))
+            hdu.writeto(file_list[-1])
+
+        fused = os.path.join(tmpdir, 'fused.fits')
+        functions.msjoin(file_list, fused, scale_temperature=True)
+
+        for filename in file_list:
+            assert 'TEMPCORR' not in fits.getheader(filename, 0), 'Input was modified'
+            functions.apply_dark_correction(filename, 57000.0)
+        joined = os.path.join(tmpdir, 'joined.fits')
+        functions.msjoin(file_list, joined, scale_temperature=True)
+
+        with fits.open(fused) as fused_hdu, fits.open(joined) as joined_hdu:
+            assert fused_hdu[0].header['TEMPCORR'] == 'COMPLETE'
+            assert joined_hdu[0].header['TEMPCORR'] == 'COMPLETE'
+            for ext in range(1, 13):
+                assert np.array_equal(fused_hdu[ext].data, joined_hdu[ext].data)
+
+            #-- the last imset was at 21C
+            factor = 1.0 / (1.0 + functions.DARK_V_TEMP * 3)
+            assert np.allclose(fused_hdu[11].data, factor)
+
+#-------------------------------------------------------------------------------
+
+def test_header_edits():
+    """ Header edits are written in one go, growth is reported, and the
+    header index is told of every edit
+
+    """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'o00000000_raw.fits')
+        hdu = fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(np.arange(12).reshape(3, 4))])
+        hdu[0].header['CRCORR'] = 'OMIT'
+        hdu.writeto(filename)
+        size = os.path.getsize(filename)
+
+        with functions.header_edits(filename) as header:
+            header['CRCORR'] = 'PERFORM'
+            header['APERTURE'] = '50CCD'
+        with fits.open(filename) as hdu:
+            assert hdu[0].header['CRCORR'] == 'PERFORM'
+            assert hdu[0].header['APERTURE'] == '50CCD'
+        assert os.path.getsize(filename) == size, 'Header should fit in place'
+
+        report = io.StringIO()
+        with contextlib.redirect_stdout(report):
+            with functions.header_edits(filename, ext=1) as header:
+                for i in range(40):
+                    header['KEY{}'.format(i)] = i
+        assert 'whole file will be rewritten' in report.getvalue()
+        with fits.open(filename) as hdu:
+            assert hdu[1].header['KEY39'] == 39
+            assert np.array_equal(hdu[1].data, np.arange(12).reshape(3, 4))
+
+        #-- the index entry is dropped even if the edit fails part way
+        from refstis import header_index
+        assert header_index.getval(filename, 'CRCORR') == 'PERFORM'
+        try:
+            with functions.header_edits(filename) as header:
+                header['CRCORR'] = 'COMPLETE'
+                raise RuntimeError('edit failed')
+        except RuntimeError:
+            pass
+        assert os.path.abspath(filename) not in header_index._parsed
+        assert header_index.getval(filename, 'CRCORR') == fits.getval(filename, 'CRCORR')
+
+#-------------------------------------------------------------------------------
+
+def test_write_reference_file():
+    """ Reference files are written in one go from their arrays """
+
+    from refstis import synthetic
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        detector = synthetic.Detector()
+        rng = np.random.default_rng(4)
+        input_list = []
+        for i in range(2):
+            input_list.append(os.path.join(tmpdir, 'o0000000{}_raw.fits'.format(i)))
+            synthetic.write_raw(input_list[-1], detector, rng, expstart=57000. + i)
+
+        sci = np.ones((1044, 1062), dtype=np.float32)
+        err = np.full_like(sci, 0.5)
+        dq = np.zeros(sci.shape, dtype=np.int16)
+        refname = os.path.join(tmpdir, 'refbias.fits')
+        functions.write_reference_file(refname, input_list, sci, err, dq,
+                                       taskname='REFBIAS', ncombine=2)
+
+        assert os.listdir(tmpdir).count('refbias.fits') == 1
+        assert not [item for item in os.listdir(tmpdir) if item.endswith('.tmp')]
+        with fits.open(refname) as hdu:
+            assert hdu[0].header['TASKNAME'] == 'REFBIAS'
+            assert hdu[0].header['FILENAME'] == 'refbias.fits'
+            assert hdu[0].header['FILETYPE'] == 'CCD BIAS IMAGE'
+            assert hdu[0].header['NEXTEND'] == 3
+            assert hdu[1].header['NCOMBINE'] == 2
+            assert [ext.header['EXTNAME'] for ext in hdu[1:]] == ['SCI', 'ERR', 'DQ']
+            assert np.array_equal(hdu[2].data, err)
+
+#-------------------------------------------------------------------------------
+
+def test_hot_columns():
+    """ Column means of several row fractions come from one pass, and hot
+    columns are found in column space, also for non-square images
+
+    """
+
+    rng = np.random.default_rng(6)
+    residual = rng.normal(0, 1, (1044, 300)).astype(np.float32)
+    residual[:, 17] += 5
+    residual[:200, 123] += 20
+
+    means = functions.column_means(residual, (1, .2))
+    assert means.shape == (2, 300)
+    assert np.allclose(means[0], residual[:1024].mean(axis=0, dtype=np.float64))
+    assert np.allclose(means[1], residual[:209].mean(axis=0, dtype=np.float64))
+
+    assert np.flatnonzero(functions.hot_columns(means[0], nsigma=5.0)).tolist() == [17, 123]
+    assert 123 in np.flatnonzero(functions.hot_columns(means[1], nsigma=5.0))
+
+#-------------------------------------------------------------------------------
+
+def test_crreject_imsets_numpy():
+    """ The numpy method gives the arrays of the combined file without
+    writing any file, and the builders use them directly
+
+    """
+
+    from refstis import crrej, refbias, synthetic
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        detector = synthetic.Detector()
+        rng = np.random.default_rng(12)
+        raw_files = []
+        for i in range(2):
+            raw_files.append(os.path.join(tmpdir, 'o0000000{}_raw.fits'.format(i)))
+            synthetic.write_raw(raw_files[-1], detector, rng, nimsets=2, expstart=57000. + i)
+
+        expected = crrej.combine_files(raw_files, os.path.join(tmpdir, 'expected.fits'))
+        before = set(os.listdir(tmpdir))
+
+        sci, err, dq, ncombine = functions.crreject_imsets(
+            raw_files, os.path.join(tmpdir, 'week_crj.fits'), 'numpy')
+        assert ncombine == 4
+        with fits.open(expected) as hdu:
+            for ext, data in zip((1, 2, 3), (sci, err, dq)):
+                assert np.array_equal(hdu[ext].data, data)
+        assert set(os.listdir(tmpdir)) == before
+
+        refbias_name = os.path.join(tmpdir, 'refbias.fits')
+        with contextlib.redirect_stdout(io.StringIO()):
+            refbias.make_refbias(raw_files, refbias_name, crreject_method='numpy')
+        assert set(os.listdir(tmpdir)) == before | {'refbias.fits'}
+
+#-------------------------------------------------------------------------------
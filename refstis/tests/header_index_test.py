@@ -0,0 +1,88 @@
+from refstis import header_index
+from astropy.io import fits
+import numpy as np
+import os
+import tempfile
+
+#-------------------------------------------------------------------------------
+
+def test_index_invalidation():
+    """ Check that keywords are served from the index and re-read once the
+    file changes
+
+    """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        old_index = os.environ.get('REFSTIS_HEADER_INDEX')
+        os.environ['REFSTIS_HEADER_INDEX'] = os.path.join(tmpdir, 'index.db')
+        try:
+            filename = os.path.join(tmpdir, 'o00000000_raw.fits')
+            hdu = fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(np.zeros((4, 4)))])
+            hdu[0].header['TARGNAME'] = 'BIAS'
+            hdu[1].header['EXPSTART'] = 55000.5
+            hdu.writeto(filename)
+
+            reads = []
+            original = header_index._read_headers
+            header_index._read_headers = lambda path: reads.append(path) or original(path)
+            try:
+                assert header_index.getval(filename, 'TARGNAME') == 'BIAS'
+                assert header_index.getval(filename, 'EXPSTART', 1) == 55000.5
+                assert header_index.getheader(filename)['NAXIS'] == 0
+            finally:
+                header_index._read_headers = original
+
+            #-- an unchanged file is parsed once
+            assert len(reads) == 1
+
+            #-- force a different mtime in case the filesystem is coarse
+            fits.setval(filename, 'TARGNAME', value='DARK')
+            stats = os.stat(filename)
+            os.utime(filename, ns=(stats.st_atime_ns, stats.st_mtime_ns + 10**9))
+            assert header_index.getval(filename, 'TARGNAME') == 'DARK'
+
+            #-- a fresh process would read the entry back from the database
+            header_index._parsed.clear()
+            assert header_index.getval(filename, 'TARGNAME') == 'DARK'
+        finally:
+            if old_index is None:
+                del os.environ['REFSTIS_HEADER_INDEX']
+            else:
+                os.environ['REFSTIS_HEADER_INDEX'] = old_index
+
+#-------------------------------------------------------------------------------
+
+def test_same_tick_edit():
+    """ An edit keeping the size and modification time must still be seen """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        old_index = os.environ.get('REFSTIS_HEADER_INDEX')
+        os.environ['REFSTIS_HEADER_INDEX'] = os.path.join(tmpdir, 'index.db')
+        try:
+            filename = os.path.join(tmpdir, 'o00000000_flt.fits')
+            hdu = fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(np.zeros((4, 4)))])
+            hdu[0].header['TEMPCORR'] = 'NO'
+            hdu.writeto(filename)
+            assert header_index.getval(filename, 'TEMPCORR') == 'NO'
+
+            stats = os.stat(filename)
+            fits.setval(filename, 'TEMPCORR', value='YES')
+            os.utime(filename, ns=(stats.st_atime_ns, stats.st_mtime_ns))
+            assert os.path.getsize(filename) == stats.st_size
+            assert header_index.getval(filename, 'TEMPCORR') == 'YES'
+
+            #-- and an entry left in the database by another process
+            header_index._parsed.clear()
+            fits.setval(filename, 'TEMPCORR', value='NO')
+            os.utime(filename, ns=(stats.st_atime_ns, stats.st_mtime_ns))
+            assert header_index.getval(filename, 'TEMPCORR') == 'NO'
+
+            header_index.invalidate(filename)
+            assert header_index.getval(filename, 'TEMPCORR') == 'NO'
+        finally:
+            if old_index is None:
+                del os.environ['REFSTIS_HEADER_INDEX']
+            else:
+                os.environ['REFSTIS_HEADER_INDEX'] = old_index
+
+#-------------------------------------------------------------------------------
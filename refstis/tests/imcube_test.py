@@ -0,0 +1,59 @@
+from astropy.io import fits
+from refstis import crrej, imcube, synthetic
+import numpy as np
+import os
+import tempfile
+
+#-------------------------------------------------------------------------------
+
+def test_matches_in_memory():
+    """ Combining out of core, in small blocks of rows, should give the
+    same file as combining in memory, and leave no scratch files
+
+    """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        detector = synthetic.Detector()
+        rng = np.random.default_rng(9)
+        raw_files = []
+        for i in range(3):
+            raw_files.append(os.path.join(tmpdir, 'o0000000{}_raw.fits'.format(i)))
+            synthetic.write_raw(raw_files[-1], detector, rng, nimsets=2, expstart=57000. + i)
+
+        in_memory = crrej.combine_files(raw_files, os.path.join(tmpdir, 'memory.fits'))
+
+        scratch = os.path.join(tmpdir, 'scratch')
+        os.mkdir(scratch)
+        out_of_core = imcube.combine_files(raw_files, os.path.join(tmpdir, 'cube.fits'),
+                                           scratch_dir=scratch, memory=16 * 1024 ** 2)
+        assert os.listdir(scratch) == [], 'Scratch files left behind'
+
+        with fits.open(in_memory) as memory_hdu, fits.open(out_of_core) as cube_hdu:
+            assert cube_hdu[1].header['NCOMBINE'] == 6
+            for ext in range(1, 4):
+                assert np.array_equal(memory_hdu[ext].data, cube_hdu[ext].data)
+
+#-------------------------------------------------------------------------------
+
+def test_cube():
+    """ Imsets are stored in order, and the cube refuses extra ones """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with imcube.ImsetCube(2, tmpdir) as cube:
+            cube.append(np.ones((4, 5)), np.full((4, 5), 2.))
+            cube.append(np.zeros((4, 5)), np.ones((4, 5)), np.full((4, 5), 16))
+            assert cube.sci.shape == (2, 4, 5)
+            assert (cube.sci[0] == 1).all() and (cube.dq[0] == 0).all()
+            assert (cube.dq[1] == 16).all()
+            assert cube.chunk_rows(memory=imcube.BYTES_PER_VALUE * 2 * 5 * 10, halo=3) == 4
+
+            try:
+                cube.append(np.ones((4, 5)), np.ones((4, 5)))
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('Extra imset accepted')
+
+        assert os.listdir(tmpdir) == []
+
+#-------------------------------------------------------------------------------
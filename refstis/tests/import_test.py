@@ -0,0 +1,68 @@
+import os
+import subprocess
+import sys
+
+#-- dependencies which should only be loaded when actually used
+HEAVY_MODULES = ['matplotlib', 'crds', 'stistools', 'scipy', 'yaml']
+
+#-------------------------------------------------------------------------------
+
+def import_times(statement):
+    """ Run an import in a fresh interpreter with -X importtime
+
+    Returns a dict of top-level package name: cumulative import time (us)
+
+    """
+
+    package_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([package_dir, env.get('PYTHONPATH', '')])
+
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            stderr=subprocess.PIPE, universal_newlines=True, env=env,
+                            check=True).stderr
+
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        top = name.strip().split('.')[0]
+        times[top] = times.get(top, 0) + int(self_time)
+
+    return times
+
+#-------------------------------------------------------------------------------
+
+def test_builder_import_is_light():
+    """ Importing a single builder shouldn't load the plotting, CRDS or
+    calstis dependencies
+
+    """
+
+    times = import_times('import refstis.weekbias')
+    loaded = [name for name in HEAVY_MODULES if name in times]
+
+    assert not loaded, 'import refstis.weekbias loaded {} ({:.2f}s in refstis)'.format(
+        loaded, times['refstis'] / 1e6)
+
+#-------------------------------------------------------------------------------
+
+def test_lazy_submodules():
+    """ refstis.delivery and refstis.pipeline are still available as
+    attributes of the package
+
+    """
+
+    times = import_times('import refstis; refstis.delivery')
+    assert 'matplotlib' not in times
+
+    import refstis
+    try:
+        refstis.not_a_module
+    except AttributeError:
+        pass
+    else:
+        raise AssertionError('Unknown attribute did not raise AttributeError')
+
+#-------------------------------------------------------------------------------
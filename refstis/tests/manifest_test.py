@@ -0,0 +1,68 @@
+from refstis.manifest import Manifest, MANIFEST_NAME
+import os
+import tempfile
+
+#-------------------------------------------------------------------------------
+
+def write(filename, text):
+    with open(filename, 'w') as f:
+        f.write(text)
+
+#-------------------------------------------------------------------------------
+
+def test_staleness():
+    """ Products should only be rebuilt when their inputs, parameters or
+    upstream products change
+
+    """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        raw = [os.path.join(tmpdir, 'o0000000{}_raw.fits'.format(i)) for i in range(2)]
+        basebias = os.path.join(tmpdir, 'basebias.fits')
+        weekbias = os.path.join(tmpdir, 'weekbias.fits')
+        for filename in raw + [basebias, weekbias]:
+            write(filename, filename)
+
+        manifest = Manifest(os.path.join(tmpdir, MANIFEST_NAME))
+        params = {'procedure': 'weekbias'}
+        assert manifest.stale_reason(weekbias, raw + [basebias], params) == 'no build record'
+
+        manifest.add_pending('weekbias', weekbias, raw + [basebias], params)
+        manifest.task_done('weekbias')
+        manifest = Manifest(os.path.join(tmpdir, MANIFEST_NAME))
+        assert manifest.stale_reason(weekbias, raw + [basebias], params) is None
+
+        #-- a new time alone isn't a change
+        os.utime(raw[0], ns=(0, 0))
+        assert manifest.stale_reason(weekbias, raw + [basebias], params) is None
+
+        assert manifest.stale_reason(weekbias, raw + [basebias], {'procedure': 'refbias'})
+        assert manifest.stale_reason(weekbias, raw, params)
+        assert manifest.stale_reason(weekbias, raw + [basebias], params, rebuilding={basebias})
+
+        write(raw[1], 'new contents')
+        assert manifest.stale_reason(weekbias, raw + [basebias], params) == \
+            '{} changed'.format(raw[1])
+
+#-------------------------------------------------------------------------------
+
+def test_adopt_existing():
+    """ Products made without a manifest should be kept, unless an input
+    is being rebuilt
+
+    """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        basebias = os.path.join(tmpdir, 'basebias.fits')
+        weekbias = os.path.join(tmpdir, 'weekbias.fits')
+        missing = os.path.join(tmpdir, 'weekdark.fits')
+        for filename in (basebias, weekbias):
+            write(filename, filename)
+
+        manifest = Manifest(os.path.join(tmpdir, MANIFEST_NAME))
+        assert manifest.needs_build(weekbias, [basebias], rebuilding={basebias})
+        assert not manifest.needs_build(weekbias, [basebias])
+        assert manifest.needs_build(missing, [basebias])
+        assert manifest.stale_reason(weekbias, [basebias]) is None
+
+#-------------------------------------------------------------------------------
@@ -0,0 +1,36 @@
+from refstis import medfilt
+from scipy.ndimage import median_filter
+from scipy.signal import medfilt as signal_medfilt
+import numpy as np
+
+#-------------------------------------------------------------------------------
+
+def test_matches_scipy():
+    """ The filters should give exactly the scipy results, including at the
+    edges and across block boundaries
+
+    """
+
+    rng = np.random.RandomState(3)
+    data = rng.normal(1000, 5, (70, 90)).astype(np.float32)
+
+    for size in [(3, 15), (5, 5), (3, 3)]:
+        expected = median_filter(data, size)
+        for workers in (1, 3):
+            result = medfilt.median_filter(data.astype('>f4'), size,
+                                           workers=workers, chunk_rows=16)
+            assert np.array_equal(result, expected), (size, workers)
+
+        assert np.array_equal(medfilt.medfilt(data, size), signal_medfilt(data, size)), size
+
+#-------------------------------------------------------------------------------
+
+def test_even_kernel():
+    try:
+        medfilt.median_filter(np.zeros((10, 10)), (2, 3))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Even kernel size accepted')
+
+#-------------------------------------------------------------------------------
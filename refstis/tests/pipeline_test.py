@@ -0,0 +1,91 @@
+from refstis import basedark, pipeline, synthetic, weekdark
+import os
+import tempfile
+
+#-------------------------------------------------------------------------------
+
+def make_month(tmpdir):
+    folder = os.path.join(tmpdir, '14425_01')
+    synthetic.make_anneal_month(folder, n_days=14,
+                                bias_per_week=1, bias_imsets=2,
+                                dark_per_week=1, dark_imsets=1,
+                                gain4_bias_per_biweek=1, gain4_bias_imsets=1)
+    pipeline.separate_period(folder)
+
+    return folder
+
+#-------------------------------------------------------------------------------
+
+def test_gain1_weeks_wait_for_basebias():
+    """ Making the basebias edits the gain 1 raw biases in place, so no
+    gain 1 week may read them before it is done
+
+    """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        folder = make_month(tmpdir)
+
+        threshold = pipeline.BIAS_THRESHOLD[(1, 1, 1)]
+        try:
+            #-- weeks below the threshold use the weekbias procedure, which
+            #-- reads the basebias anyway, above it the refbias procedure
+            for value in (threshold, 1):
+                pipeline.BIAS_THRESHOLD[(1, 1, 1)] = value
+                tasks = {task.name: task for task in pipeline.build_task_graph(folder)}
+                assert 'basebias' in tasks
+
+                gain1 = [name for name in tasks if name.startswith('weekbias biases/1-1x1')]
+                assert len(gain1) == 2
+                for name in gain1:
+                    assert 'basebias' in tasks[name].depends, name
+
+                gain4 = [name for name in tasks if name.startswith('weekbias biases/4-1x1')]
+                assert gain4 and not tasks[gain4[0]].depends
+        finally:
+            pipeline.BIAS_THRESHOLD[(1, 1, 1)] = threshold
+
+#-------------------------------------------------------------------------------
+
+def test_basedark_built_once():
+    """ The basedark is made by a single task, which every weekdark waits
+    for, and the weekdarks never make it themselves, nor its products
+
+    """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        folder = make_month(tmpdir)
+        tasks = pipeline.build_task_graph(folder, crreject_method='numpy')
+
+        basedark_tasks = [task for task in tasks if task.func is basedark.make_basedark]
+        assert [task.name for task in basedark_tasks] == ['basedark']
+
+        products = [task for task in tasks if task.func is weekdark.prepare_basedark]
+        assert [task.name for task in products] == ['basedark products']
+        assert products[0].depends == {'basedark'}
+
+        weekdarks = [task for task in tasks if task.name.startswith('weekdark')]
+        assert len(weekdarks) == 2
+        for task in weekdarks:
+            assert task.func is weekdark.make_weekdark
+            assert 'basedark products' in task.depends, task.name
+
+#-------------------------------------------------------------------------------
+
+def test_task_workers():
+    """ Tasks calibrating many files should use the workers they are given,
+    not a pool the size of the machine
+
+    """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        folder = make_month(tmpdir)
+        for task_workers in (1, 3):
+            tasks = {task.name: task
+                     for task in pipeline.build_task_graph(folder, task_workers=task_workers)}
+            names = ['basebias', 'basedark'] + [name for name in tasks
+                                                 if name.startswith('weekdark')]
+            assert len(names) == 4
+            for name in names:
+                assert tasks[name].kwargs['workers'] == task_workers, name
+
+#-------------------------------------------------------------------------------
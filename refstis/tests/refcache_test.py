@@ -0,0 +1,97 @@
+from refstis import refcache
+from astropy.io import fits
+import numpy as np
+import os
+import tempfile
+
+#-------------------------------------------------------------------------------
+
+def test_cache_reuse_and_invalidation():
+    """ Products should be computed once per version of the file """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'basedark.fits')
+        fits.HDUList([fits.PrimaryHDU(),
+                      fits.ImageHDU(np.ones((8, 8), dtype=np.float32), name='SCI')]).writeto(filename)
+
+        calls = []
+        cache = refcache.ReferenceCache()
+        def compute():
+            calls.append(1)
+            return fits.getdata(filename, 1)
+
+        data = cache.get(filename, ('data', 1), compute)
+        assert cache.get(filename, ('data', 1), compute) is data
+        assert len(calls) == 1
+        assert not data.flags.writeable
+
+        fits.setval(filename, 'TARGNAME', ext=0, value='DARK')
+        stats = os.stat(filename)
+        os.utime(filename, ns=(stats.st_atime_ns, stats.st_mtime_ns + 10**9))
+        cache.get(filename, ('data', 1), compute)
+        assert len(calls) == 2
+
+#-------------------------------------------------------------------------------
+
+def test_cache_size_limit():
+    """ The least recently used products should be dropped first """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'basebias.fits')
+        fits.PrimaryHDU().writeto(filename)
+
+        cache = refcache.ReferenceCache(max_bytes=3 * 800)
+        for i in range(3):
+            cache.get(filename, i, lambda: np.zeros(100))
+        cache.get(filename, 0, lambda: np.zeros(100))
+        cache.get(filename, 3, lambda: np.zeros(100))
+
+        assert len(cache) == 3
+        assert cache.nbytes == 3 * 800
+        assert cache.misses == 4
+
+        #-- 1 was the least recently used
+        cache.get(filename, 1, lambda: np.zeros(100))
+        assert cache.misses == 5
+
+        #-- too big to keep at all
+        cache.get(filename, 'big', lambda: np.zeros(1000))
+        assert len(cache) == 3
+
+#-------------------------------------------------------------------------------
+
+def test_saved_products():
+    """ Derived products should be read back by another process, until the
+    file changes
+
+    """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'basedark.fits')
+        data = np.arange(64, dtype=np.float32).reshape(8, 8)
+        fits.HDUList([fits.PrimaryHDU(),
+                      fits.ImageHDU(data, name='SCI')]).writeto(filename)
+
+        saved = refcache._cache
+        try:
+            refcache._cache = refcache.ReferenceCache()
+            stats = refcache.clipped_stats(filename, ('sci', 1), sigma=5, maxiters=40)
+            med = refcache.medfilt(filename, ('sci', 1), (5, 5))
+            assert len(os.listdir(os.path.join(tmpdir, '.refcache'))) == 2
+
+            #-- a fresh cache, as in another worker, must not recompute
+            refcache._cache = refcache.ReferenceCache()
+            cache = refcache._cache
+            assert cache.get(filename, ('clipped_stats', ('sci', 1), 5, 40),
+                             lambda: 1 / 0, persist=True) == stats
+            np.testing.assert_array_equal(cache.get(filename, ('medfilt', ('sci', 1), (5, 5)),
+                                                    lambda: 1 / 0, persist=True), med)
+
+            fits.setval(filename, 'TARGNAME', ext=0, value='DARK')
+            mtime = os.stat(filename)
+            os.utime(filename, ns=(mtime.st_atime_ns, mtime.st_mtime_ns + 10**9))
+            refcache._cache = refcache.ReferenceCache()
+            assert refcache._cache.get(filename, ('medfilt', ('sci', 1), (5, 5)),
+                                       lambda: 'recomputed', persist=True) == 'recomputed'
+        finally:
+            refcache._cache = saved
@@ -0,0 +1,36 @@
+from refstis import robust_stats
+from astropy.stats import sigma_clipped_stats
+import numpy as np
+
+#-------------------------------------------------------------------------------
+
+def test_matches_astropy():
+    """ The clipped statistics should agree with astropy for the settings
+    used by the builders
+
+    """
+
+    rng = np.random.RandomState(42)
+    data = rng.normal(1000, 5, (256, 256)).astype(np.float32)
+    data[rng.randint(0, 256, 500), rng.randint(0, 256, 500)] += rng.exponential(500, 500)
+    data[0, 0] = np.nan
+
+    for sigma, maxiters in [(3, 40), (5, 50), (3, 1), (3, None)]:
+        expected = sigma_clipped_stats(data, sigma=sigma, maxiters=maxiters)
+        result = robust_stats.sigma_clipped_stats(data, sigma=sigma, maxiters=maxiters)
+        assert np.allclose(result, expected, rtol=1e-6), (sigma, maxiters)
+
+#-------------------------------------------------------------------------------
+
+def test_reuse_sorted_sample():
+    """ Clipping the same sample twice should give independent answers """
+
+    data = np.arange(101, dtype=np.float64)
+    data[-1] = 1e6
+
+    sample = robust_stats.SortedSample(data)
+    assert len(sample) == 101
+    assert sample.sigma_clipped_stats(3, 10)[0] == 49.5
+    assert sample.sigma_clipped_stats(3, 0)[1] == 50
+
+#-------------------------------------------------------------------------------
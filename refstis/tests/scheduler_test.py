@@ -0,0 +1,40 @@
+from refstis.scheduler import Task, Result, run_tasks, check_graph
+import operator
+
+#-------------------------------------------------------------------------------
+
+def make_tasks():
+    return [Task('total', sum, ([Result('a'), Result('b')],)),
+            Task('b', operator.mul, (Result('a'), 10)),
+            Task('a', operator.add, (1, 2))]
+
+#-------------------------------------------------------------------------------
+
+def test_dependency_order():
+    """ Tasks referencing other results must run after them """
+
+    order = check_graph(make_tasks())
+    assert order.index('a') < order.index('b') < order.index('total')
+
+    for workers in (1, 2):
+        done = []
+        results = run_tasks(make_tasks(), workers=workers,
+                            on_done=lambda name, value: done.append(name))
+        assert results == {'a': 3, 'b': 30, 'total': 33}, 'Error with {} workers'.format(workers)
+        assert done == ['a', 'b', 'total'], 'Error with {} workers'.format(workers)
+
+#-------------------------------------------------------------------------------
+
+def test_bad_graphs():
+    """ Cycles and unknown dependencies should be caught before running """
+
+    for tasks in ([Task('a', abs, (Result('b'),)), Task('b', abs, (Result('a'),))],
+                  [Task('a', abs, (1,), depends=['missing'])]):
+        try:
+            check_graph(tasks)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('Bad graph not caught: {}'.format(tasks))
+
+#-------------------------------------------------------------------------------
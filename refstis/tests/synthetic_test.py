@@ -0,0 +1,44 @@
+from refstis import synthetic, pipeline
+from astropy.io import fits
+import numpy as np
+import os
+import sqlite3
+import tempfile
+
+#-------------------------------------------------------------------------------
+
+def test_month_layout():
+    """ A synthetic month should look like raw archive data to the pipeline """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        folder = os.path.join(tmpdir, '14425_01')
+        raw_files = synthetic.make_anneal_month(folder, n_days=14,
+                                                bias_per_week=1, bias_imsets=2,
+                                                dark_per_week=1, dark_imsets=1,
+                                                gain4_bias_per_biweek=1, gain4_bias_imsets=1)
+        assert len(raw_files) == 3 + 3 + 2
+
+        with fits.open(raw_files[0]) as hdu:
+            assert hdu[0].header['NEXTEND'] == 6
+            assert hdu[0].header['TARGNAME'] == 'BIAS'
+            assert hdu[1].data.shape == (1044, 1062)
+            assert hdu[1].data.dtype.kind == 'u'
+            assert hdu[2].data is None
+
+            #-- bias level in the overscan, hot columns in the science region
+            assert abs(np.median(hdu[1].data[:, 2:17]) - synthetic.BIAS_LEVEL) < 5
+
+        pipeline.separate_period(folder)
+        for week in ('biases/1-1x1/wk01', 'biases/1-1x1/wk02', 'biases/4-1x1/biwk01',
+                     'darks/wk01', 'darks/wk02'):
+            assert os.listdir(os.path.join(folder, week)), 'Empty {}'.format(week)
+
+        database = os.path.join(tmpdir, 'anneal_info.db')
+        synthetic.write_anneal_db(database, n_days=14, n_months=2)
+        db = sqlite3.connect(database)
+        rows = db.execute('SELECT * FROM anneals').fetchall()
+        db.close()
+        assert len(rows) == 3
+        assert rows[0][4] == 57000.0 and rows[1][3] == 57014.0
+
+#-------------------------------------------------------------------------------
@@ -0,0 +1,52 @@
+from refstis import trace
+import json
+import os
+import pickle
+import tempfile
+
+#-------------------------------------------------------------------------------
+
+@trace.traced
+def double(filename, value):
+    return 2 * value
+
+#-------------------------------------------------------------------------------
+
+def test_export():
+    """ Spans should be recorded only when enabled, and merged into a
+    Chrome trace
+
+    """
+
+    old_dir = os.environ.pop('REFSTIS_TRACE_DIR', None)
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            assert double('before.fits', 1) == 2
+
+            run_dir = trace.start_run(tmpdir, 'test')
+            assert double('o00000000_raw.fits', 2) == 4
+            try:
+                with trace.span('calstis', category='calstis', file='joined.fits'):
+                    raise ValueError('calstis failed')
+            except ValueError:
+                pass
+
+            output = os.path.join(tmpdir, 'trace.json')
+            assert trace.export(run_dir, output) == 2
+
+            with open(output) as f:
+                events = json.load(f)['traceEvents']
+            spans = [event for event in events if event['ph'] == 'X']
+            assert [event['name'] for event in spans] == ['double', 'calstis']
+            assert spans[0]['args']['files'] == 'o00000000_raw.fits'
+            assert 'calstis failed' in spans[1]['args']['error']
+            assert all(event['dur'] >= 0 for event in spans)
+    finally:
+        os.environ.pop('REFSTIS_TRACE_DIR', None)
+        if old_dir is not None:
+            os.environ['REFSTIS_TRACE_DIR'] = old_dir
+
+    #-- traced functions must still be usable by the process pool
+    assert pickle.loads(pickle.dumps(double)) is double
+
+#-------------------------------------------------------------------------------
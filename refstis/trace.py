@@ -0,0 +1,172 @@
+"""Timing spans of the pipeline stages, exported in the Chrome trace format.
+
+Wrap a stage in `span`, or decorate a function with `traced`, and its
+start and duration are recorded when tracing is enabled.  The pipeline
+runs its tasks in a pool of processes, so every process appends its own
+spans to ``trace-<pid>.jsonl`` in the directory named by the
+``REFSTIS_TRACE_DIR`` environment variable (set before the pool is
+started, so the workers inherit it).  `export` merges those files into a
+single JSON file which can be opened in ``chrome://tracing`` or
+https://ui.perfetto.dev, showing each process and thread as a row.
+
+Tracing is disabled when ``REFSTIS_TRACE_DIR`` isn't set, in which case a
+span costs an environment lookup.
+
+"""
+
+from contextlib import contextmanager
+import functools
+import glob
+import json
+import os
+import threading
+import time
+
+_lock = threading.Lock()
+
+#-------------------------------------------------------------------------------
+
+def trace_dir():
+    """Return the directory spans are written to, or None if disabled"""
+
+    return os.environ.get('REFSTIS_TRACE_DIR') or None
+
+#-------------------------------------------------------------------------------
+
+def start_run(base_dir, label='refstis'):
+    """Enable tracing into a new folder for one run
+
+    Parameters
+    ----------
+    base_dir : str
+        folder holding the traces of all runs
+    label : str, optional
+        start of the name of the run folder
+
+    Returns
+    -------
+    run_dir : str
+        folder the spans of this run are written to
+
+    """
+
+    run_dir = os.path.join(base_dir, '{}_{}_{}'.format(
+        label, time.strftime('%Y%m%d_%H%M%S'), os.getpid()))
+    os.makedirs(run_dir)
+    os.environ['REFSTIS_TRACE_DIR'] = run_dir
+
+    return run_dir
+
+#-------------------------------------------------------------------------------
+
+def _write(event):
+    filename = os.path.join(trace_dir(), 'trace-{}.jsonl'.format(os.getpid()))
+    line = json.dumps(event) + '\n'
+    with _lock:
+        try:
+            with open(filename, 'a') as f:
+                f.write(line)
+        except OSError:
+            pass
+
+#-------------------------------------------------------------------------------
+
+@contextmanager
+def span(name, category='refstis', **args):
+    """Record the time spent in a block
+
+    Parameters
+    ----------
+    name : str
+        name of the span, e.g. 'make_weekbias'
+    category : str, optional
+        category of the span, shown by the trace viewer
+    **args
+        extra information shown with the span, e.g. the file processed
+
+    """
+
+    if trace_dir() is None:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    except BaseException as e:
+        args['error'] = repr(e)
+        raise
+    finally:
+        stop = time.time()
+        _write({'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': int(start * 1e6),
+                'dur': int((stop - start) * 1e6),
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': {key: str(value) for key, value in args.items()}})
+
+#-------------------------------------------------------------------------------
+
+def traced(func):
+    """Decorator recording every call of a function as a span
+
+    String arguments (the file names) are shown with the span.
+
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if trace_dir() is None:
+            return func(*args, **kwargs)
+
+        names = [item for item in args if isinstance(item, str)]
+        names += [value for value in kwargs.values() if isinstance(value, str)]
+        with span(func.__name__, category=func.__module__, files=' '.join(names)):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+#-------------------------------------------------------------------------------
+
+def export(run_dir, output):
+    """Merge the spans of every process into a Chrome trace file
+
+    Parameters
+    ----------
+    run_dir : str
+        folder of ``trace-<pid>.jsonl`` files
+    output : str
+        JSON file to write
+
+    Returns
+    -------
+    n_events : int
+        number of spans written
+
+    """
+
+    events = []
+    for filename in sorted(glob.glob(os.path.join(run_dir, 'trace-*.jsonl'))):
+        with open(filename) as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+
+    events.sort(key=lambda event: event['ts'])
+    main_pid = os.getpid()
+    metadata = [{'name': 'process_name',
+                 'ph': 'M',
+                 'pid': pid,
+                 'args': {'name': 'pipeline' if pid == main_pid else 'worker {}'.format(pid)}}
+                for pid in sorted({event['pid'] for event in events})]
+
+    with open(output, 'w') as f:
+        json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, f)
+
+    return len(events)
+
+#-------------------------------------------------------------------------------
@@ -2,17 +2,17 @@
 
 """
 
-from astropy.io import fits
-from astropy.stats import sigma_clipped_stats
 import numpy as np
-import shutil
 
 from . import functions
+from . import refcache
+from . import trace
 from .basejoint import replace_hot_cols
 
 #-------------------------------------------------------------------------------
 
-def make_weekbias(input_list, refbias_name, basebias):
+@trace.traced
+def make_weekbias(input_list, refbias_name, basebias, crreject_method='calstis'):
     """ Make 'weekly' bias from list of input bias files
 
     1. join imsets from each datset together into one large file
@@ -40,6 +40,8 @@ def make_weekbias(input_list, refbias_name, basebias):
         filename of the output reference file
     basebias : str
         filename of the monthly basebias
+    crreject_method : str, optional
+        'calstis' or 'numpy', see `refstis.functions.crreject_imsets`
 
     """
 
@@ -49,41 +51,33 @@ def make_weekbias(input_list, refbias_name, basebias):
     print('Output to %s' % (refbias_name))
     print('using {}'.format(basebias))
 
-    joined_out = refbias_name.replace('.fits', '_joined.fits')
-    functions.msjoin(input_list, joined_out)
+    crj_filename = refbias_name.replace('.fits', '_crj.fits')
+    crj_sci, err, dq, ncombine = functions.crreject_imsets(input_list, crj_filename,
+                                                           crreject_method)
 
-    crj_filename = functions.crreject(joined_out)
-    residual_image, median_image = functions.make_residual(crj_filename, (3, 15))
+    residual_image, median_image = functions.make_residual(crj_sci, (3, 15))
 
-    resi_columns_2d = functions.make_resicols_image(residual_image, yfrac=.25)
+    residual_columns = functions.column_means(residual_image, [.25])[0]
+    hot = functions.hot_columns(residual_columns, nsigma=5.0, maxiters=20)
 
-    resi_mean, resi_median, resi_std = sigma_clipped_stats(resi_columns_2d[0],
-                                                           sigma=3,
-                                                           maxiters=20)
-    replval = resi_mean + 5.0 * resi_std
-    only_hotcols = np.where(resi_columns_2d >= replval, residual_image, 0)
+    only_hotcols = np.zeros_like(residual_image)
+    only_hotcols[:, hot] = residual_image[:, hot]
 
-    with fits.open(crj_filename, mode='update') as hdu:
-        #-- update science extension
-        baseline_sci = fits.getdata(basebias, ext=('sci', 1))
-        hdu[('sci', 1)].data = baseline_sci + only_hotcols
+    #-- update science extension
+    baseline_sci = refcache.getdata(basebias, ('sci', 1))
+    sci = baseline_sci + only_hotcols
 
-        #-- update DQ extension
-        hot_index = np.where(only_hotcols > 0)
-        hdu[('dq', 1)].data[hot_index] = 16
+    #-- update DQ extension
+    hot_index = np.where(only_hotcols > 0)
+    dq[hot_index] = 16
 
-        #- update ERR
-        baseline_err = fits.getdata(basebias, ext=('err', 1))
-        no_hot_index = np.where(only_hotcols == 0)
-        hdu[('err', 1)].data[no_hot_index] = baseline_err[no_hot_index]
+    #- update ERR
+    baseline_err = refcache.getdata(basebias, ('err', 1))
+    no_hot_index = np.where(only_hotcols == 0)
+    err[no_hot_index] = baseline_err[no_hot_index]
 
-    shutil.copy(crj_filename, refbias_name)
-    functions.update_header_from_input(refbias_name, input_list)
-    fits.setval(refbias_name, 'TASKNAME', ext=0, value='WEEKBIAS')
-
-    print('Cleaning up...')
-    functions.RemoveIfThere(crj_filename)
-    functions.RemoveIfThere(joined_out)
+    functions.write_reference_file(refbias_name, input_list, sci, err, dq,
+                                   taskname='WEEKBIAS')
 
     print('weekbias done for {}'.format(refbias_name))
 
@@ -3,12 +3,36 @@
 """
 
 from astropy.io import fits
-from astropy.stats import sigma_clipped_stats
 import numpy as np
-from scipy.signal import medfilt
-import shutil
 
 from . import functions
+from . import refcache
+from . import trace
+from .robust_stats import sigma_clipped_stats
+
+#-- products of the basedark used by every week, see `prepare_basedark`
+BASEDARK_STATS = (('sci', 1), 5, 40)
+BASEDARK_MEDFILT = (('sci', 1), (5, 5))
+
+#-------------------------------------------------------------------------------
+
+def prepare_basedark(basedark):
+    """ Compute the basedark products used by every weekdark
+
+    The clipped statistics and median filter of the basedark are saved
+    next to it by `refstis.refcache`, so weekdarks built by other
+    processes read them rather than computing them again.
+
+    Parameters
+    ----------
+    basedark : str
+        basedark name
+
+    """
+
+    print('Preparing {}'.format(basedark))
+    refcache.clipped_stats(basedark, *BASEDARK_STATS)
+    refcache.medfilt(basedark, *BASEDARK_MEDFILT)
 
 #-------------------------------------------------------------------------------
 
@@ -27,57 +51,87 @@ def create_superdark(crj_filename, basedark):
     basedark : str
         basedark name
 
+    The basedark arrays and the products derived from them come from
+    `refstis.refcache`, so they are only computed once for all weeks.
+
     """
 
     with fits.open(crj_filename, mode='update') as crj_hdu:
+        sci, err, dq = make_superdark(crj_hdu[('sci', 1)].data,
+                                      crj_hdu[('err', 1)].data,
+                                      crj_hdu[('dq', 1)].data,
+                                      basedark)
+        crj_hdu[('sci', 1)].data = sci
+        crj_hdu[('err', 1)].data = err
+        crj_hdu[('dq', 1)].data = dq
 
-        ## Perform iterative statistics on this normalized superdark
-        data_mean, data_median, data_std = sigma_clipped_stats(crj_hdu[('sci', 1)].data,
-                                                               sigma=5,
-                                                               maxiters=40)
+#-------------------------------------------------------------------------------
 
-        p_five_sigma = data_median + (5*data_std)
-        print('hot pixels are defined as above: ', p_five_sigma)
-        basedark_hdu = fits.open(basedark)
+def make_superdark(sci, err, dq, basedark):
+    """ Superdark arrays from the normalized crj arrays and basedark
 
-        base_mean, base_median, base_std = sigma_clipped_stats(basedark_hdu[('sci', 1)].data,
-                                                            sigma=5,
-                                                            maxiters=40)
+    See `create_superdark`.
 
-        fivesig = base_median + 5.0 * base_std
-        zerodark = crj_hdu[('sci', 1)].data - base_median
-        only_hotpix = np.where(crj_hdu[('sci', 1)].data >= p_five_sigma,
-                               zerodark,
-                               0.0)
+    Parameters
+    ----------
+    sci, err, dq : np.ndarray
+        arrays of the normalized cosmic-ray rejected week
+    basedark : str
+        basedark name
+
+    Returns
+    -------
+    sci, err, dq : np.ndarray
+        arrays of the superdark
 
-        basedark_med = medfilt(basedark_hdu[('sci', 1)].data, (5, 5))
-        only_dark = np.where(basedark_hdu[('sci', 1)].data >= p_five_sigma,
-                             basedark_med,
-                             basedark_hdu[('sci', 1)].data)
+    """
 
+    ## Perform iterative statistics on this normalized superdark
+    data_mean, data_median, data_std = sigma_clipped_stats(sci,
+                                                           sigma=5,
+                                                           maxiters=40)
 
-        crj_hdu[('sci', 1)].data = only_dark + only_hotpix
+    p_five_sigma = data_median + (5*data_std)
+    print('hot pixels are defined as above: ', p_five_sigma)
+    basedark_sci = refcache.getdata(basedark, ('sci', 1))
+    basedark_err = refcache.getdata(basedark, ('err', 1))
 
-        #- update DQ extension
-        crj_hdu[('dq', 1)].data = np.where(only_hotpix >= p_five_sigma,
-                                           16,
-                                           crj_hdu[('dq', 1)].data)
+    base_mean, base_median, base_std = refcache.clipped_stats(basedark, *BASEDARK_STATS)
 
-        #- Update Error
-        crj_hdu[('err', 1)].data = np.where(only_hotpix == 0,
-                                            basedark_hdu[('err', 1)].data,
-                                            crj_hdu[('err', 1)].data)
+    fivesig = base_median + 5.0 * base_std
+    zerodark = sci - base_median
+    only_hotpix = np.where(sci >= p_five_sigma,
+                           zerodark,
+                           0.0)
+
+    basedark_med = refcache.medfilt(basedark, *BASEDARK_MEDFILT)
+    only_dark = np.where(basedark_sci >= p_five_sigma,
+                         basedark_med,
+                         basedark_sci)
+
+    #- update DQ extension
+    dq = np.where(only_hotpix >= p_five_sigma,
+                  16,
+                  dq)
+
+    #- Update Error
+    err = np.where(only_hotpix == 0,
+                   basedark_err,
+                   err)
+
+    return only_dark + only_hotpix, err, dq
 
 #-------------------------------------------------------------------------------
 
-def make_weekdark(input_list, refdark_name, thebasedark, thebiasfile=None):
+@trace.traced
+def make_weekdark(input_list, refdark_name, thebasedark, thebiasfile=None, workers=None):
     """ Create a weekly dark reference file
 
     1. If not already done, run basic2d with blevcorr, biascorr, and dqicorr 
        set to perform
-    2. Apply temperature correction to the data
-    3. split all raw images into their imsets
-    4. join imsets together into a single file
+    2. split all raw images into their imsets
+    3. join imsets together into a single file, applying the temperature
+       correction to the data as they are joined
     5. combine and cr-reject
     6. normalize to e/s by dividing by (exptime/gain)
     7. do hot pixel things
@@ -97,6 +151,9 @@ def make_weekdark(input_list, refdark_name, thebasedark, thebiasfile=None):
         Monthly basedark
     thebiasfile : str, bool, optional
         biasfile to use for calibration
+    workers : int, optional
+        number of files bias subtracted at a time, see
+        `refstis.functions.bias_subtract_data_many`
 
     """
 
@@ -110,19 +167,11 @@ def make_weekdark(input_list, refdark_name, thebasedark, thebiasfile=None):
     print('With : %s' % (thebiasfile))
     print('     : %s' % (thebasedark))
 
-    flt_list = [functions.bias_subtract_data(item, thebiasfile) for item in input_list]
-
-    for filename in flt_list:
-        texpstrt = fits.getval(filename, 'texpstrt', 0)
-        #Side 1 operations ended on May 16, 2001.
-        #Side 2 operations started on July 10, 2001,
-        #52091.0 corresponds to July 1, 2001
-        if texpstrt > 52091.0:
-            functions.apply_dark_correction(filename, texpstrt)
+    flt_list = functions.bias_subtract_data_many(input_list, thebiasfile, workers=workers)
 
     joined_out = refdark_name.replace('.fits', '_joined.fits')
-    print('Joining images to %s' % joined_out)
-    functions.msjoin(flt_list, joined_out)
+    print('Joining and temperature correcting images to %s' % joined_out)
+    functions.msjoin(flt_list, joined_out, scale_temperature=True)
 
     crdone = functions.bd_crreject(joined_out)
     print("## crdone is ", crdone)
@@ -130,13 +179,11 @@ def make_weekdark(input_list, refdark_name, thebasedark, thebiasfile=None):
         functions.bd_calstis(joined_out, thebiasfile)
 
     crj_filename = joined_out.replace('.fits', '_crj.fits')
-    shutil.copy(crj_filename, refdark_name)
-    functions.normalize_crj(refdark_name)
-
-    create_superdark(refdark_name, thebasedark)
+    sci, err, dq = functions.normalized_imset(crj_filename)
+    sci, err, dq = make_superdark(sci, err, dq, thebasedark)
 
-    functions.update_header_from_input(refdark_name, input_list)
-    fits.setval(refdark_name, 'TASKNAME', ext=0, value='WEEKDARK')
+    functions.write_reference_file(refdark_name, input_list, sci, err, dq,
+                                   taskname='WEEKDARK')
 
     print('Cleaning up...')
     functions.RemoveIfThere(crj_filename)